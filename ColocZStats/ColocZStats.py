@@ -1,3 +1,5 @@
+import itertools
+import math
 import os
 import unittest
 import logging
@@ -6,6 +8,7 @@ import SegmentStatistics
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import time
+from ColocZStatsLib import BackgroundTask, Benchmark, ChannelCache, ColocEngine, CompositeRendering, Dependencies, ImageRegistry, Instrumentation, IntegralVolume, JointHistogram, Pyramid, ResultCache, SpreadsheetExport, ThresholdSweep, TiffStreaming
 try:
    import numpy as np
 except ModuleNotFoundError:
@@ -74,14 +77,26 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._updatingGUIFromParameterNode = False
         self._updatingParameterNodeFromGUI = False
         self._importingScene = False
-        self.volumeDict = {}
-        self.uiGroupDict = {}
-        self.annotationDict = {}
-        self.ROINodeDict = {}
-        self.ROICheckedDict = {}
-        self.InputCheckedDict = {}
+        # State of the loaded images and of their channels, by file path.
+        self.images = ImageRegistry.ImageRegistry()
         self.currentIndex = -1
         self.imageWidget = None
+        # Colocalization computation running in the background, if any.
+        self.computeTask = None
+        self.computeTimer = qt.QTimer()
+        self.computeTimer.setInterval(100)
+        # ROI node observed for the live ROI statistics, if any.
+        self.observedROINode = None
+        # Whether channels changed since the state was last written to the parameter node.
+        # The state is written when the sync timer fires, so that dragging a slider doesn't rewrite it on every tick.
+        self.stateModified = False
+        self.parameterSyncTimer = qt.QTimer()
+        self.parameterSyncTimer.setSingleShot(True)
+        self.parameterSyncTimer.setInterval(200)
+        # Updates the composite renderings once the sliders settle, in the composite rendering mode.
+        self.compositeTimer = qt.QTimer()
+        self.compositeTimer.setSingleShot(True)
+        self.compositeTimer.setInterval(100)
         self.channelsWidget = qt.QWidget()
         self.channelsLayout = qt.QVBoxLayout()
         self.channelsWidget.setLayout(self.channelsLayout)
@@ -113,6 +128,7 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartImportEvent, self.onSceneStartImport)
         self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndImportEvent, self.onSceneEndImport)
+        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartSaveEvent, self.onSceneStartSave)
 
         # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
         # (in the selected parameter node).
@@ -125,7 +141,34 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.RenameButton.connect('clicked(bool)', self.onRenameButtonClicked)
         self.ui.DeleteButton.connect('clicked(bool)', self.onDeleteButtonClicked)
         self.ui.ComputeButton.connect('clicked(bool)', self.onComputeButtonClicked)
+        self.ui.PreviewButton.connect('clicked(bool)', self.onPreviewButtonClicked)
+        self.ui.CancelButton.connect('clicked(bool)', self.onCancelButtonClicked)
+        self.ui.ComputeSegmentsButton.connect('clicked(bool)', self.onComputeSegmentsButtonClicked)
+        self.computeTimer.connect('timeout()', self.onComputeTimer)
+        self.parameterSyncTimer.connect('timeout()', self.syncModifiedChannels)
+        self.compositeTimer.connect('timeout()', lambda: self.logic.updateCompositeRendering(self))
+        self.ui.ComputeProgressBar.visible = False
+        self.ui.CancelButton.visible = False
         self.ui.AnnotationText.connect('updateMRMLFromWidgetFinished()', self.onAnnotationTextSaved)
+        self.ui.LazyLoadingCheckBox.checked = slicer.util.settingsValue("ColocZStats/LazyLoading", False, converter=slicer.util.toBool)
+        self.logic.lazyLoading = self.ui.LazyLoadingCheckBox.checked
+        self.ui.LazyLoadingCheckBox.connect('toggled(bool)', self.onLazyLoadingToggled)
+        self.ui.CompositeRenderingCheckBox.checked = slicer.util.settingsValue("ColocZStats/CompositeRendering", False, converter=slicer.util.toBool)
+        self.logic.compositeRendering = self.ui.CompositeRenderingCheckBox.checked
+        self.ui.CompositeRenderingCheckBox.connect('toggled(bool)', self.onCompositeRenderingToggled)
+        self.ui.LiveStatsCheckBox.connect('toggled(bool)', self.onLiveStatsToggled)
+        self.ui.LiveROIStatsCheckBox.connect('toggled(bool)', self.onLiveROIStatsToggled)
+        self.ui.HistogramBinsSpinBox.value = int(slicer.util.settingsValue("ColocZStats/HistogramBins", JointHistogram.DEFAULT_SCATTER_BINS, converter=int))
+        self.logic.histogramBins = self.ui.HistogramBinsSpinBox.value
+        self.ui.HistogramBinsSpinBox.connect('valueChanged(int)', self.onHistogramBinsChanged)
+        self.ui.HistogramHtmlCheckBox.checked = slicer.util.settingsValue("ColocZStats/HistogramHtmlExport", False, converter=slicer.util.toBool)
+        self.logic.histogramHtmlExport = self.ui.HistogramHtmlCheckBox.checked
+        self.ui.HistogramHtmlCheckBox.connect('toggled(bool)', self.onHistogramHtmlToggled)
+        self.ui.ProfilingCheckBox.checked = self.logic.profiler.enabled
+        self.ui.ProfilingCheckBox.connect('toggled(bool)', self.onProfilingToggled)
+
+        # Install the optional packages once and import them in the background, before the first computation.
+        self.logic.prepareDependencies()
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
@@ -137,6 +180,13 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.updateParameterNodeFromGUI()
 
+    def currentImage(self):
+        """
+        The ImageState of the image selected in the input volume's combobox, or None.
+        """
+        comboBox = self.ui.InputVolumeComboBox
+        return self.images.get(comboBox.itemData(comboBox.currentIndex))
+
     def onInputVolumeChange(self, index):
         """
         Called when input volume's combobox changes.
@@ -148,37 +198,37 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # Disabled old input volume widgets
         if oldIndex != -1:
-            oldFilename = comboBox.itemData(oldIndex)
-            if oldFilename:
-                oldGroupBox = self.uiGroupDict[oldFilename]
-                oldGroupBox.hide()
-                if oldFilename in self.ROINodeDict:
-                    self.ROINodeDict[oldFilename].GetDisplayNode().SetVisibility(False)
+            oldImage = self.images.get(comboBox.itemData(oldIndex))
+            if oldImage and oldImage.groupBox:
+                oldImage.groupBox.hide()
+                if oldImage.roiNode:
+                    oldImage.roiNode.GetDisplayNode().SetVisibility(False)
 
         # Enable new input volume widgets
-        filename = comboBox.itemData(index)
-        if filename:
-            groupBox = self.uiGroupDict[filename]
-            groupBox.show()
-
-            if filename in self.ROINodeDict:
-                self.ROINodeDict[filename].GetDisplayNode().SetVisibility(self.ROICheckedDict[filename])
-
-        if filename in self.annotationDict:
-            annotationTextNode = self.annotationDict[filename]
-            if annotationTextNode:
-                self.ui.AnnotationText.setMRMLTextNode(annotationTextNode)
+        image = self.images.get(comboBox.itemData(index))
+        if image:
+            # The widgets of images restored from a scene are created when the image is first selected.
+            if image.groupBox is None:
+                self.buildImageWidgets(image)
+            image.groupBox.show()
+
+            if image.roiNode:
+                image.roiNode.GetDisplayNode().SetVisibility(image.roiVisible)
+
+        if image and image.annotationNode:
+            self.ui.AnnotationText.setMRMLTextNode(image.annotationNode)
         else:
             self.ui.AnnotationText.setMRMLTextNode(None)
 
-        if filename in self.InputCheckedDict:
-            self.ui.InputCheckBox.checked = self.InputCheckedDict[filename]
+        if image:
+            self.ui.InputCheckBox.checked = image.inputVisible
 
-        if filename in self.ROINodeDict:
-            self.ui.ROICheckBox.setChecked(self.ROICheckedDict[filename])
+        if image and image.roiNode:
+            self.ui.ROICheckBox.setChecked(image.roiVisible)
         else:
             self.ui.ROICheckBox.setChecked(False)
 
+        self.updateROIObserver()
         self.updateParameterNodeFromGUI()
 
     @vtk.calldata_type(vtk.VTK_OBJECT)
@@ -194,22 +244,20 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         if self._updatingGUIFromParameterNode:
             return
-        comboBox = self.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        channelVolumeList = self.volumeDict.get(filename)
-        if not channelVolumeList:
+        image = self.currentImage()
+        if not image:
             return
 
         volRenLogic = slicer.modules.volumerendering.logic()
-        self.InputCheckedDict[filename] = checked
+        image.inputVisible = checked
 
-        group = self.uiGroupDict[filename]
-        checkBoxes = group.findChildren(qt.QCheckBox)
-        for index in range(len(channelVolumeList)):
-            channelVolumeNode = channelVolumeList[index]
-            if channelVolumeNode:
+        for index in range(image.channelCount):
+            channelVolumeNode = image.volumes[index]
+            if channelVolumeNode and self.logic.isChannelLoaded(channelVolumeNode):
                 displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(channelVolumeNode)
-                displayNode.SetVisibility(checked and checkBoxes[index].checked)
+                if displayNode:
+                    displayNode.SetVisibility(checked and bool(image.visible[index]))
+        self.scheduleCompositeUpdate()
 
         self.updateParameterNodeFromGUI()
 
@@ -221,12 +269,23 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if self._updatingGUIFromParameterNode:
             return
         comboBox = self.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        channelVolumeList = self.volumeDict.get(filename)
-        if not channelVolumeList:
+        image = self.currentImage()
+        if not image:
+            return
+
+        # Channels that are not loaded yet have no geometry to fit the ROI to.
+        loadedChannelVolumeList = [channelVolumeNode for channelVolumeNode in image.volumes if channelVolumeNode and self.logic.isChannelLoaded(channelVolumeNode)]
+        if not loadedChannelVolumeList:
+            text = "Please display at least one channel before creating the ROI box."
+            msg = qt.QMessageBox()
+            msg.setIcon(qt.QMessageBox.Warning)
+            msg.setText(text)
+            msg.setStandardButtons(qt.QMessageBox.Ok)
+            msg.exec_()
+            self.ui.ROICheckBox.setChecked(not checked)
             return
 
-        createROINode = not (filename in self.ROINodeDict)
+        createROINode = image.roiNode is None
         if createROINode:
             ROINode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
             ROINode.SetName(comboBox.currentText + " ROI")
@@ -234,17 +293,18 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             roiDisplayNode.SetColor(1.0, 1.0, 1.0)
             roiDisplayNode.SetSelectedColor(1.0, 1.0, 1.0)
             roiDisplayNode.SetOpacity(0.0)
-            self.ROINodeDict[filename] = ROINode
-            self.ROICheckedDict[filename] = checked
+            image.roiNode = ROINode
+            image.roiVisible = checked
 
         volRenLogic = slicer.modules.volumerendering.logic()
-        roiNodeID = self.ROINodeDict[filename].GetID()
+        roiNodeID = image.roiNode.GetID()
 
         # Fit ROI bounding box to volume and enable the cropping effect.
-        for channelVolumeNode in channelVolumeList:
+        for channelVolumeNode in loadedChannelVolumeList:
             if channelVolumeNode:
                 displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(channelVolumeNode)
-                displayNode.SetAndObserveROINodeID(roiNodeID)
+                if displayNode:
+                    displayNode.SetAndObserveROINodeID(roiNodeID)
                 if createROINode:
                     cropVolumeParameters = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLCropVolumeParametersNode")
                     cropVolumeParameters.SetInputVolumeNodeID(channelVolumeNode.GetID())
@@ -252,10 +312,13 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropVolumeParameters)
                     slicer.modules.cropvolume.logic().FitROIToInputVolume(cropVolumeParameters)
                     slicer.mrmlScene.RemoveNode(cropVolumeParameters)
-                displayNode.SetCroppingEnabled(checked)
-        self.ROINodeDict[filename].GetDisplayNode().SetVisibility(checked)
-        self.ROICheckedDict[filename] = checked
+                if displayNode:
+                    displayNode.SetCroppingEnabled(checked)
+        image.roiNode.GetDisplayNode().SetVisibility(checked)
+        image.roiVisible = checked
+        self.scheduleCompositeUpdate()
 
+        self.updateROIObserver()
         self.updateParameterNodeFromGUI()
 
     def onRecenterButtonClicked(self):
@@ -263,11 +326,8 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         Called when the 'Re-center ROI' button is clicked.
         To reposition the image region selected by the ROI bounding box to the center of the scene.
         """
-        comboBox = self.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        roiNode = None
-        if filename in self.ROINodeDict:
-            roiNode = self.ROINodeDict[filename]
+        image = self.currentImage()
+        roiNode = image.roiNode if image else None
         layoutManager = slicer.app.layoutManager()
         threeDWidget = layoutManager.threeDWidget(0)
         threeDView = threeDWidget.threeDView()
@@ -284,24 +344,19 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         To rename the current volume.
         """
         comboBox = self.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        channelVolumeList = self.volumeDict.get(filename)
-        if not channelVolumeList:
+        image = self.currentImage()
+        if not image:
             return
         text = qt.QInputDialog.getText(self.layout.parentWidget(), "Rename Volume", "New name:", qt.QLineEdit.Normal, comboBox.currentText)
         if text:
             newName = str(text)
             comboBox.setItemText(comboBox.currentIndex, newName)
-            groupBox = self.uiGroupDict[filename]
-            checkBoxes = groupBox.findChildren(qt.QCheckBox)
-            for index in range(len(channelVolumeList)):
-                if channelVolumeList[index]:
-                    name = newName + "_" + checkBoxes[index].text
-                    channelVolumeList[index].SetName(name)
+            for index in range(image.channelCount):
+                if image.volumes[index]:
+                    name = newName + "_" + image.labels[index]
+                    image.volumes[index].SetName(name)
             self.updateParameterNodeFromGUI()
-            roiNode = None
-            if filename in self.ROINodeDict:
-                roiNode = self.ROINodeDict[filename]
+            roiNode = image.roiNode
             if roiNode:
                 roiNode.SetName(newName + " ROI")
             else:
@@ -315,31 +370,27 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         To delete the current volume from the scene.
         """
         comboBox = self.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        channelVolumeList = self.volumeDict.get(filename)
-        if not channelVolumeList:
+        image = self.currentImage()
+        if not image:
             return
 
-        for channelVolumeNode in channelVolumeList:
+        for channelVolumeNode in image.volumes:
             if channelVolumeNode:
+                self.logic.releaseChannelBuffer(channelVolumeNode)
                 slicer.mrmlScene.RemoveNode(channelVolumeNode)
 
         # Delete all sliders from the UI that control the threshold of all channels.
-        self.volumeDict.pop(filename, None)
-        groupBox = self.uiGroupDict[filename]
-        groupBox.hide()
-        self.uiGroupDict.pop(filename, None)
-        groupBox.setParent(None)
+        self.images.remove(image.filename)
+        groupBox = image.groupBox
+        if groupBox:
+            groupBox.hide()
+            groupBox.setParent(None)
         comboBox.removeItem(comboBox.currentIndex)
 
         # Delete all ROI bounding box as well.
-        if filename in self.ROINodeDict:
-            ROINode = None
-            ROINode = self.ROINodeDict.pop(filename)
-            if ROINode:
-                slicer.mrmlScene.RemoveNode(ROINode)
-        if filename in self.ROICheckedDict:
-            self.ROICheckedDict.pop(filename)
+        if image.roiNode:
+            slicer.mrmlScene.RemoveNode(image.roiNode)
+        self.logic.removeCompositeRendering(image.filename)
 
     def onComputeButtonClicked(self):
         """
@@ -348,6 +399,177 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         self.logic.computeStats(self)
 
+    def onPreviewButtonClicked(self):
+        """
+        Called when the 'Preview' button is clicked.
+        """
+        self.logic.previewStats(self)
+
+    def onComputeSegmentsButtonClicked(self):
+        """
+        Called when the 'Compute per Segment' button is clicked.
+        To compute the colocalization within every segment of the selected segmentation.
+        """
+        self.logic.computeStatsForSegments(self, self.ui.SegmentationSelector.currentNode())
+
+    def startComputeTask(self, task):
+        """
+        Show the progress of a computation running in the background and enable its cancellation.
+        """
+        self.computeTask = task
+        self.ui.ComputeButton.enabled = False
+        self.ui.ComputeSegmentsButton.enabled = False
+        self.ui.DeleteButton.enabled = False
+        self.ui.ComputeProgressBar.value = 0
+        self.ui.ComputeProgressBar.format = task.stage + " (%p%)"
+        self.ui.ComputeProgressBar.visible = True
+        self.ui.CancelButton.enabled = True
+        self.ui.CancelButton.visible = True
+        self.computeTimer.start()
+
+    def onComputeTimer(self):
+        """
+        Called periodically while a computation runs in the background: shows its progress and its results.
+        """
+        task = self.computeTask
+        if task is None:
+            self.computeTimer.stop()
+            return
+        finished = task.poll()
+        self.ui.ComputeProgressBar.value = int(task.progress * 100)
+        if not task.cancelled:
+            self.ui.ComputeProgressBar.format = task.stage + " (%p%)"
+        if not finished:
+            return
+
+        self.finishComputeTask()
+        if task.error is not None:
+            logging.error(task.errorTraceback)
+            self.logic.showWarning("Colocalization failed: " + str(task.error))
+        elif task.cancelled:
+            logging.info("Colocalization cancelled.")
+
+    def onCancelButtonClicked(self):
+        """
+        Called when the 'Cancel' button is clicked. The computation stops at its next progress report.
+        """
+        if self.computeTask is not None:
+            self.computeTask.cancel()
+            self.ui.CancelButton.enabled = False
+            self.ui.ComputeProgressBar.format = "Cancelling..."
+
+    def finishComputeTask(self):
+        """
+        Restore the module panel after a background computation.
+        """
+        self.computeTimer.stop()
+        self.computeTask = None
+        self.ui.ComputeButton.enabled = True
+        self.ui.ComputeSegmentsButton.enabled = True
+        self.ui.DeleteButton.enabled = True
+        self.ui.ComputeProgressBar.visible = False
+        self.ui.CancelButton.visible = False
+
+    def stopComputeTask(self):
+        """
+        Cancel the background computation and wait for it, e.g. before the volumes it reads are removed.
+        """
+        task = self.computeTask
+        if task is None:
+            return
+        task.cancel()
+        task.wait()
+        task.discardMainThreadCalls()
+        self.finishComputeTask()
+
+    def onLazyLoadingToggled(self, checked):
+        """
+        Called when the 'Load channels on demand' checkbox is toggled.
+        Applies to the images that are loaded afterwards.
+        """
+        self.logic.lazyLoading = checked
+        qt.QSettings().setValue("ColocZStats/LazyLoading", checked)
+
+    def onLiveStatsToggled(self, checked):
+        """
+        Called when the 'Live statistics while adjusting thresholds' checkbox is toggled.
+        """
+        if checked:
+            self.logic.updateLiveStats(self)
+        else:
+            self.ui.LiveStatsLabel.text = ""
+            self.logic.jointHistograms.clear()
+
+    def onHistogramBinsChanged(self, value):
+        """
+        Called when the number of 2D histogram bins is changed.
+        """
+        self.logic.histogramBins = value
+        qt.QSettings().setValue("ColocZStats/HistogramBins", value)
+
+    def onHistogramHtmlToggled(self, checked):
+        """
+        Called when the 'Also export interactive 2D histograms (HTML)' checkbox is toggled.
+        """
+        self.logic.histogramHtmlExport = checked
+        qt.QSettings().setValue("ColocZStats/HistogramHtmlExport", checked)
+        if checked:
+            self.logic.prepareDependencies()
+
+    def onCompositeRenderingToggled(self, checked):
+        """
+        Called when the 'Composite rendering' checkbox is toggled.
+        """
+        qt.QSettings().setValue("ColocZStats/CompositeRendering", checked)
+        self.compositeTimer.stop()
+        self.logic.setCompositeRendering(self, checked)
+
+    def scheduleCompositeUpdate(self):
+        """
+        Update the composite renderings when the timer fires, in the composite rendering mode.
+        The channels changed until then are blended together.
+        """
+        if self.logic.compositeRendering and not self.compositeTimer.active:
+            self.compositeTimer.start()
+
+    def onProfilingToggled(self, checked):
+        """
+        Called when the 'Record stage timings' checkbox is toggled.
+        """
+        self.logic.profiler.enabled = checked
+        qt.QSettings().setValue("ColocZStats/Profiling", checked)
+
+    def onLiveROIStatsToggled(self, checked):
+        """
+        Called when the 'Live statistics while moving the ROI' checkbox is toggled.
+        """
+        self.updateROIObserver()
+        if checked:
+            self.logic.updateLiveROIStats(self)
+        else:
+            self.ui.LiveStatsLabel.text = ""
+            self.logic.integralVolume = None
+
+    def updateROIObserver(self):
+        """
+        Observe the ROI of the current image while the live ROI statistics are enabled.
+        """
+        image = self.currentImage()
+        roiNode = image.roiNode if image and self.ui.LiveROIStatsCheckBox.checked else None
+        if roiNode is self.observedROINode:
+            return
+        if self.observedROINode is not None:
+            self.removeObserver(self.observedROINode, vtk.vtkCommand.ModifiedEvent, self.onROIModified)
+        self.observedROINode = roiNode
+        if roiNode is not None:
+            self.addObserver(roiNode, vtk.vtkCommand.ModifiedEvent, self.onROIModified)
+
+    def onROIModified(self, caller, event):
+        """
+        Called when the observed ROI is moved or resized.
+        """
+        self.logic.updateLiveROIStats(self)
+
     def onAnnotationTextSaved(self):
         """
         To save the annotation text.
@@ -359,6 +581,9 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.stopComputeTask()
+        self.parameterSyncTimer.stop()
+        self.compositeTimer.stop()
         self.removeObservers()
 
     def enter(self):
@@ -380,6 +605,14 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         Called just before the scene is closed.
         """
+        # The background computation reads the channel volumes that are about to be removed.
+        self.stopComputeTask()
+        if self.observedROINode is not None:
+            self.removeObserver(self.observedROINode, vtk.vtkCommand.ModifiedEvent, self.onROIModified)
+            self.observedROINode = None
+        self.logic.integralVolume = None
+        self.logic.channelCache.clear()
+        self.logic.pyramids = {}
         self.updateParameterNodeFromGUI()
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
@@ -388,10 +621,23 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         Called just after the scene is closed.
         """
+        self.logic.channelBuffers.clear()
+        self.logic.composites.clear()
         # If this module is shown while the scene is closed then recreate a new parameter node immediately
         if self.parent.isEntered:
             self.initializeParameterNode()
 
+    def onSceneStartSave(self, caller, event):
+        """
+        Called just before the scene is saved.
+        Channels that were never displayed are loaded so that the saved scene contains all channels.
+        """
+        self.syncModifiedChannels()
+        for image in self.images:
+            for channelVolumeNode in image.volumes:
+                if channelVolumeNode:
+                    self.logic.loadChannel(channelVolumeNode, self)
+
     def onSceneStartImport(self, caller, event):
         self._importingScene = True
 
@@ -440,6 +686,7 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         This method is called whenever parameter node is changed.
         The module GUI is updated to show the current state of the parameter node.
+        Only the widgets of the selected image are created, the widgets of the other images are created when they are selected.
         """
 
         if self._parameterNode is None or self._updatingGUIFromParameterNode or self._updatingParameterNodeFromGUI or self._importingScene:
@@ -448,174 +695,125 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
         self._updatingGUIFromParameterNode = True
 
-        countStr = self._parameterNode.GetParameter("Count")
-        if countStr == None or countStr == "":
+        state = self.readState()
+        if state is None:
             self._updatingGUIFromParameterNode = False
             return
 
-        # Image Count
-        imageCount = int(countStr)
-        # Current Selected Index
-        currentText = self._parameterNode.GetParameter("CurrentText")
-
         comboBox = self.ui.InputVolumeComboBox
+        # The images are selected once all of them are restored, so that adding the first one doesn't create its widgets.
+        wasBlocked = comboBox.blockSignals(True)
         # Load data for each image
-        for index in range(imageCount):
+        for index, imageState in enumerate(state['images']):
             indexStr = str(index)
+            filepath = imageState['filepath']
 
-            # Item Text
-            itemText = self._parameterNode.GetParameter("ItemText" + indexStr)
-
-            # Filepath
-            filepath = self._parameterNode.GetParameter("Filepath" + indexStr)
-
-            # Input Check Box
-            InputVisibility = (self._parameterNode.GetParameter("InputVisibility" + indexStr) == "true")
-            self.InputCheckedDict[filepath] = InputVisibility
+            # Reference for all channels' volume.
+            channelVolumes = list()
+            for channelIndex in range(len(imageState['channels'])):
+                channelVolumes.append(self._parameterNode.GetNodeReference("Volume" + indexStr + "_" + str(channelIndex)))
+
+            image = self.images.get(filepath)
+            if image is None:
+                image = ImageRegistry.ImageState(filepath, channelVolumes, [channelState['label'] for channelState in imageState['channels']])
+                image.annotationNode = self._parameterNode.GetNodeReference("AnnotationNode" + indexStr)
+                image.applyDict(imageState)
+                self.images.add(image)
+                comboBox.addItem(imageState['itemText'], filepath)
+            else:
+                image.applyDict(imageState)
+                self.updateImageWidgets(image)
 
-            # ROI Check Box
+            # ROI
             ROINode = self._parameterNode.GetNodeReference("ROINode" + indexStr)
             if ROINode:
-                self.ROINodeDict[filepath] = ROINode
-            ROICheckStatus = (self._parameterNode.GetParameter("ROI" + indexStr) == "true")
-            self.ROICheckedDict[filepath] = ROICheckStatus
+                image.roiNode = ROINode
 
             # Annotation
-            annotationText = self._parameterNode.GetParameter("Annotation" + indexStr)
-            if not annotationText:
-                annotationText = ""
-
-            # Channel count
-            channelCount = int(self._parameterNode.GetParameter("Channel Count" + indexStr))
+            if image.annotationNode:
+                image.annotationNode.SetText(imageState.get('annotation', ""))
+        comboBox.setCurrentIndex(comboBox.findText(state['currentText']))
+        comboBox.blockSignals(wasBlocked)
+        self.onInputVolumeChange(comboBox.currentIndex)
 
-            # Create layout
-            layout = qt.QVBoxLayout()
-
-            # Reference for all channels' volume.
-            channelVolumes = list()
-            for channelIndex in range(channelCount):
-                volumeParameterName = "Volume" + str(index) + "_" + str(channelIndex)
-                channelVolume = self._parameterNode.GetNodeReference(volumeParameterName)
-                channelVolumes.append(channelVolume)
-
-            if filepath not in self.uiGroupDict:
-                for channelIndex in range(len(channelVolumes)):
-
-                    # Update the state of channels' Visibility, LowerThreshold, UpperThreshold.
-                    visibilityParameterName = "Visibility" + str(index) + "_" + str(channelIndex)
-                    visibility = (self._parameterNode.GetParameter(visibilityParameterName) == "true")
-                    channelLabelName = "ChannelLabel" + str(index) + "_" + str(channelIndex)
-                    channelLabel = str(self._parameterNode.GetParameter(channelLabelName))
-
-                    lowerThresholdParameterName = "LowerThreshold" + str(index) + "_" + str(channelIndex)
-                    lowerThreshold = int(float(self._parameterNode.GetParameter(lowerThresholdParameterName)))
-
-                    upperThresholdParameterName = "UpperThreshold" + str(index) + "_" + str(channelIndex)
-                    upperThreshold = int(float(self._parameterNode.GetParameter(upperThresholdParameterName)))
-
-                    lowerThresholdBoundParameterName = "LowerThresholdBound" + str(index) + "_" + str(channelIndex)
-                    lowerThresholdBound = int(float(self._parameterNode.GetParameter(lowerThresholdBoundParameterName)))
-
-                    upperThresholdBoundParameterName = "UpperThresholdBound" + str(index) + "_" + str(channelIndex)
-                    upperThresholdBound = int(float(self._parameterNode.GetParameter(upperThresholdBoundParameterName)))
-
-                    # Create widgets for channel volume node
-                    subHorizontallayout = qt.QHBoxLayout()
-                    name = channelLabel
-                    checkBox = qt.QCheckBox(name)
-                    checkBox.objectName = name + "_checkbox"
-                    checkBox.setChecked(visibility)
-                    self.connectCheckBoxChangeSlot(checkBox, channelVolumes[channelIndex])
-                    subHorizontallayout.addWidget(checkBox)
-                    renameChannelbutton = qt.QPushButton("Rename Channel")
-                    renameChannelbutton.objectName = name + "_renameButton"
-                    self.connectRenameChannelButtonChangeSlot(renameChannelbutton, channelVolumes[channelIndex], subHorizontallayout, checkBox)
-                    subHorizontallayout.addWidget(renameChannelbutton)
-                    thresholdSlider = slicer.qMRMLVolumeThresholdWidget()
-                    thresholdSlider.objectName = name + "_threshold"
-                    thresholdSlider.setMRMLVolumeNode(channelVolumes[channelIndex])
-                    thresholdSlider.lowerThreshold = lowerThreshold
-                    thresholdSlider.upperThreshold = upperThreshold
-                    thresholdSlider.lowerThresholdBound = lowerThresholdBound
-                    thresholdSlider.upperThresholdBound = upperThresholdBound
-                    self.connectThresholdChangeSlot(thresholdSlider, channelVolumes[channelIndex])
-                    layout.addItem(subHorizontallayout)
-                    layout.addWidget(thresholdSlider)
-
-                # Add a groupBox for thresholding widgets.
-                self.volumeDict[filepath] = channelVolumes
-                groupBox = qt.QGroupBox("")
-                self.uiGroupDict[filepath] = groupBox
-                layout.addStretch()
-                groupBox.setLayout(layout)
-                self.channelsLayout.addWidget(groupBox)
-                self.ui.scrollArea.setWidget(self.channelsWidget)
-                comboBox.addItem(itemText, filepath)
-
-                # Create text node for the annotation.
-                annotationTextNode = self._parameterNode.GetNodeReference("AnnotationNode" + indexStr)
-                annotationTextNode.SetText(annotationText)
-                self.annotationDict[filepath] = annotationTextNode
-            else:
-                groupBox = self.uiGroupDict[filepath]
-                checkBoxes = groupBox.findChildren(qt.QCheckBox)
-                thresholdSliders = groupBox.findChildren(slicer.qMRMLVolumeThresholdWidget)
-
-                for channelIndex in range(len(channelVolumes)):
-                    # Update the state of channels' Visibility, LowerThreshold, UpperThreshold.
-                    visibilityParameterName = "Visibility" + str(index) + "_" + str(channelIndex)
-                    visibility = (self._parameterNode.GetParameter(visibilityParameterName) == "true")
-                    channelLabelName = "ChannelLabel" + str(index) + "_" + str(channelIndex)
-                    channelLabel = str(self._parameterNode.GetParameter(channelLabelName))
-                    checkBox = checkBoxes[channelIndex]
-                    checkBox.setChecked(visibility)
-                    checkBox.setText(channelLabel)
-
-                    lowerThresholdParameterName = "LowerThreshold" + str(index) + "_" + str(channelIndex)
-                    lowerThreshold = int(float(self._parameterNode.GetParameter(lowerThresholdParameterName)))
-
-                    upperThresholdParameterName = "UpperThreshold" + str(index) + "_" + str(channelIndex)
-                    upperThreshold = int(float(self._parameterNode.GetParameter(upperThresholdParameterName)))
-
-                    lowerThresholdBoundParameterName = "LowerThresholdBound" + str(index) + "_" + str(channelIndex)
-                    lowerThresholdBound = int(float(self._parameterNode.GetParameter(lowerThresholdBoundParameterName)))
-
-                    upperThresholdBoundParameterName = "UpperThresholdBound" + str(index) + "_" + str(channelIndex)
-                    upperThresholdBound = int(float(self._parameterNode.GetParameter(upperThresholdBoundParameterName)))
-
-                    thresholdSlider = thresholdSliders[channelIndex]
-                    thresholdSlider.lowerThreshold = lowerThreshold
-                    thresholdSlider.upperThreshold = upperThreshold
-
-                    thresholdSlider.lowerThresholdBound = lowerThresholdBound
-                    thresholdSlider.upperThresholdBound = upperThresholdBound
-
-                annotationTextNode = self.annotationDict[filepath]
-                annotationTextNode.SetText(annotationText)
-            currentFile = comboBox.itemData(comboBox.currentIndex)
-            if currentFile == filepath:
-                groupBox.show()
-                self.currentIndex = comboBox.currentIndex
-            else:
-                groupBox.hide()
-
-        currentIndex = comboBox.findText(currentText)
-        comboBox.setCurrentIndex(currentIndex)
-        filename = comboBox.itemData(currentIndex)
-        if filename:
-            if filename in self.InputCheckedDict:
-                self.ui.InputCheckBox.checked = self.InputCheckedDict[filename]
-            if filename in self.ROINodeDict:
-                self.ROINodeDict[filename].GetDisplayNode().SetVisibility(self.ROICheckedDict[filename])
-                self.ui.ROICheckBox.setChecked(self.ROICheckedDict[filename])
-            if filename in self.annotationDict:
-                annotationTextNode = self.annotationDict[filename]
-                if annotationTextNode:
-                    self.ui.AnnotationText.setMRMLTextNode(annotationTextNode)
+        # The scene may have been saved in the other rendering mode.
+        self.logic.setCompositeRendering(self, self.logic.compositeRendering)
 
         # All the GUI updates are done
         self._updatingGUIFromParameterNode = False
 
+    def readState(self):
+        """
+        The state of the module saved in the parameter node (see ImageRegistry.loadState), or None if there is none.
+        """
+        stateText = self._parameterNode.GetParameter("State")
+        if stateText:
+            try:
+                return ImageRegistry.loadState(stateText)
+            except ValueError as error:
+                logging.error("Could not restore the ColocZStats state: " + str(error))
+                return None
+        # Scenes saved by previous versions of the module have one parameter per image and channel property.
+        if self._parameterNode.GetParameter("Count"):
+            return ImageRegistry.stateFromParameters(self._parameterNode.GetParameter)
+        return None
+
+    def buildImageWidgets(self, image):
+        """
+        Create the group box with the checkbox, rename button and threshold slider of each channel of a restored image.
+        """
+        layout = qt.QVBoxLayout()
+        for channelIndex in range(image.channelCount):
+            volume = image.volumes[channelIndex]
+            # Create widgets for channel volume node
+            subHorizontallayout = qt.QHBoxLayout()
+            name = image.labels[channelIndex]
+            checkBox = qt.QCheckBox(name)
+            checkBox.objectName = name + "_checkbox"
+            self.connectCheckBoxChangeSlot(checkBox, volume)
+            subHorizontallayout.addWidget(checkBox)
+            renameChannelbutton = qt.QPushButton("Rename Channel")
+            renameChannelbutton.objectName = name + "_renameButton"
+            self.connectRenameChannelButtonChangeSlot(renameChannelbutton, volume, subHorizontallayout, checkBox)
+            subHorizontallayout.addWidget(renameChannelbutton)
+            thresholdSlider = slicer.qMRMLVolumeThresholdWidget()
+            thresholdSlider.objectName = name + "_threshold"
+            thresholdSlider.setMRMLVolumeNode(volume)
+            layout.addItem(subHorizontallayout)
+            layout.addWidget(thresholdSlider)
+            image.checkBoxes[channelIndex] = checkBox
+            image.thresholdSliders[channelIndex] = thresholdSlider
+        self.updateImageWidgets(image)
+        for channelIndex in range(image.channelCount):
+            self.connectThresholdChangeSlot(image.thresholdSliders[channelIndex], image.volumes[channelIndex])
+
+        # Add a groupBox for thresholding widgets.
+        groupBox = qt.QGroupBox("")
+        image.groupBox = groupBox
+        layout.addStretch()
+        groupBox.setLayout(layout)
+        groupBox.hide()
+        self.channelsLayout.addWidget(groupBox)
+        self.ui.scrollArea.setWidget(self.channelsWidget)
+
+    def updateImageWidgets(self, image):
+        """
+        Show the channel state of an image in its channel widgets, if they were created.
+        """
+        for channelIndex in range(image.channelCount):
+            checkBox = image.checkBoxes[channelIndex]
+            thresholdSlider = image.thresholdSliders[channelIndex]
+            if checkBox is None or thresholdSlider is None:
+                continue
+            lowerThreshold, upperThreshold = image.thresholds[channelIndex]
+            lowerThresholdBound, upperThresholdBound = image.thresholdBounds[channelIndex]
+            checkBox.setChecked(bool(image.visible[channelIndex]))
+            checkBox.setText(image.labels[channelIndex])
+            thresholdSlider.lowerThreshold = float(lowerThreshold)
+            thresholdSlider.upperThreshold = float(upperThreshold)
+            thresholdSlider.lowerThresholdBound = float(lowerThresholdBound)
+            thresholdSlider.upperThresholdBound = float(upperThresholdBound)
+
     def updateParameterNodeFromGUI(self, caller=None, event=None):
         """
         This method is called when the user makes any change in the GUI.
@@ -626,91 +824,81 @@ class ColocZStatsWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             return
 
         self._updatingParameterNodeFromGUI = True
+        # The whole state is written below, including the channels waiting for the sync timer.
+        self.stateModified = False
+        self.parameterSyncTimer.stop()
         comboBox = self.ui.InputVolumeComboBox
         wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
-        # Image Count
-        imageCount = len(self.volumeDict)
-        self._parameterNode.SetParameter("Count", str(imageCount))
-        if imageCount == 0:
-            self._parameterNode.EndModify(wasModified)
-            self._updatingParameterNodeFromGUI = False
-            return
-
-        self.ui.AnnotationText.saveEdits()
+        if len(self.images) > 0:
+            self.ui.AnnotationText.saveEdits()
 
-        # The Item Text of current selected volume.
-        self._parameterNode.SetParameter("CurrentText", comboBox.currentText)
-
-        # Save data for each image
-        for index in range(imageCount):
+        # Node references of each image, so that the scene remaps their IDs when it is loaded.
+        for index in range(comboBox.count):
             indexStr = str(index)
-
-            # Item Text
-            self._parameterNode.SetParameter("ItemText" + indexStr, comboBox.itemText(index))
-
-            # Filepath
-            filepath = comboBox.itemData(index)
-            self._parameterNode.SetParameter("Filepath" + indexStr, filepath)
-
-            # Input Check Box
-            if filepath in self.InputCheckedDict:
-                self._parameterNode.SetParameter("InputVisibility" + indexStr,
-                                                 "true" if self.InputCheckedDict[filepath] else "false")
-            # ROI Check Box
-            if filepath in self.ROICheckedDict:
-                self._parameterNode.SetParameter("ROI" + indexStr, "true" if self.ROICheckedDict[filepath] else "false")
-            if filepath in self.ROINodeDict:
-                self._parameterNode.SetNodeReferenceID("ROINode" + indexStr, self.ROINodeDict[filepath].GetID())
-
-            # Annotation
-            annotationTextNode = self.annotationDict[filepath]
-            self._parameterNode.SetNodeReferenceID("AnnotationNode" + indexStr, annotationTextNode.GetID())
-            annotationText = annotationTextNode.GetText()
-            if not annotationText:
-                annotationText = ""
-            self._parameterNode.SetParameter("Annotation" + indexStr, annotationText)
-
-            # Channel count
-            channelVolumeList = self.volumeDict.get(filepath)
-            channelCount = len(channelVolumeList)
-            self._parameterNode.SetParameter("Channel Count" + indexStr, str(channelCount))
-
-            # Reference for all channels' volume.
-            for channelIndex in range(channelCount):
+            image = self.images.get(comboBox.itemData(index))
+            if image.roiNode:
+                self._parameterNode.SetNodeReferenceID("ROINode" + indexStr, image.roiNode.GetID())
+            if image.annotationNode:
+                self._parameterNode.SetNodeReferenceID("AnnotationNode" + indexStr, image.annotationNode.GetID())
+            for channelIndex in range(image.channelCount):
                 volumeParameterName = "Volume" + indexStr + "_" + str(channelIndex)
-                volumeID = channelVolumeList[channelIndex].GetID()
-                self._parameterNode.SetNodeReferenceID(volumeParameterName, volumeID)
-
-            # The widgets of visibility and threshold sliders for all channels.
-            group = self.uiGroupDict[filepath]
-            checkBoxes = group.findChildren(qt.QCheckBox)
-            thresholdSliders = group.findChildren(slicer.qMRMLVolumeThresholdWidget)
-
-            for channelIndex in range(len(channelVolumeList)):
-                channelIndexStr = str(channelIndex)
-                checkBox = checkBoxes[channelIndex]
-                thresholdSlider = thresholdSliders[channelIndex]
-                channelLabelName = "ChannelLabel" + indexStr + "_" + channelIndexStr
-                channelLabel = checkBox.text
-                self._parameterNode.SetParameter(channelLabelName, channelLabel)
-                visibilityParameterName = "Visibility" + indexStr + "_" + channelIndexStr
-                visibility = "true" if checkBox.checked else "false"
-                self._parameterNode.SetParameter(visibilityParameterName, visibility)
+                self._parameterNode.SetNodeReferenceID(volumeParameterName, image.volumeIDs[channelIndex])
 
-                lowerThresholdParameterName = "LowerThreshold" + indexStr + "_" + channelIndexStr
-                self._parameterNode.SetParameter(lowerThresholdParameterName, str(thresholdSlider.lowerThreshold))
+        self.writeState()
+        self._parameterNode.EndModify(wasModified)
+        self._updatingParameterNodeFromGUI = False
 
-                upperThresholdParameterName = "UpperThreshold" + indexStr + "_" + channelIndexStr
-                self._parameterNode.SetParameter(upperThresholdParameterName, str(thresholdSlider.upperThreshold))
+    def setParameter(self, name, value):
+        """
+        Set a parameter of the parameter node, unless it already has this value.
+        """
+        if self._parameterNode.GetParameter(name) != value:
+            self._parameterNode.SetParameter(name, value)
 
-                lowerThresholdBoundParameterName = "LowerThresholdBound" + indexStr + "_" + channelIndexStr
-                self._parameterNode.SetParameter(lowerThresholdBoundParameterName, str(thresholdSlider.lowerThresholdBound))
+    def writeState(self):
+        """
+        Write the state of all images to the "State" parameter, as one JSON string (see ImageRegistry.dumpState).
+        The parameters of the state saved by previous versions of the module are removed.
+        """
+        comboBox = self.ui.InputVolumeComboBox
+        images = list()
+        for index in range(comboBox.count):
+            image = self.images.get(comboBox.itemData(index))
+            annotationText = image.annotationNode.GetText() if image.annotationNode else ""
+            images.append((comboBox.itemText(index), annotationText or "", image))
+        self.setParameter("State", ImageRegistry.dumpState(comboBox.currentText, images))
+        if self._parameterNode.GetParameter("Count"):
+            for name in self._parameterNode.GetParameterNames():
+                if ImageRegistry.LEGACY_PARAMETER_PATTERN.match(name):
+                    self._parameterNode.UnsetParameter(name)
+
+    def markChannelModified(self, volume):
+        """
+        Schedule writing the state to the parameter node after a channel of a volume changed.
+        The channels modified until the sync timer fires are written together.
+        """
+        if self.images.channel(volume.GetID())[0] is None:
+            return
+        self.stateModified = True
+        if not self.parameterSyncTimer.active:
+            self.parameterSyncTimer.start()
 
-                upperThresholdBoundParameterName = "UpperThresholdBound" + indexStr + "_" + channelIndexStr
-                self._parameterNode.SetParameter(upperThresholdBoundParameterName, str(thresholdSlider.upperThresholdBound))
+    def syncModifiedChannels(self):
+        """
+        Write the state to the parameter node if channels were modified since it was last written.
+        Only the "State" parameter is written, the node references don't change with the channel state.
+        """
+        stateModified = self.stateModified
+        self.stateModified = False
+        self.parameterSyncTimer.stop()
+        if not stateModified:
+            return
+        if self._parameterNode is None or self._updatingGUIFromParameterNode or self._updatingParameterNodeFromGUI or self._importingScene:
+            return
 
-        self._parameterNode.EndModify(wasModified)
+        self._updatingParameterNodeFromGUI = True
+        self.writeState()
         self._updatingParameterNodeFromGUI = False
 
     # The slot for threshold checkBox and sliders.
@@ -735,17 +923,59 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # Stages of the colocalization computation, as shown in the progress bar.
+    COMPUTE_STAGES = ["Cropping to the ROI", "Thresholding and computing metrics", "Drawing plots", "Exporting the spreadsheet"]
+    # Stages of the per-segment colocalization computation.
+    SEGMENT_STAGES = ["Thresholding and computing metrics", "Exporting the spreadsheet"]
+
     def __init__(self):
         """
         Called when the threshold slider for each channel triggered.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        # When enabled, channels are created as empty placeholders and decoded when they are displayed or selected.
+        self.lazyLoading = False
+        # Channel buffers wrapped by the image data of the channel volumes, by volume node ID.
+        self.channelBuffers = {}
+        # Joint histograms of channel pairs within an ROI, for the live statistics.
+        self.jointHistograms = {}
+        # Summed-volume tables of the selected channels for the live ROI statistics, as a (key, IntegralVolume) pair.
+        self.integralVolume = None
+        # Subsampled levels of the channels for the preview, as (image data modification time, ChannelPyramid) by volume node ID.
+        self.pyramids = {}
+        # Maximum number of bins per channel of the 2D histograms.
+        self.histogramBins = JointHistogram.DEFAULT_SCATTER_BINS
+        # When enabled, the 2D histograms are also saved as interactive HTML pages (requires holoviews).
+        self.histogramHtmlExport = False
+        # On-disk cache of the computed statistics and figures, so that computing unchanged inputs again is immediate.
+        resultCacheSize = int(slicer.util.settingsValue("ColocZStats/ResultCacheSize", ResultCache.DEFAULT_MAX_BYTES // (1024 * 1024), converter=int))
+        self.resultCache = ResultCache.ResultCache(os.path.join(slicer.app.cachePath, "ColocZStats", "Results"), resultCacheSize * 1024 * 1024)
+        # Bit-packed thresholded masks of single cropped channels, so that only the channels whose threshold changed are thresholded again.
+        channelCacheSize = int(slicer.util.settingsValue("ColocZStats/ChannelCacheSize", ChannelCache.DEFAULT_MEMORY_BUDGET // (1024 * 1024), converter=int))
+        self.channelCache = ChannelCache.ChannelCache(channelCacheSize * 1024 * 1024)
+        # Wall time, CPU time and peak memory of the stages, logged and added to the spreadsheets when enabled.
+        profiling = Instrumentation.enabledByEnvironment() or slicer.util.settingsValue("ColocZStats/Profiling", False, converter=slicer.util.toBool)
+        self.profiler = Instrumentation.Profiler(profiling)
+        # Mark of the profiler when the current computation started.
+        self.profilerRunStart = 0
+        # When enabled, the visible channels of each image are rendered as one RGBA volume instead of one volume rendering per channel.
+        self.compositeRendering = False
+        # Composite of the channels of each image and its vector volume node, as (CompositeVolume, volume node ID) by file path.
+        self.composites = {}
 
     def updateThresholdOnVolume(self, volNode, lower, upper, widget, thresholdSlider):
+        image, channelIndex = widget.images.channel(volNode.GetID())
+        if image is not None:
+            image.setThreshold(channelIndex, lower, upper, thresholdSlider.lowerThresholdBound, thresholdSlider.upperThresholdBound)
+            widget.scheduleCompositeUpdate()
         displayNode = volNode.GetDisplayNode()
+        if not displayNode:
+            return
         displayNode.SetThreshold(lower, upper)
         displayNode.SetApplyThreshold(True)
-        widget.updateParameterNodeFromGUI()
+        if widget.ui.LiveStatsCheckBox.checked:
+            self.updateLiveStats(widget)
+        widget.markChannelModified(volNode)
 
     def createVolumesForChannels(self, node, widget):
         """
@@ -762,7 +992,7 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
             return
 
         # Determine whether the file format is tiff.
-        if (not filename) or widget.volumeDict.get(filename):
+        if (not filename) or filename in widget.images:
             return
         if not (filename.endswith(".tif") or filename.endswith(".tiff")):
             if filename.endswith(".nrrd"):
@@ -801,23 +1031,20 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
         import numpy as np
         print("Loaded image: " + filename)
 
-        try:
-            import tifffile
-        except ModuleNotFoundError:
-            slicer.util.pip_install("tifffile")
-            import tifffile
+        import tifffile
 
         tif = tifffile.TiffFile(filename)
         nodeName = node.GetName()
         layout = qt.QVBoxLayout()
         channelVolumeList = list()
+        channelLabels = list()
+        channelWidgets = list()
 
         # Find channel dimension to determine how many channels are in the input image.
         channelDim = -1
         ZDim = -1
         axes = tif.series[0].axes
         tif_axes = str(axes)
-        image = tif.asarray()
         for index in range(0, len(axes)):
             if axes[index] == 'Z':
                 ZDim = index
@@ -839,8 +1066,8 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
 
         elif ZDim != -1:
             if channelDim != -1:
-                image = np.moveaxis(image, channelDim, 0)
-                channelNum = image.shape[0]
+                shape = tif.series[0].shape
+                channelNum = shape[channelDim]
                 if channelNum > 15:
                     text = "Does not support image with channels more than 15."
                     msg = qt.QMessageBox()
@@ -851,14 +1078,38 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
                     slicer.mrmlScene.RemoveNode(node)
                     return
 
-                dimNum = len(image.shape)
+                dimNum = len(shape)
                 if dimNum == 4:
+                    # Decode the channels one at a time into their own contiguous buffer, so that the whole
+                    # image never has to be held in memory next to the channel volumes.
+                    # In lazy loading mode only the metadata is read here, channels are decoded in loadChannel.
+                    reader = None
+                    image = None
+                    if not self.lazyLoading:
+                        try:
+                            reader = TiffStreaming.TiffChannelReader(filename)
+                        except ValueError:
+                            image = np.moveaxis(tif.asarray(), channelDim, 0)
                     for component in range(channelNum):
-                        componentImage = image[component, :, :, :]
                         name = nodeName + "_" + "Channel " + str(component + 1)
                         channelLabelName = name.split("_")[-1]
-                        channelVolume = self.createVolumeForChannel(componentImage, colorIds[component], layout, name, widget,channelLabelName)
+                        if self.lazyLoading:
+                            channelVolume, checkBox, thresholdSlider = self.createPlaceholderVolumeForChannel(filename, component, colorIds[component], layout, name, widget, channelLabelName)
+                        else:
+                            with self.profiler.span("Decoding " + name):
+                                if reader:
+                                    componentImage = reader.readChannel(component)
+                                else:
+                                    componentImage = np.ascontiguousarray(image[component, :, :, :])
+                            with self.profiler.span("Creating the volume of " + name):
+                                channelVolume, checkBox, thresholdSlider = self.createVolumeForChannel(componentImage, colorIds[component], layout, name, widget,channelLabelName)
+                            del componentImage
                         channelVolumeList.append(channelVolume)
+                        channelLabels.append(channelLabelName)
+                        channelWidgets.append((checkBox, thresholdSlider))
+                    if reader:
+                        reader.close()
+                    image = None
                 else:
                     text = "The number of axes read by TiffFile library is incompatible. Expected 4. Got " + str(dimNum)
                     msg = qt.QMessageBox()
@@ -881,10 +1132,15 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
 
 
 
-        widget.volumeDict[filename] = channelVolumeList
-        widget.InputCheckedDict[filename] = True
+        image = ImageRegistry.ImageState(filename, channelVolumeList, channelLabels)
+        for channelIndex, (checkBox, thresholdSlider) in enumerate(channelWidgets):
+            image.checkBoxes[channelIndex] = checkBox
+            image.thresholdSliders[channelIndex] = thresholdSlider
+            image.visible[channelIndex] = checkBox.checked
+            image.setThreshold(channelIndex, thresholdSlider.lowerThreshold, thresholdSlider.upperThreshold,
+                               thresholdSlider.lowerThresholdBound, thresholdSlider.upperThresholdBound)
         groupBox = qt.QGroupBox("")
-        widget.uiGroupDict[filename] = groupBox
+        image.groupBox = groupBox
         layout.addStretch()
         groupBox.setLayout(layout)
         widget.channelsLayout.addWidget(groupBox)
@@ -892,7 +1148,9 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
 
         # Update text node for the annotation.
         annotationTextNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTextNode")
-        widget.annotationDict[filename] = annotationTextNode
+        image.annotationNode = annotationTextNode
+        widget.images.add(image)
+        widget.scheduleCompositeUpdate()
 
         # Update the comboBox.
         comboBox = widget.ui.InputVolumeComboBox
@@ -906,6 +1164,7 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
         if currentFile == filename:
             widget.ui.AnnotationText.setMRMLTextNode(annotationTextNode)
 
+        tif.close()
         if not node in channelVolumeList:
             slicer.mrmlScene.RemoveNode(node)
 
@@ -913,29 +1172,250 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
 
     def createVolumeForChannel(self, componentImage, colorId, layout, name, widget, channelLabelName):
         """
-        Create a volume for each channel to control.
+        Create a volume for each channel to control. Returns the volume, and the checkbox and threshold slider of the channel.
+        """
+        scalarVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        scalarVolumeNode.SetName(name)
+        self.updateVolumeFromChannelBuffer(scalarVolumeNode, componentImage)
+        checkBox, thresholdSlider = self.initializeVolume(scalarVolumeNode, colorId, layout, widget,channelLabelName)
+        return scalarVolumeNode, checkBox, thresholdSlider
+
+    def updateVolumeFromChannelBuffer(self, volumeNode, channelBuffer):
+        """
+        Make the image data of a volume wrap a kji-ordered channel buffer without copying it.
+        The buffer is kept referenced in channelBuffers for as long as the volume uses it.
+        """
+        from vtk.util import numpy_support
+        channelBuffer = np.ascontiguousarray(channelBuffer)
+        vtkArray = numpy_support.numpy_to_vtk(channelBuffer.reshape(-1), deep=False, array_type=numpy_support.get_vtk_array_type(channelBuffer.dtype))
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(channelBuffer.shape[2], channelBuffer.shape[1], channelBuffer.shape[0])
+        imageData.GetPointData().SetScalars(vtkArray)
+        volumeNode.SetAndObserveImageData(imageData)
+        self.channelBuffers[volumeNode.GetID()] = channelBuffer
+
+    def releaseChannelBuffer(self, volumeNode):
+        """
+        Drop the reference to the channel buffer of a volume that is removed from the scene.
+        """
+        self.channelBuffers.pop(volumeNode.GetID(), None)
+
+    def createPlaceholderVolumeForChannel(self, filename, component, colorId, layout, name, widget, channelLabelName):
+        """
+        Create an empty volume for a channel whose data is only decoded by loadChannel,
+        when the channel is displayed or selected for computation.
+        Returns the volume, and the checkbox and threshold slider of the channel.
         """
         scalarVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
         scalarVolumeNode.SetName(name)
-        slicer.util.updateVolumeFromArray(scalarVolumeNode, componentImage)
-        self.initializeVolume(scalarVolumeNode, colorId, layout, widget,channelLabelName)
-        return scalarVolumeNode
+        scalarVolumeNode.SetAttribute("ColocZStats.SourceFile", filename)
+        scalarVolumeNode.SetAttribute("ColocZStats.ChannelIndex", str(component))
+        scalarVolumeNode.SetAttribute("ColocZStats.ColorID", colorId)
+        checkBox, thresholdSlider = self.createChannelWidgets(scalarVolumeNode, layout, widget, channelLabelName, False)
+        return scalarVolumeNode, checkBox, thresholdSlider
+
+    def isChannelLoaded(self, volumeNode):
+        """
+        Whether the data of a channel volume has been decoded (always true unless it was created in lazy loading mode).
+        """
+        return volumeNode.GetAttribute("ColocZStats.SourceFile") is None
+
+    def loadChannel(self, volumeNode, widget):
+        """
+        Decode the pages of a placeholder channel from its TIFF file and set up its display.
+        """
+        if self.isChannelLoaded(volumeNode):
+            return
+        filename = volumeNode.GetAttribute("ColocZStats.SourceFile")
+        channelIndex = int(volumeNode.GetAttribute("ColocZStats.ChannelIndex"))
+        colorId = volumeNode.GetAttribute("ColocZStats.ColorID")
+
+        with TiffStreaming.TiffChannelReader(filename) as reader:
+            componentImage = reader.readChannel(channelIndex)
+        self.updateVolumeFromChannelBuffer(volumeNode, componentImage)
+        del componentImage
+        volumeNode.RemoveAttribute("ColocZStats.SourceFile")
+        volumeNode.RemoveAttribute("ColocZStats.ChannelIndex")
+        volumeNode.RemoveAttribute("ColocZStats.ColorID")
+        displayNode = self.initializeVolumeDisplay(volumeNode, colorId)
+
+        image, channelIndex = widget.images.channel(volumeNode.GetID())
+        if image is None:
+            return
+
+        # Apply the ROI of the image, if it was created before this channel got loaded.
+        if image.roiNode and displayNode:
+            displayNode.SetAndObserveROINodeID(image.roiNode.GetID())
+            displayNode.SetCroppingEnabled(image.roiVisible)
+
+        # The threshold slider was created without data, let it pick up the scalar range.
+        thresholdSlider = image.thresholdSliders[channelIndex]
+        if thresholdSlider is None:
+            return
+        thresholdSlider.setMRMLVolumeNode(None)
+        thresholdSlider.setMRMLVolumeNode(volumeNode)
+        image.setThreshold(channelIndex, thresholdSlider.lowerThreshold, thresholdSlider.upperThreshold,
+                           thresholdSlider.lowerThresholdBound, thresholdSlider.upperThresholdBound)
 
     def initializeVolume(self, scalarVolumeNode, colorId, layout, widget, channelLabelName):
+        self.initializeVolumeDisplay(scalarVolumeNode, colorId)
+        return self.createChannelWidgets(scalarVolumeNode, layout, widget, channelLabelName, True)
+
+    def initializeVolumeDisplay(self, scalarVolumeNode, colorId):
+        """
+        Create the display and volume rendering nodes of a channel volume.
+        In the composite rendering mode the channel has no volume rendering of its own, and None is returned.
+        """
         scalarVolumeNode.CreateDefaultDisplayNodes()
         scalarVolumeNode.GetScalarVolumeDisplayNode().SetAndObserveColorNodeID(colorId)
+        if self.compositeRendering:
+            return None
+        return self.createChannelRendering(scalarVolumeNode)
+
+    def createChannelRendering(self, scalarVolumeNode):
+        """
+        Create the volume rendering nodes of a channel volume.
+        """
         volRenLogic = slicer.modules.volumerendering.logic()
         displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(scalarVolumeNode)
         displayNode.SetName(scalarVolumeNode.GetName() + "_Rendering")
         displayNode.SetFollowVolumeDisplayNode(True)
         displayNode.SetVisibility(True)
+        return displayNode
+
+    def setCompositeRendering(self, widget, enabled):
+        """
+        Switch between one volume rendering per channel and one composite rendering per image.
+        The renderings of the mode that is left are removed from the scene, to free their memory.
+        """
+        self.compositeRendering = enabled
+        volRenLogic = slicer.modules.volumerendering.logic()
+        for image in widget.images:
+            for channelIndex, volume in enumerate(image.volumes):
+                if not volume or not self.isChannelLoaded(volume):
+                    continue
+                displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(volume)
+                if enabled and displayNode:
+                    self.removeRendering(displayNode)
+                elif not enabled and not displayNode:
+                    displayNode = self.createChannelRendering(volume)
+                    displayNode.SetVisibility(image.inputVisible and bool(image.visible[channelIndex]))
+                    if image.roiNode:
+                        displayNode.SetAndObserveROINodeID(image.roiNode.GetID())
+                        displayNode.SetCroppingEnabled(image.roiVisible)
+            if not enabled:
+                self.removeCompositeRendering(image.filename)
+        if enabled:
+            self.updateCompositeRendering(widget)
+
+    def removeRendering(self, displayNode):
+        """
+        Remove a volume rendering display node and its volume property from the scene.
+        """
+        volumePropertyNode = displayNode.GetVolumePropertyNode()
+        slicer.mrmlScene.RemoveNode(displayNode)
+        if volumePropertyNode:
+            slicer.mrmlScene.RemoveNode(volumePropertyNode)
 
-        # Create widgets for channel volume node
+    def removeCompositeRendering(self, filename):
+        """
+        Remove the composite rendering of an image, if it has one.
+        """
+        composite = self.composites.pop(filename, None)
+        if composite is None:
+            return
+        volumeNode = slicer.mrmlScene.GetNodeByID(composite[1])
+        if volumeNode:
+            volRenLogic = slicer.modules.volumerendering.logic()
+            displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(volumeNode)
+            if displayNode:
+                self.removeRendering(displayNode)
+            slicer.mrmlScene.RemoveNode(volumeNode)
+
+    def createCompositeVolume(self, image, referenceVolume, name):
+        """
+        Create the RGBA vector volume of the composite rendering of an image, in the geometry of one of its channels.
+        The volume isn't saved with the scene: it is blended again from the channels when the scene is loaded.
+        """
+        from vtk.util import numpy_support
+        shape = slicer.util.arrayFromVolume(referenceVolume).shape
+        composite = CompositeRendering.CompositeVolume(shape, image.channelCount)
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode")
+        volumeNode.SetName(name)
+        volumeNode.SetSaveWithScene(False)
+        volumeNode.CopyOrientation(referenceVolume)
+        vtkArray = numpy_support.numpy_to_vtk(composite.rgba.reshape(-1, 4), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(shape[2], shape[1], shape[0])
+        imageData.GetPointData().SetScalars(vtkArray)
+        volumeNode.SetAndObserveImageData(imageData)
+        volumeNode.CreateDefaultDisplayNodes()
+
+        # The components are rendered as colors and opacity, instead of as 4 independent scalars.
+        volRenLogic = slicer.modules.volumerendering.logic()
+        displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(volumeNode)
+        displayNode.SetName(name + "_Rendering")
+        displayNode.SetSaveWithScene(False)
+        volumePropertyNode = displayNode.GetVolumePropertyNode()
+        volumePropertyNode.SetSaveWithScene(False)
+        volumePropertyNode.GetVolumeProperty().SetIndependentComponents(False)
+        opacity = vtk.vtkPiecewiseFunction()
+        opacity.AddPoint(0, 0.0)
+        opacity.AddPoint(255, 1.0)
+        volumePropertyNode.SetScalarOpacity(opacity)
+        self.composites[image.filename] = (composite, volumeNode.GetID())
+        return composite, volumeNode
+
+    def updateCompositeRendering(self, widget):
+        """
+        Blend the channels changed since the last update into the composite rendering of each image,
+        creating the composite renderings of the images that have none yet.
+        """
+        if not self.compositeRendering:
+            return
+        comboBox = widget.ui.InputVolumeComboBox
+        volRenLogic = slicer.modules.volumerendering.logic()
+        for image in widget.images:
+            loadedVolumes = [volume for volume in image.volumes if volume and self.isChannelLoaded(volume)]
+            if not loadedVolumes:
+                continue
+            composite = self.composites.get(image.filename)
+            volumeNode = slicer.mrmlScene.GetNodeByID(composite[1]) if composite else None
+            if volumeNode is None:
+                name = comboBox.itemText(comboBox.findData(image.filename)) + "_Composite"
+                composite, volumeNode = self.createCompositeVolume(image, loadedVolumes[0], name)
+            else:
+                composite = composite[0]
+
+            channels = list()
+            for channelIndex, volume in enumerate(image.volumes):
+                array = None
+                key = None
+                if volume and self.isChannelLoaded(volume):
+                    array = slicer.util.arrayFromVolume(volume)
+                    key = (volume.GetID(), volume.GetImageData().GetMTime())
+                lowerThreshold, upperThreshold = image.thresholds[channelIndex]
+                channels.append((key, array, bool(image.visible[channelIndex]), lowerThreshold, upperThreshold,
+                                 CompositeRendering.colorFromHex(image.colors[channelIndex])))
+            with self.profiler.span("Blending the composite rendering of " + volumeNode.GetName()):
+                if composite.update(channels):
+                    slicer.util.arrayFromVolumeModified(volumeNode)
+
+            displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(volumeNode)
+            displayNode.SetVisibility(image.inputVisible)
+            if image.roiNode:
+                displayNode.SetAndObserveROINodeID(image.roiNode.GetID())
+                displayNode.SetCroppingEnabled(image.roiVisible)
+
+    def createChannelWidgets(self, scalarVolumeNode, layout, widget, channelLabelName, checked):
+        """
+        Create the checkbox, rename button and threshold slider of a channel, and return the checkbox and the slider.
+        """
         name = scalarVolumeNode.GetName()
         subHorizontallayout = qt.QHBoxLayout()
         checkBox = qt.QCheckBox(channelLabelName)
         checkBox.objectName = name + "_checkbox"
-        checkBox.setChecked(True)
+        checkBox.setChecked(checked)
         checkBox.connect('clicked(bool)', lambda checked: self.setVolumeVisibility(scalarVolumeNode, checked, widget))
         subHorizontallayout.addWidget(checkBox)
         renameChannelbutton = qt.QPushButton("Rename Channel")
@@ -950,6 +1430,7 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
         threshold.connect('thresholdValuesChanged(double, double)', lambda lower, upper: self.updateThresholdOnVolume(scalarVolumeNode, lower, upper, widget,threshold))
         layout.addItem(subHorizontallayout)
         layout.addWidget(threshold)
+        return checkBox, threshold
 
     def onRenameChannelButtonClicked(self, volumeNode,subHorizontallayout, checkBox, widget):
         """
@@ -965,34 +1446,44 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
             newChannelVolumeName = imageName + "_" + newChannelLabelName
             volumeNode.SetName(newChannelVolumeName)
             checkBox.setText(newChannelLabelName)
+            image, channelIndex = widget.images.channel(volumeNode.GetID())
+            if image is not None:
+                image.labels[channelIndex] = newChannelLabelName
 
-        widget.updateParameterNodeFromGUI()
+        widget.markChannelModified(volumeNode)
 
 
     def setVolumeVisibility(self, volumeNode, checked, widget):
         """
         Called when the checkbox of each threshold slider is clicked.
         """
+        image, channelIndex = widget.images.channel(volumeNode.GetID())
+        if image is not None:
+            image.visible[channelIndex] = checked
+            widget.scheduleCompositeUpdate()
+        if checked:
+            self.loadChannel(volumeNode, widget)
         volRenLogic = slicer.modules.volumerendering.logic()
         displayNode = volRenLogic.GetFirstVolumeRenderingDisplayNode(volumeNode)
-        displayNode.SetVisibility(checked and widget.ui.InputCheckBox.checked)
-        widget.updateParameterNodeFromGUI()
+        if displayNode:
+            displayNode.SetVisibility(checked and widget.ui.InputCheckBox.checked)
+        if widget.ui.LiveStatsCheckBox.checked:
+            self.updateLiveStats(widget)
+        widget.markChannelModified(volumeNode)
 
     def computeStats(self, widget):
         """
         To compute the volume's colocalization within the current ROI.
         """
         comboBox = widget.ui.InputVolumeComboBox
-        filename = comboBox.itemData(comboBox.currentIndex)
-        channelVolumeList = widget.volumeDict.get(filename)
-        if not channelVolumeList:
+        image = widget.currentImage()
+        if not image:
             return
 
-        annotation_text = widget.annotationDict[filename].GetText()
+        filename = image.filename
+        annotation_text = image.annotationNode.GetText()
 
-        roiNode = None
-        if filename in widget.ROINodeDict:
-            roiNode = widget.ROINodeDict[filename]
+        roiNode = image.roiNode
         if roiNode:
             # Get the information of ROI
             roi_center_coords, roiSize, orientationMatrix = self.infoForROI(roiNode)
@@ -1015,7 +1506,7 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
             msg.exec_()
             return
         else:
-            selectedVolumes, thresholds, selectedColors,selectedChannelLabels = self.getSelectedVolumes(channelVolumeList, widget.uiGroupDict[filename])
+            selectedVolumes, thresholds, selectedColors,selectedChannelLabels = image.selection()
 
             # Get all checked channels.
             selectedVolumeCount = len(selectedVolumes)
@@ -1028,44 +1519,141 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
                 msg.exec_()
                 return
 
-            if selectedVolumeCount > 3:
-                text = "Up to 3 channels can be selected simultaneously for calculation."
-                msg = qt.QMessageBox()
-                msg.setIcon(qt.QMessageBox.Warning)
-                msg.setText(text)
-                msg.setStandardButtons(qt.QMessageBox.Ok)
-                msg.exec_()
-                return
+            # Channels selected in lazy loading mode are decoded before computing.
+            for volume in selectedVolumes:
+                self.loadChannel(volume, widget)
+
+            # Packages that are installed on demand can only be installed from the main thread.
+            self.installComputeDependencies()
+
+            # Compute each volume's stats on a worker thread, so that Slicer stays responsive.
+            task = BackgroundTask.BackgroundTask(self.COMPUTE_STAGES)
+            channelIndices = [int(index) for index in image.selectedChannels()]
+            self.computeStatsForVolumes(selectedVolumes, roiNode, thresholds, comboBox.currentText, widget, selectedColors,selectedChannelLabels,roi_center_coords, roiSize, orientationMatrix, annotation_text, task, filename, channelIndices)
+            if task.started:
+                widget.startComputeTask(task)
+
+    def installComputeDependencies(self):
+        """
+        Install the packages needed to draw the diagrams and to write the spreadsheet, if they are missing.
+        Packages found once in the session aren't checked again.
+        """
+        Dependencies.provision(Dependencies.COMPUTE_PACKAGES, slicer.util.pip_install)
+        if self.histogramHtmlExport:
+            Dependencies.provision(Dependencies.HTML_EXPORT_PACKAGES, slicer.util.pip_install)
 
-            # Compute each volume's stats
-            self.computeStatsForVolumes(selectedVolumes, roiNode, thresholds, comboBox.currentText, widget, selectedColors,selectedChannelLabels,roi_center_coords, roiSize, orientationMatrix, annotation_text)
+    def prepareDependencies(self):
+        """
+        Install the missing optional packages once and import the heavy ones on a background thread,
+        so that the first computation doesn't wait for them.
+        """
+        try:
+            self.installComputeDependencies()
+        except Exception as error:
+            logging.warning("Could not install the optional packages of ColocZStats: " + str(error))
+            return
+        moduleNames = list(Dependencies.COMPUTE_WARM_UP_MODULES)
+        if self.histogramHtmlExport:
+            moduleNames += Dependencies.HTML_EXPORT_WARM_UP_MODULES
+        Dependencies.warmUp(moduleNames)
 
 
-    def getSelectedVolumes(self, channelVolumeList, group):
+    def computeStatsForSegments(self, widget, segmentationNode):
         """
-        Determine which channels are selected, what their thresholds are, and what specific colors they correspond to.
+        To compute the colocalization of the selected channels within every segment of a segmentation.
         """
-        colors = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#00ffff', '#ff00ff', '#eb711a', '#baeb1a', '#1aeb86',
-                  '#1ab7eb', '#7f1aeb', '#d620a0', '#851d1d', '#9ba33e', '#3e9641']
-        selectedVolumes = list()
-        selectedColors = list()
-        thresholds = list()
-        selectedChannelLabels = list()
+        comboBox = widget.ui.InputVolumeComboBox
+        image = widget.currentImage()
+        if not image:
+            return
 
-        checkBoxes = group.findChildren(qt.QCheckBox)
-        thresholdSliders = group.findChildren(slicer.qMRMLVolumeThresholdWidget)
+        if segmentationNode is None:
+            self.showWarning("Please select a segmentation whose segments are the regions.")
+            return
+
+        selectedVolumes, thresholds, selectedColors, selectedChannelLabels = image.selection()
+        if len(selectedVolumes) < 2:
+            self.showWarning("Multi-channel required.")
+            return
+
+        # Channels selected in lazy loading mode are decoded before computing.
+        for volume in selectedVolumes:
+            self.loadChannel(volume, widget)
+
+        labelArray, segmentNames = self.labelArrayForSegmentation(segmentationNode, selectedVolumes[0])
+        if not segmentNames:
+            self.showWarning("The selected segmentation has no segments.")
+            return
+
+        self.installComputeDependencies()
+
+        arrayData_list = [slicer.util.arrayFromVolume(volume) for volume in selectedVolumes]
+        task = BackgroundTask.BackgroundTask(self.SEGMENT_STAGES)
+        task.start(self.computeSegmentStatsForArrays, arrayData_list, labelArray, thresholds, segmentNames, comboBox.currentText, selectedChannelLabels, image.annotationNode.GetText(), slicer.app.defaultScenePath, task)
+        widget.startComputeTask(task)
 
-        for index in range(len(channelVolumeList)):
-            checkBox = checkBoxes[index]
-            thresholdSlider = thresholdSliders[index]
-            if checkBox.checked:
-                selectedChannelLabels.append(checkBox.text)
-                selectedVolumes.append(channelVolumeList[index])
-                thresholds.append(thresholdSlider.lowerThreshold)
-                thresholds.append(thresholdSlider.upperThreshold)
-                selectedColors.append(colors[index])
-        return selectedVolumes, thresholds, selectedColors,selectedChannelLabels
+    def labelArrayForSegmentation(self, segmentationNode, referenceVolume):
+        """
+        Get the segments of a segmentation as a label array in the geometry of a channel volume.
+        Segment number n (in the order of the segmentation) has the label n + 1; where segments overlap, the last one wins.
+        Returns the label array and the segment names.
+        """
+        segmentIds = vtk.vtkStringArray()
+        segmentationNode.GetSegmentation().GetSegmentIDs(segmentIds)
+        segmentNames = [segmentationNode.GetSegmentation().GetSegment(segmentIds.GetValue(index)).GetName() for index in range(segmentIds.GetNumberOfValues())]
+        if not segmentNames:
+            return None, segmentNames
+
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        try:
+            slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentIds, labelmapVolumeNode, referenceVolume)
+            labelArray = slicer.util.arrayFromVolume(labelmapVolumeNode).copy()
+        finally:
+            slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        return labelArray, segmentNames
 
+    def computeSegmentStatsForArrays(self, arrayData_list, labelArray, thresholds, segmentNames, imageName, ChannelLabels, annotation_text, outputDirectory, task=None):
+        """
+        To compute the colocalization of the channel arrays within every labelled region in one pass,
+        and save one row per segment in a single spreadsheet in outputDirectory. Doesn't access the scene or the application,
+        so it can run in a BackgroundTask.
+        """
+        channelCount = len(arrayData_list)
+        thresholdPairs = [(float(thresholds[index * 2]), float(thresholds[index * 2 + 1])) for index in range(channelCount)]
+        ChannelLabels_in_csv = list()
+        for selectedChannelLabel in ChannelLabels:
+            if imageName in selectedChannelLabel:
+                ChannelLabels_in_csv.append(selectedChannelLabel)
+            else:
+                ChannelLabels_in_csv.append(imageName + "_" + selectedChannelLabel)
+
+        self.reportStage(task, "Thresholding and computing metrics")
+        results = ColocEngine.computeColocalizationByLabel(arrayData_list, labelArray, thresholdPairs, progressCallback=self.stageProgressCallback(task, "Thresholding and computing metrics"))
+
+        self.reportStage(task, "Exporting the spreadsheet")
+        channelPairs = list(itertools.combinations(range(channelCount), 2))
+        segment_rows = list()
+        for index, segmentName in enumerate(segmentNames):
+            result = results.get(index + 1)
+            row = {'Segment': segmentName, 'Segment Volume': result.voxelCount if result else 0}
+            for channel in range(channelCount):
+                row[ChannelLabels_in_csv[channel] + ' Volume'] = result.channelVolumes[channel] if result else 0
+            row['Intersection Volume'] = result.intersectionVolume(range(channelCount)) if result else 0
+            intersection_coefficient, channel_coefficients = result.intersectionCoefficients() if result else ('0.0000', ['0.0000'] * channelCount)
+            row['Global Intersection Coefficient (I)'] = intersection_coefficient
+            for channel in range(channelCount):
+                row['i' + str(channel + 1)] = channel_coefficients[channel]
+            for channel1, channel2 in channelPairs:
+                row['PCC ' + ChannelLabels_in_csv[channel1] + ' and ' + ChannelLabels_in_csv[channel2]] = result.pearsonCoefficient(channel1, channel2) if result else '0.0000'
+            segment_rows.append(row)
+
+        excel_out_path = outputDirectory + "/" + imageName + " Segment Statistics.xlsx"
+        sheets = [('Segments', segment_rows, True), SpreadsheetExport.thresholdRangeSheet(ChannelLabels_in_csv, thresholdPairs)]
+        SpreadsheetExport.writeSpreadsheet(excel_out_path, sheets + SpreadsheetExport.annotationSheets(annotation_text))
+
+        self.printMessage("The colocalization of " + str(len(segmentNames)) + " segments is saved in: " + excel_out_path, task)
+        self.printMessage("------------------------------", task)
+        return results
 
     def infoForROI(self, roiNode):
         """
@@ -1085,116 +1673,300 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
         return roi_center_coords, roiSize, orientationMatrix
 
 
-    def computeStatsForVolumes(self, volumes, roiNode, thresholds, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text):
+    def cropExtentForROI(self, roiNode, volume):
         """
-        To compute the volume's colocalization within the current ROI.
+        Get the voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax] of the ROI in a volume.
         """
-        try:
-            import decimal
-        except ModuleNotFoundError:
-            slicer.util.pip_install("decimal")
-            import decimal
-        from decimal import Decimal
-
-
-        # Save the ROI node into into a markups json file.
-        roiNode.AddDefaultStorageNode()
-        jsonFileName = slicer.app.defaultScenePath + "/" + imageName + " ROI Information.mrk.json"
-        slicer.util.saveNode(roiNode, jsonFileName)
-
-        # Get cropped and thresholded volume data in numpy array
         cropVolLogic = slicer.modules.cropvolume.logic()
         cropExtent = [0] * 6
-        cropVolLogic.GetVoxelBasedCropOutputExtent(roiNode, volumes[0], cropExtent)
+        cropVolLogic.GetVoxelBasedCropOutputExtent(roiNode, volume, cropExtent)
         for cropExtentIndex in range(len(cropExtent)):
             if cropExtent[cropExtentIndex] < 0:
                 cropExtent[cropExtentIndex] = 0
-        workVolumes = list()
-        singleChannelVolumes = list()
-        lowerThresholdList = list()
-        upperThresholdList = list()
-        arrayData_list = list()
-        thresholded_arrayData_bar_list = list()
-        thresholded_workVolumes_for_pearson = list()
-        channel_for_scatter_list = list()
-
-        volumeMM3 = 0
-        for index in range(len(volumes)):
-            volume = volumes[index]
-            arrayData = slicer.util.arrayFromVolume(volume)  # Get numpy array data from volume
-            volumeMM3 = (arrayData >= 0).sum()
-
-            # Crop volume data. Note that numpy array index order is kji, not ijk.
-            if roiNode:
-                arrayData = arrayData[cropExtent[4]: cropExtent[5], cropExtent[2]: cropExtent[3],
-                            cropExtent[0]: cropExtent[1]]
-                arrayData = arrayData.astype(float)
-            volumeMM3 = (arrayData >= 0).sum()
-            arrayData_list.append(arrayData)
-
-            # Threshold volume data
-            lowerThreshold = float(thresholds[index * 2])
-            upperThreshold = float(thresholds[index * 2 + 1])
-            lowerThresholdList.append(lowerThreshold)
-            upperThresholdList.append(upperThreshold)
+        return cropExtent
 
-            # newarrayData is to compute the intersection coefficient and i1-i3
-            newarrayData = np.logical_and(arrayData>lowerThreshold, arrayData<=upperThreshold)
-            newarrayData_integer = newarrayData.astype(int)
+    def jointHistogramForVolumes(self, volume1, volume2, cropExtent):
+        """
+        Get the joint histogram of two channel volumes within a crop extent, building it on first use.
+        """
+        key = (volume1.GetID(), volume1.GetImageData().GetMTime(), volume2.GetID(), volume2.GetImageData().GetMTime(), tuple(cropExtent))
+        histogram = self.jointHistograms.get(key)
+        if histogram is None:
+            # Keep only a few histograms (e.g. the pairs of the current selection).
+            while len(self.jointHistograms) >= 8:
+                self.jointHistograms.pop(next(iter(self.jointHistograms)))
+            histogram = JointHistogram.JointHistogram(ColocEngine.cropArray(slicer.util.arrayFromVolume(volume1), cropExtent),
+                                                      ColocEngine.cropArray(slicer.util.arrayFromVolume(volume2), cropExtent))
+            self.jointHistograms[key] = histogram
+        return histogram
+
+    def updateLiveStats(self, widget):
+        """
+        Show the colocalization of each selected channel pair within the ROI for the current slider thresholds.
+        The statistics are looked up from the joint histograms, so this is fast enough to follow the sliders.
+        """
+        label = widget.ui.LiveStatsLabel
+        image = widget.currentImage()
+        if not image:
+            label.text = ""
+            return
+        roiNode = image.roiNode
+        if not roiNode:
+            label.text = "Enable 'Display ROI' to see live statistics."
+            return
+        selectedVolumes, thresholds, selectedColors, selectedChannelLabels = image.selection()
+        if len(selectedVolumes) < 2:
+            label.text = "Select at least two channels to see live statistics."
+            return
 
-            # To calculate PCC, the first step is to set all values greater than the upper threshold to 0, and subtract the lower threshold from all other values.
-            arrayData_first_thresholded = np.where(arrayData > upperThreshold,0,arrayData-lowerThreshold)
+        cropExtent = self.cropExtentForROI(roiNode, selectedVolumes[0])
+        lines = list()
+        for index1, index2 in itertools.combinations(range(len(selectedVolumes)), 2):
+            histogram = self.jointHistogramForVolumes(selectedVolumes[index1], selectedVolumes[index2], cropExtent)
+            result = histogram.result((thresholds[index1 * 2], thresholds[index1 * 2 + 1]), (thresholds[index2 * 2], thresholds[index2 * 2 + 1]))
+            intersectionCoefficient, (i1, i2) = result.intersectionCoefficients()
+            line = selectedChannelLabels[index1] + " and " + selectedChannelLabels[index2] + ": PCC = " + result.pearsonCoefficient(0, 1) + ", I = " + intersectionCoefficient + ", i1 = " + i1 + ", i2 = " + i2
+            if not histogram.exact:
+                line += " (approximate)"
+            lines.append(line)
+        label.text = "\n".join(lines)
+
+    def integralVolumeForVolumes(self, volumes, thresholdPairs):
+        """
+        Get the summed-volume tables of some channel volumes for their thresholds, building them on first use.
+        Only the tables of the latest selection are kept, as they take several times the memory of the channels.
+        """
+        key = tuple((volume.GetID(), volume.GetImageData().GetMTime()) for volume in volumes) + tuple(thresholdPairs)
+        if self.integralVolume is None or self.integralVolume[0] != key:
+            self.integralVolume = None
+            integralVolume = IntegralVolume.IntegralVolume([slicer.util.arrayFromVolume(volume) for volume in volumes], thresholdPairs)
+            self.integralVolume = (key, integralVolume)
+        return self.integralVolume[1]
+
+    def loadedChannelSelection(self, selectedVolumes, thresholds, selectedColors, selectedChannelLabels):
+        """
+        Keep the selected channels that are loaded (see ImageState.selection), with their threshold pairs and labels.
+        """
+        kept = [index for index, volume in enumerate(selectedVolumes) if self.isChannelLoaded(volume)]
+        volumes = [selectedVolumes[index] for index in kept]
+        thresholdPairs = [(float(thresholds[index * 2]), float(thresholds[index * 2 + 1])) for index in kept]
+        labels = [selectedChannelLabels[index] for index in kept]
+        return volumes, thresholdPairs, labels
 
-            channel_for_scatter = newarrayData
-            channel_for_scatter_list.append(channel_for_scatter)
+    def updateLiveROIStats(self, widget):
+        """
+        Show the colocalization of the selected channels within the current ROI box.
+        The statistics are looked up from summed-volume tables, so this is fast enough to follow the ROI handles.
+        """
+        label = widget.ui.LiveStatsLabel
+        image = widget.currentImage()
+        if not image:
+            label.text = ""
+            return
+        roiNode = image.roiNode
+        if not roiNode:
+            label.text = "Enable 'Display ROI' to see live statistics."
+            return
+        selectedVolumes, thresholdPairs, selectedChannelLabels = self.loadedChannelSelection(*image.selection())
+        if len(selectedVolumes) < 2:
+            label.text = "Select at least two displayed channels to see live statistics."
+            return
 
-            # To calculate PCC, the second step is to set all negative values in the result obtained from the first step to 0.
-            arrayData_final_thresholded = np.where(arrayData_first_thresholded<0,0,arrayData_first_thresholded)
+        try:
+            integralVolume = self.integralVolumeForVolumes(selectedVolumes, thresholdPairs)
+        except MemoryError as error:
+            label.text = str(error)
+            return
+        result = integralVolume.result(self.cropExtentForROI(roiNode, selectedVolumes[0]))
 
-            # To calculate PCC, the third step is to get the average of the result of the second step.
-            thresholded_arrayData_bar = np.average(arrayData_final_thresholded)
-            thresholded_arrayData_bar_list.append(thresholded_arrayData_bar)
-            thresholded_workVolumes_for_pearson.append(arrayData_final_thresholded)
+        intersectionCoefficient, channelCoefficients = result.intersectionCoefficients()
+        lines = ["ROI: I = " + intersectionCoefficient + ", " + ", ".join("i" + str(index + 1) + " = " + channelCoefficient for index, channelCoefficient in enumerate(channelCoefficients))]
+        for index1, index2 in itertools.combinations(range(len(selectedVolumes)), 2):
+            lines.append(selectedChannelLabels[index1] + " and " + selectedChannelLabels[index2] + ": PCC = " + result.pearsonCoefficient(index1, index2))
+        label.text = "\n".join(lines)
 
-            newvolumeMM3 = np.sum(newarrayData_integer)
-            workVolumes.append(newarrayData_integer)
-            newvolumeMM3_decimal = Decimal(str(newvolumeMM3))
-            singleChannelVolumes.append(newvolumeMM3_decimal)
+    def pyramidForVolume(self, volume):
+        """
+        Get the subsampled levels of a channel volume, creating them if the volume is new or its data changed.
+        """
+        modifiedTime = volume.GetImageData().GetMTime()
+        if volume.GetID() not in self.pyramids or self.pyramids[volume.GetID()][0] != modifiedTime:
+            self.pyramids[volume.GetID()] = (modifiedTime, Pyramid.ChannelPyramid(slicer.util.arrayFromVolume(volume)))
+        return self.pyramids[volume.GetID()][1]
 
-        # No intersection if there is only one channel
-        if len(volumes) == 1:
+    def previewStats(self, widget):
+        """
+        Estimate the colocalization of the selected channels within the current ROI from a subsampled level,
+        and show the estimates with their 95% error bounds. Compute Colocalization gives the exact values.
+        """
+        label = widget.ui.LiveStatsLabel
+        image = widget.currentImage()
+        if not image:
+            label.text = ""
+            return
+        roiNode = image.roiNode
+        if not roiNode:
+            label.text = "Enable 'Display ROI' to see the preview."
+            return
+        selectedVolumes, thresholds, selectedColors, selectedChannelLabels = image.selection()
+        if len(selectedVolumes) < 2:
+            label.text = "Select at least two channels to see the preview."
+            return
+        for volume in selectedVolumes:
+            self.loadChannel(volume, widget)
+
+        thresholdPairs = [(float(thresholds[index * 2]), float(thresholds[index * 2 + 1])) for index in range(len(selectedVolumes))]
+        pyramids = [self.pyramidForVolume(volume) for volume in selectedVolumes]
+        estimate = Pyramid.estimateColocalization(pyramids, self.cropExtentForROI(roiNode, selectedVolumes[0]), thresholdPairs)
+        if estimate.result.unionVolume() == 0:
+            label.text = "Preview: there are no thresholded voxels within the ROI."
             return
 
-        try:
-            import matplotlib
-        except ModuleNotFoundError:
-            slicer.util.pip_install("matplotlib")
-            import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
+        def formatEstimate(value, bound):
+            return format(value, '.4f') + " \u00b1 " + format(bound, '.4f')
 
-        try:
-            import math
-        except ModuleNotFoundError:
-            slicer.util.pip_install("python-math")
-            import math
+        samplingText = "every voxel" if estimate.factor == 1 else "every " + str(estimate.factor) + "th voxel along each axis"
+        lines = ["Preview (" + samplingText + "): I = " + formatEstimate(*estimate.intersectionCoefficient()) + ", "
+                 + ", ".join("i" + str(index + 1) + " = " + formatEstimate(*estimate.channelCoefficient(index)) for index in range(len(selectedVolumes)))]
+        for index1, index2 in itertools.combinations(range(len(selectedVolumes)), 2):
+            lines.append(selectedChannelLabels[index1] + " and " + selectedChannelLabels[index2] + ": PCC = " + formatEstimate(*estimate.pearsonCoefficient(index1, index2)))
+        for index, channelLabel in enumerate(selectedChannelLabels):
+            volume, bound = estimate.channelVolume(index)
+            lines.append(channelLabel + " volume: " + str(int(round(volume))) + " \u00b1 " + str(int(math.ceil(bound))) + " voxels")
+        label.text = "\n".join(lines)
 
-        # Computes two channels' intersection if there are only two channels
-        if len(workVolumes) == 2:
+    def computeStatsForFile(self, filename, channelIndices, cropExtent, thresholds, memoryBudget=TiffStreaming.DEFAULT_MEMORY_BUDGET):
+        """
+        To compute the colocalization of some channels directly from a TIFF file within a voxel based crop extent.
+        The file is read in Z-slabs that fit in memoryBudget bytes, so stacks larger than the available memory can be analysed.
+        """
+        thresholdPairs = [(float(thresholds[index * 2]), float(thresholds[index * 2 + 1])) for index in range(len(channelIndices))]
+        return TiffStreaming.computeColocalizationFromTiff(filename, channelIndices, cropExtent, thresholdPairs, memoryBudget)
 
-            volumeMM3 = np.sum(workVolumes[0] * workVolumes[1])
-            volumeMM3_decimal = Decimal(str(volumeMM3))
+    def sweepThresholds(self, volumes, roiNode, thresholdRanges, upperThresholds, imageName, channelLabels):
+        """
+        To compute the colocalization of 2 or 3 channel volumes within the ROI for every combination of lower thresholds.
+        thresholdRanges holds one (start, stop, step) lower threshold range per volume, upperThresholds one upper threshold per volume.
+        The whole grid is evaluated from one pass over the data and saved as a single table with a heatmap.
+        """
+        if len(volumes) < 2 or len(volumes) > 3:
+            raise ValueError("The threshold sweep requires 2 or 3 channels.")
+        self.installComputeDependencies()
+        cropExtent = self.cropExtentForROI(roiNode, volumes[0])
+        channelArrays = [ColocEngine.cropArray(slicer.util.arrayFromVolume(volume), cropExtent) for volume in volumes]
+        lowerThresholdGrids = [ThresholdSweep.thresholdGrid(*thresholdRange) for thresholdRange in thresholdRanges]
+        sweep = ThresholdSweep.ThresholdSweep(channelArrays, lowerThresholdGrids, upperThresholds)
+
+        heatmapLocation = slicer.app.defaultScenePath + "/" + imageName + " Threshold Sweep.png"
+        ThresholdSweep.saveSweepHeatmap(sweep, channelLabels, heatmapLocation)
+
+        excel_out_path = slicer.app.defaultScenePath + "/" + imageName + " Threshold Sweep.xlsx"
+        SpreadsheetExport.writeSpreadsheet(excel_out_path, [('Threshold Sweep', sweep.rows(channelLabels), True), ('Heatmap', [('A1', heatmapLocation)], True)])
+        return sweep
+
+    def computeStatsForVolumes(self, volumes, roiNode, thresholds, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, task=None, sourceFile=None, channelIndices=None):
+        """
+        To compute the volume's colocalization within the current ROI.
+        If a BackgroundTask is given, the computation is started on its worker thread and this returns immediately.
+        If the TIFF file and the indices of the channels are given, the results are cached for the same inputs.
+        """
+        self.profilerRunStart = self.profiler.mark()
 
-            selectedChannelLabel1 = ChannelLabels[0]
-            selectedChannelLabel2 = ChannelLabels[1]
+        # Save the ROI node into into a markups json file.
+        with self.profiler.span("Saving the ROI"):
+            roiNode.AddDefaultStorageNode()
+            outputDirectory = slicer.app.defaultScenePath
+            jsonFileName = outputDirectory + "/" + imageName + " ROI Information.mrk.json"
+            slicer.util.saveNode(roiNode, jsonFileName)
 
-            # Compute the pearson coefficient for the two selected channels.
-            Pearson_coefficient = np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])*(thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1]))/(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])**2))*(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1])**2))))
+        # Get the voxel based crop extent of the ROI.
+        cropExtent = self.cropExtentForROI(roiNode, volumes[0])
 
-            if math.isnan(Pearson_coefficient):
-                Pearson_coefficient = Decimal('0.0000')
-            else:
-                Pearson_coefficient = format(float(Pearson_coefficient), '.4f')
+        # No intersection if there is only one channel
+        if len(volumes) == 1:
+            return
+
+        cacheKey = self.resultCacheKey(sourceFile, channelIndices, thresholds, cropExtent, imageName, colors, ChannelLabels)
+        channelKeys = [(volume.GetID(), volume.GetImageData().GetMTime()) for volume in volumes]
+
+        # Get numpy array data from volumes and compute the statistics.
+        with self.profiler.span("Reading the channel arrays"):
+            arrayData_list = [slicer.util.arrayFromVolume(volume) for volume in volumes]
+        if task is None:
+            self.computeStatsForArrays(arrayData_list, cropExtent, thresholds, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, None, cacheKey, channelKeys)
+        else:
+            task.start(self.computeStatsForArrays, arrayData_list, cropExtent, thresholds, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, task, cacheKey, channelKeys)
+
+    def resultCacheKey(self, sourceFile, channelIndices, thresholds, cropExtent, imageName, colors, ChannelLabels):
+        """
+        Key of the result cache for the statistics of some channels of a TIFF file, or None if the file isn't known.
+        Besides the file identity, channels, thresholds and crop extent, it includes everything the figures show.
+        """
+        fileIdentity = ResultCache.fileIdentity(sourceFile)
+        if fileIdentity is None or channelIndices is None:
+            return None
+        thresholdPairs = [[float(thresholds[index * 2]), float(thresholds[index * 2 + 1])] for index in range(len(channelIndices))]
+        return self.resultCache.key(fileIdentity, list(channelIndices), thresholdPairs, [int(value) for value in cropExtent],
+                                    imageName, list(colors), list(ChannelLabels), self.histogramBins, self.histogramHtmlExport)
+
+    def addCacheArtifact(self, cacheEntry, location):
+        """
+        Keep a copy of a figure in the result cache entry of the current computation, if any.
+        """
+        if cacheEntry is not None:
+            cacheEntry.addArtifact(location)
+
+    def computeStatsForArrays(self, arrayData_list, cropExtent, thresholds, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, task=None, cacheKey=None, channelKeys=None):
+        """
+        To compute the colocalization of the channel arrays within the crop extent, draw the diagrams and export the spreadsheet.
+        Doesn't access the scene or the application (the figures and spreadsheet are saved in outputDirectory, resolved
+        on the main thread), so it can run on the worker thread of a BackgroundTask; images and warnings are then shown on the main thread.
+        When the result cache holds the key, the statistics and figures are taken from it and only the spreadsheet is written again.
+        When the channels are identified by channel keys, their thresholded masks are taken from the channel cache.
+        """
+        with self.profiler.span("Reading the result cache"):
+            cacheEntry = self.resultCache.open(cacheKey) if cacheKey is not None else None
+        thresholdPairs = [(float(thresholds[index * 2]), float(thresholds[index * 2 + 1])) for index in range(len(arrayData_list))]
+        if cacheEntry is not None and cacheEntry.hit:
+            self.printMessage("Using the cached results for unchanged channels, thresholds and ROI.", task)
+            self.drawStatsForResult(cacheEntry.result, None, thresholdPairs, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, task, cacheEntry)
+            return
+
+        self.reportStage(task, "Cropping to the ROI")
+        with self.profiler.span("Cropping to the ROI"):
+            croppedArrayData_list = [ColocEngine.cropArray(arrayData, cropExtent) for arrayData in arrayData_list]
+        self.reportStage(task, "Thresholding and computing metrics")
+        channelMasks = None
+        if channelKeys is not None:
+            with self.profiler.span("Thresholding the channels"):
+                channelMasks = list()
+                for index, arrayData in enumerate(arrayData_list):
+                    channelMasks.append(self.channelCache.channelMask(channelKeys[index], arrayData, cropExtent, *thresholdPairs[index]))
+                    self.reportStage(task, "Thresholding and computing metrics", 0.5 * (index + 1) / len(arrayData_list))
+        with self.profiler.span("Computing the metrics"):
+            result = ColocEngine.computeColocalization(croppedArrayData_list, None, thresholdPairs, progressCallback=self.stageProgressCallback(task, "Thresholding and computing metrics"), channelMasks=channelMasks)
+        self.drawStatsForResult(result, croppedArrayData_list, thresholdPairs, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, task, cacheEntry, channelMasks)
+        if cacheEntry is not None:
+            with self.profiler.span("Storing the result in the cache"):
+                self.resultCache.store(cacheEntry, result)
+
+    def drawStatsForResult(self, result, croppedArrayData_list, thresholdPairs, imageName, widget, colors, ChannelLabels, roi_center_coords, roiSize, orientationMatrix, annotation_text, jsonFileName, outputDirectory, task=None, cacheEntry=None, channelMasks=None):
+        """
+        Draw the diagrams and export the spreadsheet of a colocalization result.
+        The 2D histograms are computed from the cropped channel arrays (and their cached masks, if given),
+        which are not needed (None) when the cache entry holds the figures.
+        """
+        self.reportStage(task, "Drawing plots")
+        lowerThresholdList = [lowerThreshold for lowerThreshold, upperThreshold in thresholdPairs]
+        upperThresholdList = [upperThreshold for lowerThreshold, upperThreshold in thresholdPairs]
+
+        def pairMasks(channel1, channel2):
+            return None if channelMasks is None else [channelMasks[channel1], channelMasks[channel2]]
+
+        # Computes two channels' intersection if there are only two channels
+        if result.channelCount == 2:
+            selectedChannelLabel1 = ChannelLabels[0]
+            selectedChannelLabel2 = ChannelLabels[1]
 
             if imageName in selectedChannelLabel1:
                 ChannelLabel1_in_csv  = selectedChannelLabel1
@@ -1207,49 +1979,28 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
                 ChannelLabel2_in_csv = imageName + "_" + selectedChannelLabel2
 
             # Define the ROI for drawing the scatter diagram/2D histogram.
-            roi_for_scatter = (channel_for_scatter_list[0] | channel_for_scatter_list[1])
-            channel1_in_scatter = arrayData_list[0][roi_for_scatter]
-            channel2_in_scatter = arrayData_list[1][roi_for_scatter]
+            scatterHistogram = None
+            if croppedArrayData_list is not None:
+                with self.profiler.span("Computing the 2D histogram"):
+                    scatterHistogram = JointHistogram.ScatterHistogram(croppedArrayData_list[0], croppedArrayData_list[1], thresholdPairs[0], thresholdPairs[1], self.histogramBins, progressCallback=self.stageProgressCallback(task, "Drawing plots"), channelMasks=pairMasks(0, 1))
 
             # Draw the Venn diagram and produce a spreadsheet.
-            self.drawVennForTwoChannels(widget, singleChannelVolumes, volumeMM3_decimal, lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2, ChannelLabel1_in_csv, ChannelLabel2_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName, Pearson_coefficient, channel1_in_scatter, channel2_in_scatter, annotation_text)
+            with self.profiler.span("Drawing the Venn diagram of two channels"):
+                self.drawVennForTwoChannels(widget, result, lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2, ChannelLabel1_in_csv, ChannelLabel2_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName, outputDirectory, scatterHistogram, annotation_text, task, cacheEntry)
 
             return
 
-        twoChannelsIntersectionVolumes = list()
-        for index in range(3):
-            secondIndex = index + 1
-            if secondIndex == 3:
-                secondIndex = 0
-            volumeMM3 = np.sum(workVolumes[index] * workVolumes[secondIndex])
-            volumeMM3_decimal = Decimal(str(volumeMM3))
-            twoChannelsIntersectionVolumes.append(volumeMM3_decimal)
-
-        volumeMM3 = np.sum(workVolumes[0] * workVolumes[1] * workVolumes[2])
-        volumeMM3_decimal = Decimal(str(volumeMM3))
-
-        # Compute the pearson coefficient for the three selected channels.
-        Pearson_coefficient_1_2 = np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])*(thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1]))/(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])**2))*(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1])**2))))
-
-        if math.isnan(Pearson_coefficient_1_2):
-            Pearson_coefficient_1_2 = Decimal('0.0000')
-        else:
-            Pearson_coefficient_1_2 = format(float(Pearson_coefficient_1_2), '.4f')
-
-
-        Pearson_coefficient_1_3 = np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])*(thresholded_workVolumes_for_pearson[2] - thresholded_arrayData_bar_list[2]))/(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[0] - thresholded_arrayData_bar_list[0])**2))*(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[2] - thresholded_arrayData_bar_list[2])**2))))
-        if math.isnan(Pearson_coefficient_1_3):
-            Pearson_coefficient_1_3 = Decimal('0.0000')
-        else:
-            Pearson_coefficient_1_3 = format(float(Pearson_coefficient_1_3), '.4f')
-
-
-        Pearson_coefficient_2_3 = np.sum((thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1])*(thresholded_workVolumes_for_pearson[2] - thresholded_arrayData_bar_list[2]))/(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[1] - thresholded_arrayData_bar_list[1])**2))*(np.sqrt(np.sum((thresholded_workVolumes_for_pearson[2] - thresholded_arrayData_bar_list[2])**2))))
-        if math.isnan(Pearson_coefficient_2_3):
-            Pearson_coefficient_2_3 = Decimal('0.0000')
-        else:
-            Pearson_coefficient_2_3 = format(float(Pearson_coefficient_2_3), '.4f')
-
+        # More than three channels can't be drawn as a Venn diagram: report every region in a table.
+        if result.channelCount > 3:
+            ChannelLabels_in_csv = list()
+            for selectedChannelLabel in ChannelLabels:
+                if imageName in selectedChannelLabel:
+                    ChannelLabels_in_csv.append(selectedChannelLabel)
+                else:
+                    ChannelLabels_in_csv.append(imageName + "_" + selectedChannelLabel)
+            with self.profiler.span("Drawing the Venn regions of " + str(result.channelCount) + " channels"):
+                self.drawRegionsForChannels(widget, result, lowerThresholdList, upperThresholdList, colors, ChannelLabels, ChannelLabels_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName, outputDirectory, annotation_text, task, cacheEntry)
+            return
 
         selectedChannelLabel1 = ChannelLabels[0]
         selectedChannelLabel2 = ChannelLabels[1]
@@ -1271,177 +2022,249 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
             ChannelLabel3_in_csv = imageName + "_" + selectedChannelLabel3
 
         # Define the ROI for drawing the scatter diagram/2D histogram.
-        roi_for_scatter_c1_c2 = (channel_for_scatter_list[0] | channel_for_scatter_list[1])
-        channel1_in_scatter_c1_c2 = arrayData_list[0][roi_for_scatter_c1_c2]
-        channel2_in_scatter_c1_c2 = arrayData_list[1][roi_for_scatter_c1_c2]
-
-        roi_for_scatter_c1_c3 = (channel_for_scatter_list[0] | channel_for_scatter_list[2])
-        channel1_in_scatter_c1_c3 = arrayData_list[0][roi_for_scatter_c1_c3]
-        channel3_in_scatter_c1_c3 = arrayData_list[2][roi_for_scatter_c1_c3]
-
-        roi_for_scatter_c2_c3 = (channel_for_scatter_list[1] | channel_for_scatter_list[2])
-        channel2_in_scatter_c2_c3 = arrayData_list[1][roi_for_scatter_c2_c3]
-        channel3_in_scatter_c2_c3 = arrayData_list[2][roi_for_scatter_c2_c3]
-
-        self.drawVennForThreeChannels(widget, singleChannelVolumes, twoChannelsIntersectionVolumes, volumeMM3_decimal,
-                                      lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1,
-                                      selectedChannelLabel2, selectedChannelLabel3, ChannelLabel1_in_csv,
-                                      ChannelLabel2_in_csv, ChannelLabel3_in_csv, imageName, roi_center_coords, roiSize,
-                                      orientationMatrix, jsonFileName,Pearson_coefficient_1_2, Pearson_coefficient_1_3,
-                                      Pearson_coefficient_2_3, channel1_in_scatter_c1_c2, channel2_in_scatter_c1_c2,
-                                      channel1_in_scatter_c1_c3, channel3_in_scatter_c1_c3, channel2_in_scatter_c2_c3,
-                                      channel3_in_scatter_c2_c3, annotation_text)
-
+        scatterHistogram_1_2 = scatterHistogram_1_3 = scatterHistogram_2_3 = None
+        if croppedArrayData_list is not None:
+            with self.profiler.span("Computing the 2D histograms"):
+                scatterHistogram_1_2 = JointHistogram.ScatterHistogram(croppedArrayData_list[0], croppedArrayData_list[1], thresholdPairs[0], thresholdPairs[1], self.histogramBins, progressCallback=self.stageProgressCallback(task, "Drawing plots"), channelMasks=pairMasks(0, 1))
+                scatterHistogram_1_3 = JointHistogram.ScatterHistogram(croppedArrayData_list[0], croppedArrayData_list[2], thresholdPairs[0], thresholdPairs[2], self.histogramBins, progressCallback=self.stageProgressCallback(task, "Drawing plots"), channelMasks=pairMasks(0, 2))
+                scatterHistogram_2_3 = JointHistogram.ScatterHistogram(croppedArrayData_list[1], croppedArrayData_list[2], thresholdPairs[1], thresholdPairs[2], self.histogramBins, progressCallback=self.stageProgressCallback(task, "Drawing plots"), channelMasks=pairMasks(1, 2))
+
+        with self.profiler.span("Drawing the Venn diagram of three channels"):
+            self.drawVennForThreeChannels(widget, result, lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1,
+                                          selectedChannelLabel2, selectedChannelLabel3, ChannelLabel1_in_csv,
+                                          ChannelLabel2_in_csv, ChannelLabel3_in_csv, imageName, roi_center_coords, roiSize,
+                                          orientationMatrix, jsonFileName, outputDirectory, scatterHistogram_1_2, scatterHistogram_1_3,
+                                          scatterHistogram_2_3, annotation_text, task, cacheEntry)
+
+
+    def reportStage(self, task, stage, fraction=0.0):
+        """
+        Report the stage of a computation running in a BackgroundTask. Stops the computation if the task was cancelled.
+        """
+        if task is not None:
+            task.setProgress(stage, fraction)
 
-    def drawVennForTwoChannels(self, widget, singleChannelVolumes, intersectionVolume,lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2, ChannelLabel1_in_csv, ChannelLabel2_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName,Pearson_coefficient, channel1_in_scatter, channel2_in_scatter, annotation_text):
+    def stageProgressCallback(self, task, stage):
         """
-        Draw a Venn diagram showing the colocalization percentage when only two channels are selected.
+        Progress callback for the engine functions, reporting the completed fraction of a stage.
         """
-        import decimal
-        from decimal import Decimal
+        if task is None:
+            return None
+        return lambda fraction: task.setProgress(stage, fraction)
 
-        p1 = 0
-        p2 = 0
-        p3 = 0
-        intersection_coefficient = 0
-        i1 = Decimal('0.0000')
-        i2 = Decimal('0.0000')
+    def showImage(self, widget, imageWidgetName, imageLocation, task=None):
+        """
+        Show an image file in one of the image windows of the widget (imageWidget is reused, the others are recreated).
+        When called from a BackgroundTask, the image is shown on the main thread.
+        """
+        if task is not None:
+            task.callOnMainThread(self.showImage, widget, imageWidgetName, imageLocation)
+            return
+        pm = qt.QPixmap(imageLocation)
+        imageWidget = getattr(widget, imageWidgetName, None)
+        if imageWidgetName != 'imageWidget' or not imageWidget:
+            imageWidget = qt.QLabel()
+            setattr(widget, imageWidgetName, imageWidget)
+        imageWidget.setPixmap(pm)
+        imageWidget.setScaledContents(True)
+        imageWidget.show()
+
+    def printMessage(self, text, task=None):
+        """
+        Print a message to the Python console. When called from a BackgroundTask, the message is printed on the main thread.
+        """
+        if task is not None:
+            task.callOnMainThread(print, text)
+            return
+        print(text)
 
-        totalVolumeOfTwoChannels = singleChannelVolumes[0] + singleChannelVolumes[1] - intersectionVolume
+    def showWarning(self, text, task=None):
+        """
+        Show a warning message box. When called from a BackgroundTask, the message box is shown on the main thread.
+        """
+        if task is not None:
+            task.callOnMainThread(self.showWarning, text)
+            return
+        msg = qt.QMessageBox()
+        msg.setIcon(qt.QMessageBox.Warning)
+        msg.setText(text)
+        msg.setStandardButtons(qt.QMessageBox.Ok)
+        msg.exec_()
 
-        if float(totalVolumeOfTwoChannels) > 0:
-            result1 = format(float(((singleChannelVolumes[0] - intersectionVolume) / totalVolumeOfTwoChannels) * Decimal('100.0000')), '.4f')
-            result2 = format(float(((singleChannelVolumes[1] - intersectionVolume) / totalVolumeOfTwoChannels) * Decimal('100.0000')), '.4f')
-            result3 = format(float((intersectionVolume / totalVolumeOfTwoChannels) * Decimal('100.0000')), '.4f')
+    def drawRegionsForChannels(self, widget, result, lowerThresholdList, upperThresholdList, colors, selectedChannelLabels, ChannelLabels_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName, outputDirectory, annotation_text, task=None, cacheEntry=None):
+        """
+        Draw the volume percentage of every Venn region as a bar chart and produce a spreadsheet with one row per region,
+        for any number of selected channels.
+        """
+        channelCount = result.channelCount
+        percentages = result.vennPercentages()
+        if percentages is None:
+            self.showWarning("There are no voxels within current ROI box.", task)
+            return
+        regions = result.vennRegions(percentages)
+        intersection_coefficient, channel_coefficients = result.intersectionCoefficients(percentages)
+
+        for index in range(channelCount):
+            self.printMessage("The threshold range of " + ChannelLabels_in_csv[index] + " is: " + str(lowerThresholdList[index]) + "-" + str(upperThresholdList[index]), task)
+        self.printMessage("The global intersection coefficient of all " + str(channelCount) + " channels is: " + intersection_coefficient, task)
+        self.printMessage("Calculation completed.", task)
+        self.printMessage("------------------------------", task)
+
+        # Display and save the region percentages, skipping the empty regions.
+        regionsImagefileLocation = outputDirectory + "/" + imageName + ' Venn Regions.jpg'
+        if cacheEntry is None or not cacheEntry.restoreArtifact(regionsImagefileLocation):
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+            shownRegions = [region for region in regions if region[1] > 0]
+            my_dpi = 200
+            figure = plt.figure(figsize=(1000 / my_dpi, max(800, 40 * len(shownRegions) + 200) / my_dpi), dpi=my_dpi)
+            regionNames = [' & '.join(selectedChannelLabels[channel] for channel in channels) for channels, volume, percentage in shownRegions]
+            regionColors = [colors[channels[0]] if len(channels) == 1 else '#808080' for channels, volume, percentage in shownRegions]
+            plt.barh(range(len(shownRegions)), [float(percentage) for channels, volume, percentage in shownRegions], color=regionColors, alpha=0.6)
+            plt.yticks(range(len(shownRegions)), regionNames, fontsize=6)
+            plt.gca().invert_yaxis()
+            plt.xlabel('Volume Percentage (%)', fontsize=8)
+            plt.suptitle(imageName, fontsize=15)
+            plt.title('Volume Percentages (I = ' + intersection_coefficient + ')', fontsize=10)
+
+            figure.savefig(regionsImagefileLocation, bbox_inches='tight')
+            plt.close(figure)
+            self.addCacheArtifact(cacheEntry, regionsImagefileLocation)
+        self.showImage(widget, 'imageWidget', regionsImagefileLocation, task)
 
-            result_list_1 = [Decimal(result1), Decimal(result2), Decimal(result3)]
-            result_list_2 = [Decimal(result1), Decimal(result2), Decimal(result3)]
-            result_list_2.remove(max(result_list_2))
-            result_list_2_sum = sum(result_list_2)
-            result_list_1[result_list_1.index(max(result_list_1))] = Decimal('100.0000') - result_list_2_sum
+        # Create a spreadsheet to save the colocalization and ROI information.
+        roi_center_coords_str = "[" + str(-roi_center_coords[0]) + ", " + str(-roi_center_coords[1]) + ", " + str(roi_center_coords[2]) + "]"
+        orientation_str = "[" + str(-orientationMatrix[0]) + ", " + str(-orientationMatrix[1]) + ", " + str(
+            -orientationMatrix[2]) + ", " + str(-orientationMatrix[3]) + ", " + str(-orientationMatrix[4]) + ", " + str(
+            -orientationMatrix[5]) + ", " + str(orientationMatrix[6]) + ", " + str(orientationMatrix[7]) + ", " + str(
+            orientationMatrix[8]) + "]"
+        roiSize_str = "[" + str(roiSize[0]) + ", " + str(roiSize[1]) + ", " + str(roiSize[2]) + "]"
 
-            # Get the specific percentage value corresponding to each part of the Venn diagram.
-            p1 = format(float(result_list_1[0]), '.4f')
-            p2 = format(float(result_list_1[1]), '.4f')
-            p3 = format(float(result_list_1[2]), '.4f')
+        self.reportStage(task, "Exporting the spreadsheet")
+        excel_out_path = outputDirectory + "/" + imageName + " Statistics.xlsx"
+        sheets = SpreadsheetExport.regionStatisticsSheets(result, list(zip(lowerThresholdList, upperThresholdList)), ChannelLabels_in_csv,
+                                              ["LPS", roi_center_coords_str, orientation_str, roiSize_str, jsonFileName], annotation_text,
+                                              regionsImagefileLocation, percentages)
+        SpreadsheetExport.writeSpreadsheet(excel_out_path, sheets, self.writeProfilingSheet, self.profiler)
 
-            sum1 = format(float((result_list_1[0] + result_list_1[2])), '.4f')
-            sum2 = format(float((result_list_1[1] + result_list_1[2])), '.4f')
+    def writeProfilingSheet(self, writer):
+        """
+        Add the stages measured since the computation started to a spreadsheet, if the profiler is enabled.
+        The spreadsheet is written to disk after this, so its own writing only appears in the log.
+        """
+        if not self.profiler.enabled:
+            return
+        import pandas as pd
+        pd.DataFrame(self.profiler.report(self.profilerRunStart), columns=['Stage', 'Wall Time (s)', 'CPU Time (s)', 'Peak Memory (MiB)']).to_excel(writer, sheet_name='Profiling', index=False)
 
-            intersection_coefficient = format(float(Decimal(p3) * Decimal('0.01')), '.4f')
+    def drawScatterHistogram(self, scatterHistogram, ChannelLabel1_in_csv, ChannelLabel2_in_csv, outputDirectory, cacheEntry=None):
+        """
+        Save the 2D histogram of a channel pair in outputDirectory as a PNG image, and as an interactive HTML page if enabled.
+        The files are copied from the result cache entry when it holds them. Returns the location of the PNG image.
+        """
+        scatter_plot_png_location = outputDirectory + "/" + ChannelLabel1_in_csv + ' and ' + ChannelLabel2_in_csv + '_2D Histogram.png'
+        if cacheEntry is None or not cacheEntry.restoreArtifact(scatter_plot_png_location):
+            JointHistogram.saveScatterHistogramImage(scatterHistogram, ChannelLabel1_in_csv, ChannelLabel2_in_csv, scatter_plot_png_location)
+            self.addCacheArtifact(cacheEntry, scatter_plot_png_location)
+        if self.histogramHtmlExport:
+            scatter_plot_html_location = outputDirectory + "/" + ChannelLabel1_in_csv + ' and ' + ChannelLabel2_in_csv + '_2D Histogram.html'
+            if cacheEntry is None or not cacheEntry.restoreArtifact(scatter_plot_html_location):
+                self.saveScatterHistogramHtml(scatterHistogram, ChannelLabel1_in_csv, ChannelLabel2_in_csv, scatter_plot_html_location)
+                self.addCacheArtifact(cacheEntry, scatter_plot_html_location)
+        return scatter_plot_png_location
+
+    def saveScatterHistogramHtml(self, scatterHistogram, ChannelLabel1_in_csv, ChannelLabel2_in_csv, scatter_plot_html_location):
+        """
+        Save the 2D histogram of a channel pair as an interactive Bokeh page.
+        """
+        import pandas as pd
+        import holoviews as hv
+        Dependencies.initializeOnce('bokeh', lambda: hv.extension('bokeh'))
 
-            if singleChannelVolumes[0] == Decimal('0.0000'):
-                i1 = Decimal('0.0000')
+        binCenters1, binCenters2, binCounts = scatterHistogram.nonEmptyBins()
+        df_hist = pd.DataFrame({ChannelLabel1_in_csv: binCenters1, ChannelLabel2_in_csv: binCenters2, "count": binCounts})
+        df_hist["log count"] = np.log10(df_hist["count"])
+        hv_fig = hv.Points(
+            data=df_hist, kdims=[ChannelLabel1_in_csv, ChannelLabel2_in_csv], vdims=["log count"]
+        ).opts(
+            cmap="viridis",
+            color="log count",
+            colorbar=True,
+            colorbar_opts={"title": "log₁₀ count"},
+            frame_height=250,
+            frame_width=250,
+            padding=0.02,
+        )
+        hv.save(hv_fig, scatter_plot_html_location)
 
-            elif singleChannelVolumes[1] == Decimal('0.0000'):
-                i2 = Decimal('0.0000')
+    def drawVennForTwoChannels(self, widget, result, lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2, ChannelLabel1_in_csv, ChannelLabel2_in_csv, imageName, roi_center_coords, roiSize, orientationMatrix, jsonFileName, outputDirectory, scatterHistogram, annotation_text, task=None, cacheEntry=None):
+        """
+        Draw a Venn diagram showing the colocalization percentage when only two channels are selected.
+        """
+        percentages = result.vennPercentages()
+        Pearson_coefficient = result.pearsonCoefficient(0, 1)
 
-            else:
-                i1 = format(float(intersectionVolume / singleChannelVolumes[0]), '.4f')
-                i2 = format(float(intersectionVolume / singleChannelVolumes[1]), '.4f')
-
-            print("The threshold range of " + ChannelLabel1_in_csv + " is: " + str(lowerThresholdList[0]) + "-" + str(upperThresholdList[0]))
-            print("The threshold range of " + ChannelLabel2_in_csv + " is: " + str(lowerThresholdList[1]) + "-" + str(upperThresholdList[1]))
-            print("The percentage of " + ChannelLabel1_in_csv + " is: " + sum1 + "%")
-            print("The percentage of " + ChannelLabel2_in_csv + " is: " + sum2 + "%")
-            print("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel2_in_csv + " is:" + p3 + "%")
-            print("Calculation completed.")
-            print("------------------------------")
+        if percentages is not None:
+            # Get the specific percentage value corresponding to each part of the Venn diagram.
+            p1 = format(float(percentages[0]), '.4f')
+            p2 = format(float(percentages[1]), '.4f')
+            p3 = format(float(percentages[2]), '.4f')
+
+            sum1 = format(float(result.subsetPercentage([0], percentages)), '.4f')
+            sum2 = format(float(result.subsetPercentage([1], percentages)), '.4f')
+
+            intersection_coefficient, (i1, i2) = result.intersectionCoefficients(percentages)
+
+            self.printMessage("The threshold range of " + ChannelLabel1_in_csv + " is: " + str(lowerThresholdList[0]) + "-" + str(upperThresholdList[0]), task)
+            self.printMessage("The threshold range of " + ChannelLabel2_in_csv + " is: " + str(lowerThresholdList[1]) + "-" + str(upperThresholdList[1]), task)
+            self.printMessage("The percentage of " + ChannelLabel1_in_csv + " is: " + sum1 + "%", task)
+            self.printMessage("The percentage of " + ChannelLabel2_in_csv + " is: " + sum2 + "%", task)
+            self.printMessage("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel2_in_csv + " is:" + p3 + "%", task)
+            self.printMessage("Calculation completed.", task)
+            self.printMessage("------------------------------", task)
         else:
-            text = "There are no voxels within current ROI box."
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText(text)
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
+            self.showWarning("There are no voxels within current ROI box.", task)
             return
 
         # Display and save the Venn diagram.
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-        my_dpi = 200
-        plt.figure(figsize=(1000 / my_dpi, 800 / my_dpi), dpi=my_dpi)
-        p1_in_venn = str(p1) + '%'
-        p2_in_venn = str(p2) + '%'
-        p3_in_venn = str(p3) + '%'
+        vennImagename = imageName + ' Venn Diagram.jpg'
+        vennImagefileLocation = outputDirectory + "/" + vennImagename
+        if cacheEntry is None or not cacheEntry.restoreArtifact(vennImagefileLocation):
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+            my_dpi = 200
+            figure = plt.figure(figsize=(1000 / my_dpi, 800 / my_dpi), dpi=my_dpi)
+            p1_in_venn = str(p1) + '%'
+            p2_in_venn = str(p2) + '%'
+            p3_in_venn = str(p3) + '%'
 
-        try:
-            import matplotlib_venn
-        except ModuleNotFoundError:
-            slicer.util.pip_install("matplotlib_venn")
-            import matplotlib_venn
-        from matplotlib_venn import venn2_unweighted
+            from matplotlib_venn import venn2_unweighted
 
-        venn2 = venn2_unweighted(subsets=[p1_in_venn, p2_in_venn, p3_in_venn], set_labels=[selectedChannelLabel1, selectedChannelLabel2], set_colors=(colors[0], colors[1]), alpha=0.6)
+            venn2 = venn2_unweighted(subsets=[p1_in_venn, p2_in_venn, p3_in_venn], set_labels=[selectedChannelLabel1, selectedChannelLabel2], set_colors=(colors[0], colors[1]), alpha=0.6)
 
-        plt.suptitle(imageName, fontsize=15)
-        plt.title('\n' + 'Volume Percentages', fontsize=10)
+            plt.suptitle(imageName, fontsize=15)
+            plt.title('\n' + 'Volume Percentages', fontsize=10)
 
-        Rp = u'r\u209A'
-        plt.text(0.7, 0.2, 'Threshold Range for ' + selectedChannelLabel1  + ': '+ str(lowerThresholdList[0]) + '~' + str(upperThresholdList[0]) + '\n' + 'Threshold Range for ' + selectedChannelLabel2 + ': '+str(lowerThresholdList[1]) + '~' + str(upperThresholdList[1]) + '\n', fontsize=9)
-        plt.text(0.7, 0, 'Pearson Correlation Coefficient: \n' + 'PCC' + ' = ' + str(Pearson_coefficient) + '\n', fontsize=9)
-        plt.text(0.7, -0.23, 'Intersection Coefficients: \n' +'I = ' + str(intersection_coefficient) + '\n' + 'i1 = ' + str(i1) + '\n' + 'i2 = ' + str(i2), fontsize=9)
+            Rp = u'r\u209A'
+            plt.text(0.7, 0.2, 'Threshold Range for ' + selectedChannelLabel1  + ': '+ str(lowerThresholdList[0]) + '~' + str(upperThresholdList[0]) + '\n' + 'Threshold Range for ' + selectedChannelLabel2 + ': '+str(lowerThresholdList[1]) + '~' + str(upperThresholdList[1]) + '\n', fontsize=9)
+            plt.text(0.7, 0, 'Pearson Correlation Coefficient: \n' + 'PCC' + ' = ' + str(Pearson_coefficient) + '\n', fontsize=9)
+            plt.text(0.7, -0.23, 'Intersection Coefficients: \n' +'I = ' + str(intersection_coefficient) + '\n' + 'i1 = ' + str(i1) + '\n' + 'i2 = ' + str(i2), fontsize=9)
 
-        for text in venn2.subset_labels:
-            text.set_fontsize(10)
+            for text in venn2.subset_labels:
+                text.set_fontsize(10)
 
-        vennImagename = imageName + ' Venn Diagram.jpg'
-        vennImagefileLocation = slicer.app.defaultScenePath + "/" + vennImagename
-        plt.savefig(vennImagefileLocation,bbox_inches='tight')
-        pm = qt.QPixmap(vennImagefileLocation)
-        if not widget.imageWidget:
-            widget.imageWidget = qt.QLabel()
-        widget.imageWidget.setPixmap(pm)
-        widget.imageWidget.setScaledContents(True)
-        widget.imageWidget.show()
+            figure.savefig(vennImagefileLocation, bbox_inches='tight')
+            plt.close(figure)
+            self.addCacheArtifact(cacheEntry, vennImagefileLocation)
+        self.showImage(widget, 'imageWidget', vennImagefileLocation, task)
 
 
         # Draw the scatter diagram/2d histogram for the two selected channels.
-        try:
-            import pandas as pd
-        except ModuleNotFoundError:
-            slicer.util.pip_install("pandas")
-            import pandas as pd
-
-        try:
-            import selenium
-        except ModuleNotFoundError:
-            slicer.util.pip_install("selenium")
-            import selenium
-
-        try:
-            import holoviews as hv
-        except ModuleNotFoundError:
-            slicer.util.pip_install("holoviews")
-            import holoviews as hv
-        hv.extension('bokeh')
-
-        df_hist = pd.DataFrame({ChannelLabel1_in_csv: channel1_in_scatter.ravel(), ChannelLabel2_in_csv: channel2_in_scatter.ravel()})
-        df_hist = df_hist.groupby(df_hist.columns.tolist()).size().reset_index(name="count")
-        df_hist["log count"] = np.log10(df_hist["count"])
-        hv_fig = hv.Points(
-            data=df_hist, kdims=[ChannelLabel1_in_csv, ChannelLabel2_in_csv], vdims=["log count"]
-        ).opts(
-            cmap="viridis",
-            color="log count",
-            colorbar=True,
-            colorbar_opts={"title": "log₁₀ count"},
-            frame_height=250,
-            frame_width=250,
-            padding=0.02,
-        )
-
-        # Display and save the scatter diagram.
-        scatter_plot_png_location = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' +ChannelLabel2_in_csv+ '_2D Histogram.png'
-        hv.save(hv_fig, scatter_plot_png_location, fmt='png')
-        pm2 = qt.QPixmap(scatter_plot_png_location)
-        widget.imageWidget2 = qt.QLabel()
-        widget.imageWidget2.setPixmap(pm2)
-        widget.imageWidget2.setScaledContents(True)
-        widget.imageWidget2.show()
-        scatter_plot_html_location = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' + ChannelLabel2_in_csv + '_2D Histogram.html'
-        hv.save(hv_fig, scatter_plot_html_location)
+        with self.profiler.span("Saving the 2D histogram images"):
+            scatter_plot_png_location = self.drawScatterHistogram(scatterHistogram, ChannelLabel1_in_csv, ChannelLabel2_in_csv, outputDirectory, cacheEntry)
+        self.showImage(widget, 'imageWidget2', scatter_plot_png_location, task)
 
         # Create a spreadsheet to save the colocalization and ROI information.
         roi_center_coords_str = "[" + str(-roi_center_coords[0]) + ", " + str(-roi_center_coords[1]) + ", " + str(roi_center_coords[2]) + "]"
@@ -1464,299 +2287,113 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
 
         image_intersection  = {'Global Intersection Coefficient (I)' : volume_intersection_column_2, 'i1' : volume_intersection_column_3,'i2' : volume_intersection_column_4}
 
-        ROI_Information_column_1 = ["Coordinate System: ", "Center: ", "Orientation: ", "Size: ", "ROI JSON File Location: "]
-        ROI_Information_column_2 = ["LPS", roi_center_coords_str, orientation_str, roiSize_str, jsonFileName]
-        ROI_Information = {"ROI Information": ROI_Information_column_1, "Values": ROI_Information_column_2}
-
-        annotation_column_1 = [annotation_text]
-        annotation_information = {"Annotation": annotation_column_1}
-
-        current_timestamp = time.ctime()
-        timestamp_column_1 = [current_timestamp]
-        timestamp_information = {"Timestamp": timestamp_column_1}
+        self.reportStage(task, "Exporting the spreadsheet")
+        excel_out_path = outputDirectory + "/" + imageName + " Statistics.xlsx"
+        sheets = [('Threshold Ranges', threshold_Range, True),
+                  SpreadsheetExport.roiInformationSheet(["LPS", roi_center_coords_str, orientation_str, roiSize_str, jsonFileName]),
+                  ('PCC', image_pearson, True), ('Intersection Coefficients', image_intersection, True),
+                  ('Venn Diagram', [('A1', vennImagefileLocation)], True),
+                  ('2D Histogram', [('A1', scatter_plot_png_location)], True)] + SpreadsheetExport.annotationSheets(annotation_text)
+        SpreadsheetExport.writeSpreadsheet(excel_out_path, sheets, self.writeProfilingSheet, self.profiler)
 
-        df1 = pd.DataFrame.from_dict(threshold_Range, orient='index')
-        df1 = df1.transpose()
-
-        df2 = pd.DataFrame.from_dict(ROI_Information, orient='index')
-        df2 = df2.transpose()
-
-        df3 = pd.DataFrame.from_dict(image_pearson, orient='index')
-        df3 = df3.transpose()
-
-        df4 = pd.DataFrame.from_dict(image_intersection, orient='index')
-        df4 = df4.transpose()
-
-        df5 = pd.DataFrame.from_dict(annotation_information, orient='index')
-        df5 = df5.transpose()
-
-        df6 = pd.DataFrame.from_dict(timestamp_information, orient='index')
-        df6 = df6.transpose()
-
-
-        try:
-            import xlsxwriter
-        except ModuleNotFoundError:
-            slicer.util.pip_install("xlsxwriter")
-            import xlsxwriter
-
-        excel_out_path = slicer.app.defaultScenePath + "/" + imageName + " Statistics.xlsx"
-        writer = pd.ExcelWriter(excel_out_path , engine='xlsxwriter')
-        df1.to_excel(writer, sheet_name = 'Threshold Ranges', index=False)
-        df2.to_excel(writer, sheet_name='ROI Information', header=False, index=False)
-        df3.to_excel(writer, sheet_name = 'PCC', index=False)
-        df4.to_excel(writer, sheet_name='Intersection Coefficients', index=False)
-        venn_subsheet = writer.book.add_worksheet('Venn Diagram')
-        venn_subsheet.insert_image('A1', vennImagefileLocation)
-        scatter_subsheet = writer.book.add_worksheet('2D Histogram')
-        scatter_subsheet.insert_image('A1', scatter_plot_png_location)
-        df5.to_excel(writer, sheet_name='Annotation', index=False)
-        df6.to_excel(writer, sheet_name='Timestamp', index=False)
-        writer.close()
-
-    def drawVennForThreeChannels(self, widget, singleChannelVolumes, twoChannelsIntersectionVolumes, intersection_1_2_3,
-                                 lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2,
+    def drawVennForThreeChannels(self, widget, result, lowerThresholdList, upperThresholdList, colors, selectedChannelLabel1, selectedChannelLabel2,
                                  selectedChannelLabel3, ChannelLabel1_in_csv, ChannelLabel2_in_csv, ChannelLabel3_in_csv,
-                                 imageName, roi_center_coords, roiSize,orientationMatrix, jsonFileName,Pearson_coefficient_1_2,
-                                 Pearson_coefficient_1_3,Pearson_coefficient_2_3, channel1_in_scatter_c1_c2, channel2_in_scatter_c1_c2,
-                                 channel1_in_scatter_c1_c3, channel3_in_scatter_c1_c3, channel2_in_scatter_c2_c3, channel3_in_scatter_c2_c3, annotation_text):
+                                 imageName, roi_center_coords, roiSize,orientationMatrix, jsonFileName, outputDirectory, scatterHistogram_1_2, scatterHistogram_1_3, scatterHistogram_2_3, annotation_text, task=None, cacheEntry=None):
         """
         Draw a Venn diagram showing the colocalization percentage when three channels are selected.
         """
-        import decimal
-        from decimal import Decimal
-
-        totalVolumeOfTwoChannels = singleChannelVolumes[0] + singleChannelVolumes[1] - twoChannelsIntersectionVolumes[0]
-        totalVolumeOfThreeChannels = totalVolumeOfTwoChannels + singleChannelVolumes[2] - twoChannelsIntersectionVolumes[2] - (twoChannelsIntersectionVolumes[1] - intersection_1_2_3)
-
-        p1 = 0
-        p2 = 0
-        p3 = 0
-        p4 = 0
-        p5 = 0
-        p6 = 0
-        p7 = 0
-        intersection_coefficient = 0
-        i1 = Decimal('0.0000')
-        i2 = Decimal('0.0000')
-        i3 = Decimal('0.0000')
-
-        if float(totalVolumeOfThreeChannels) > 0:
-            result1 = format(float((((singleChannelVolumes[0] - twoChannelsIntersectionVolumes[0]) - (twoChannelsIntersectionVolumes[2] - intersection_1_2_3)) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result2 = format(float((((singleChannelVolumes[1] - twoChannelsIntersectionVolumes[0]) - (twoChannelsIntersectionVolumes[1] - intersection_1_2_3)) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result3 = format(float(((twoChannelsIntersectionVolumes[0] - intersection_1_2_3) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result4 = format(float((((singleChannelVolumes[2] - twoChannelsIntersectionVolumes[1]) - (twoChannelsIntersectionVolumes[2] - intersection_1_2_3)) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result5 = format(float(((twoChannelsIntersectionVolumes[2] - intersection_1_2_3) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result6 = format(float(((twoChannelsIntersectionVolumes[1] - intersection_1_2_3) / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-            result7 = format(float((intersection_1_2_3 / totalVolumeOfThreeChannels) * Decimal('100.0000')), '.4f')
-
-            result_list_1 = [Decimal(result1), Decimal(result2), Decimal(result3), Decimal(result4), Decimal(result5), Decimal(result6), Decimal(result7)]
-            result_list_2 = [Decimal(result1), Decimal(result2), Decimal(result3), Decimal(result4), Decimal(result5), Decimal(result6), Decimal(result7)]
-            result_list_2.remove(max(result_list_2))
-            result_list_2_sum = sum(result_list_2)
-            result_list_1[result_list_1.index(max(result_list_1))] = Decimal('100.0000') - result_list_2_sum
+        percentages = result.vennPercentages()
+        Pearson_coefficient_1_2 = result.pearsonCoefficient(0, 1)
+        Pearson_coefficient_1_3 = result.pearsonCoefficient(0, 2)
+        Pearson_coefficient_2_3 = result.pearsonCoefficient(1, 2)
 
+        if percentages is not None:
             # Get the specific percentage value corresponding to each part of the Venn diagram.
-            p1 = format(float(result_list_1[0]), '.4f')
-            p2 = format(float(result_list_1[1]), '.4f')
-            p3 = format(float(result_list_1[2]), '.4f')
-            p4 = format(float(result_list_1[3]), '.4f')
-            p5 = format(float(result_list_1[4]), '.4f')
-            p6 = format(float(result_list_1[5]), '.4f')
-            p7 = format(float(result_list_1[6]), '.4f')
-
-            sum1_2 = format(float((result_list_1[2] + result_list_1[6])), '.4f')
-            sum1_3 = format(float((result_list_1[4] + result_list_1[6])), '.4f')
-            sum2_3 = format(float((result_list_1[5] + result_list_1[6])), '.4f')
-            sum1 = format(float((result_list_1[0] + result_list_1[4] + result_list_1[2] + result_list_1[6])), '.4f')
-            sum2 = format(float((result_list_1[1] + result_list_1[5] + result_list_1[2] + result_list_1[6])), '.4f')
-            sum3 = format(float((result_list_1[3] + result_list_1[4] + result_list_1[5] + result_list_1[6])), '.4f')
-
-            intersection_coefficient = format(float(Decimal(p7) * Decimal('0.01')), '.4f')
-
-            if singleChannelVolumes[0] == Decimal('0.0000'):
-                i1 = Decimal('0.0000')
-            elif singleChannelVolumes[1] == Decimal('0.0000'):
-                i2 = Decimal('0.0000')
-            elif singleChannelVolumes[2] == Decimal('0.0000'):
-                i3 = Decimal('0.0000')
-            else:
-
-                i1 = format(float(intersection_1_2_3 / singleChannelVolumes[0]), '.4f')
-                i2 = format(float(intersection_1_2_3 / singleChannelVolumes[1]), '.4f')
-                i3 = format(float(intersection_1_2_3 / singleChannelVolumes[2]), '.4f')
-
-            print("The threshold range of " + ChannelLabel1_in_csv + " is: " + str(lowerThresholdList[0]) + "-" + str(upperThresholdList[0]))
-            print("The threshold range of " + ChannelLabel2_in_csv + " is: " + str(lowerThresholdList[1]) + "-" + str(upperThresholdList[1]))
-            print("The threshold range of " + ChannelLabel3_in_csv + " is: " + str(lowerThresholdList[2]) + "-" + str(upperThresholdList[2]))
-            print("The percentage of " + ChannelLabel1_in_csv + " is:" + sum1 + "%")
-            print("The percentage of " + ChannelLabel2_in_csv + " is:" + sum2 + "%")
-            print("The percentage of " + ChannelLabel3_in_csv + " is:" + sum3 + "%")
-            print("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel2_in_csv + " is:" + sum1_2 + "%")
-            print("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel3_in_csv + " is:" + sum1_3 + "%")
-            print("The percentage of intersection between " + ChannelLabel2_in_csv + " and " + ChannelLabel3_in_csv + " is:" + sum2_3 + "%")
-            print("The percentage of the intersection of the three channels is: " + p7 + "%")
-            print("Calculation completed.")
-            print("------------------------------")
+            p1, p2, p3, p4, p5, p6, p7 = [format(float(percentage), '.4f') for percentage in percentages]
+
+            sum1_2 = format(float(result.subsetPercentage([0, 1], percentages)), '.4f')
+            sum1_3 = format(float(result.subsetPercentage([0, 2], percentages)), '.4f')
+            sum2_3 = format(float(result.subsetPercentage([1, 2], percentages)), '.4f')
+            sum1 = format(float(result.subsetPercentage([0], percentages)), '.4f')
+            sum2 = format(float(result.subsetPercentage([1], percentages)), '.4f')
+            sum3 = format(float(result.subsetPercentage([2], percentages)), '.4f')
+
+            intersection_coefficient, (i1, i2, i3) = result.intersectionCoefficients(percentages)
+
+            self.printMessage("The threshold range of " + ChannelLabel1_in_csv + " is: " + str(lowerThresholdList[0]) + "-" + str(upperThresholdList[0]), task)
+            self.printMessage("The threshold range of " + ChannelLabel2_in_csv + " is: " + str(lowerThresholdList[1]) + "-" + str(upperThresholdList[1]), task)
+            self.printMessage("The threshold range of " + ChannelLabel3_in_csv + " is: " + str(lowerThresholdList[2]) + "-" + str(upperThresholdList[2]), task)
+            self.printMessage("The percentage of " + ChannelLabel1_in_csv + " is:" + sum1 + "%", task)
+            self.printMessage("The percentage of " + ChannelLabel2_in_csv + " is:" + sum2 + "%", task)
+            self.printMessage("The percentage of " + ChannelLabel3_in_csv + " is:" + sum3 + "%", task)
+            self.printMessage("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel2_in_csv + " is:" + sum1_2 + "%", task)
+            self.printMessage("The percentage of intersection between " + ChannelLabel1_in_csv + " and " + ChannelLabel3_in_csv + " is:" + sum1_3 + "%", task)
+            self.printMessage("The percentage of intersection between " + ChannelLabel2_in_csv + " and " + ChannelLabel3_in_csv + " is:" + sum2_3 + "%", task)
+            self.printMessage("The percentage of the intersection of the three channels is: " + p7 + "%", task)
+            self.printMessage("Calculation completed.", task)
+            self.printMessage("------------------------------", task)
         else:
-            text = "There are no voxels within current ROI box."
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText(text)
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
+            self.showWarning("There are no voxels within current ROI box.", task)
             return
 
         # Create a Venn diagram.
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-        my_dpi = 200
-        plt.figure(figsize=(1600 / my_dpi, 1300 / my_dpi), dpi=my_dpi)
-        p1_in_venn = str(p1) + '%'
-        p2_in_venn = str(p2) + '%'
-        p3_in_venn = str(p3) + '%'
-        p4_in_venn = str(p4) + '%'
-        p5_in_venn = str(p5) + '%'
-        p6_in_venn = str(p6) + '%'
-        p7_in_venn = str(p7) + '%'
-
-        try:
-            import matplotlib_venn
-        except ModuleNotFoundError:
-            slicer.util.pip_install("matplotlib_venn")
-            import matplotlib_venn
-        from matplotlib_venn import venn3_unweighted
-
-        venn3 = venn3_unweighted(subsets=[p1_in_venn, p2_in_venn, p3_in_venn, p4_in_venn, p5_in_venn, p6_in_venn, p7_in_venn],
-                                 set_labels=[selectedChannelLabel1, selectedChannelLabel2, selectedChannelLabel3],
-                                 set_colors=(colors[0], colors[1], colors[2]), alpha=0.6)
-        plt.suptitle(imageName, fontsize=16)
-        plt.title('\n' + 'Volume Percentages', fontsize=10)
+        vennImagename = imageName + ' Venn Diagram.jpg'
+        vennImagefileLocation = outputDirectory + "/" + vennImagename
+        if cacheEntry is None or not cacheEntry.restoreArtifact(vennImagefileLocation):
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+            my_dpi = 200
+            figure = plt.figure(figsize=(1600 / my_dpi, 1300 / my_dpi), dpi=my_dpi)
+            p1_in_venn = str(p1) + '%'
+            p2_in_venn = str(p2) + '%'
+            p3_in_venn = str(p3) + '%'
+            p4_in_venn = str(p4) + '%'
+            p5_in_venn = str(p5) + '%'
+            p6_in_venn = str(p6) + '%'
+            p7_in_venn = str(p7) + '%'
 
-        Rp = u'r\u209A'
-        plt.text(0.7, 0.4, 'Threshold Range for ' + selectedChannelLabel1  + ': '+ str(lowerThresholdList[0]) + '~' + str(upperThresholdList[0]) + '\n' + 'Threshold Range for ' + selectedChannelLabel2 + ': '+str(lowerThresholdList[1]) + '~' + str(upperThresholdList[1]) + '\n' + 'Threshold Range for ' + selectedChannelLabel3 + ': '+str(lowerThresholdList[2]) + '~' + str(upperThresholdList[2]) + '\n', fontsize=9)
+            from matplotlib_venn import venn3_unweighted
 
-        plt.text(0.7, 0, 'Pearson Correlation Coefficients: \n' + 'For ' + selectedChannelLabel1 + ' and ' + selectedChannelLabel2 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_1_2) + '\n' + '\n' +
-                 'For ' + selectedChannelLabel1 + ' and ' + selectedChannelLabel3 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_1_3) + '\n' + '\n' +
-                 'For ' + selectedChannelLabel2 + ' and ' + selectedChannelLabel3 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_2_3) + '\n', fontsize=9)
+            venn3 = venn3_unweighted(subsets=[p1_in_venn, p2_in_venn, p3_in_venn, p4_in_venn, p5_in_venn, p6_in_venn, p7_in_venn],
+                                     set_labels=[selectedChannelLabel1, selectedChannelLabel2, selectedChannelLabel3],
+                                     set_colors=(colors[0], colors[1], colors[2]), alpha=0.6)
+            plt.suptitle(imageName, fontsize=16)
+            plt.title('\n' + 'Volume Percentages', fontsize=10)
 
-        plt.text(0.7, -0.2, 'Intersection Coefficients: \n' + 'I = ' + str(intersection_coefficient) + '\n' + 'i1 = ' + str(i1) + '\n' + 'i2 = ' + str(i2) + '\n' + 'i3 = ' + str(i3), fontsize=9)
+            Rp = u'r\u209A'
+            plt.text(0.7, 0.4, 'Threshold Range for ' + selectedChannelLabel1  + ': '+ str(lowerThresholdList[0]) + '~' + str(upperThresholdList[0]) + '\n' + 'Threshold Range for ' + selectedChannelLabel2 + ': '+str(lowerThresholdList[1]) + '~' + str(upperThresholdList[1]) + '\n' + 'Threshold Range for ' + selectedChannelLabel3 + ': '+str(lowerThresholdList[2]) + '~' + str(upperThresholdList[2]) + '\n', fontsize=9)
 
-        for text in venn3.subset_labels:
-            text.set_fontsize(10)
+            plt.text(0.7, 0, 'Pearson Correlation Coefficients: \n' + 'For ' + selectedChannelLabel1 + ' and ' + selectedChannelLabel2 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_1_2) + '\n' + '\n' +
+                     'For ' + selectedChannelLabel1 + ' and ' + selectedChannelLabel3 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_1_3) + '\n' + '\n' +
+                     'For ' + selectedChannelLabel2 + ' and ' + selectedChannelLabel3 + ':' + '\n' + 'PCC' + ' = ' + str(Pearson_coefficient_2_3) + '\n', fontsize=9)
 
-        vennImagename = imageName + ' Venn Diagram.jpg'
-        vennImagefileLocation = slicer.app.defaultScenePath + "/" + vennImagename
-        plt.savefig(vennImagefileLocation,bbox_inches='tight')
-        pm = qt.QPixmap(vennImagefileLocation)
-        if not widget.imageWidget:
-            widget.imageWidget = qt.QLabel()
-        widget.imageWidget.setPixmap(pm)
-        widget.imageWidget.setScaledContents(True)
-        widget.imageWidget.show()
+            plt.text(0.7, -0.2, 'Intersection Coefficients: \n' + 'I = ' + str(intersection_coefficient) + '\n' + 'i1 = ' + str(i1) + '\n' + 'i2 = ' + str(i2) + '\n' + 'i3 = ' + str(i3), fontsize=9)
 
+            for text in venn3.subset_labels:
+                text.set_fontsize(10)
 
-        try:
-            import pandas as pd
-        except ModuleNotFoundError:
-            slicer.util.pip_install("pandas")
-            import pandas as pd
-
-        try:
-            import selenium
-        except ModuleNotFoundError:
-            slicer.util.pip_install("selenium")
-            import selenium
+            figure.savefig(vennImagefileLocation, bbox_inches='tight')
+            plt.close(figure)
+            self.addCacheArtifact(cacheEntry, vennImagefileLocation)
+        self.showImage(widget, 'imageWidget', vennImagefileLocation, task)
 
-        try:
-            import holoviews as hv
-        except ModuleNotFoundError:
-            slicer.util.pip_install("holoviews")
-            import holoviews as hv
-        hv.extension('bokeh')
 
         # Draw the scatter diagram/2d histogram for the first and second selected channels.
-        df_hist_1_2 = pd.DataFrame({ChannelLabel1_in_csv: channel1_in_scatter_c1_c2.ravel(), ChannelLabel2_in_csv: channel2_in_scatter_c1_c2.ravel()})
-        df_hist_1_2 = df_hist_1_2.groupby(df_hist_1_2.columns.tolist()).size().reset_index(name="count")
-        df_hist_1_2["log count"] = np.log10(df_hist_1_2["count"])
-        hv_fig_1_2 = hv.Points(
-            data=df_hist_1_2, kdims=[ChannelLabel1_in_csv, ChannelLabel2_in_csv], vdims=["log count"]
-        ).opts(
-            cmap="viridis",
-            color="log count",
-            colorbar=True,
-            colorbar_opts={"title": "log₁₀ count"},
-            frame_height=250,
-            frame_width=250,
-            padding=0.02,
-        )
-
-        # Display and save the scatter diagram.
-        scatter_plot_png_location_1_2 = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' +ChannelLabel2_in_csv+ '_2D Histogram.png'
-        hv.save(hv_fig_1_2, scatter_plot_png_location_1_2, fmt='png')
-        pm2 = qt.QPixmap(scatter_plot_png_location_1_2)
-        widget.imageWidget2 = qt.QLabel()
-        widget.imageWidget2.setPixmap(pm2)
-        widget.imageWidget2.setScaledContents(True)
-        widget.imageWidget2.show()
-        scatter_plot_html_location_1_2 = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' + ChannelLabel2_in_csv + '_2D Histogram.html'
-        hv.save(hv_fig_1_2, scatter_plot_html_location_1_2)
+        with self.profiler.span("Saving the 2D histogram images of channels 1 and 2"):
+            scatter_plot_png_location_1_2 = self.drawScatterHistogram(scatterHistogram_1_2, ChannelLabel1_in_csv, ChannelLabel2_in_csv, outputDirectory, cacheEntry)
+        self.showImage(widget, 'imageWidget2', scatter_plot_png_location_1_2, task)
 
         # Draw the scatter diagram/2d histogram for the first and third selected channels.
-        df_hist_1_3 = pd.DataFrame({ChannelLabel1_in_csv: channel1_in_scatter_c1_c3.ravel(), ChannelLabel3_in_csv: channel3_in_scatter_c1_c3.ravel()})
-        df_hist_1_3 = df_hist_1_3.groupby(df_hist_1_3.columns.tolist()).size().reset_index(name="count")
-        df_hist_1_3["log count"] = np.log10(df_hist_1_3["count"])
-        hv_fig_1_3 = hv.Points(
-            data=df_hist_1_3, kdims=[ChannelLabel1_in_csv, ChannelLabel3_in_csv], vdims=["log count"]
-        ).opts(
-            cmap="viridis",
-            color="log count",
-            colorbar=True,
-            colorbar_opts={"title": "log₁₀ count"},
-            frame_height=250,
-            frame_width=250,
-            padding=0.02,
-        )
-
-        # Display and save the scatter diagram.
-        scatter_plot_png_location_1_3 = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' +ChannelLabel3_in_csv+ '_2D Histogram.png'
-        hv.save(hv_fig_1_3, scatter_plot_png_location_1_3, fmt='png')
-        pm3 = qt.QPixmap(scatter_plot_png_location_1_3)
-        widget.imageWidget3 = qt.QLabel()
-        widget.imageWidget3.setPixmap(pm3)
-        widget.imageWidget3.setScaledContents(True)
-        widget.imageWidget3.show()
-        scatter_plot_html_location_1_3 = slicer.app.defaultScenePath + "/" + ChannelLabel1_in_csv + ' and ' + ChannelLabel3_in_csv + '_2D Histogram.html'
-        hv.save(hv_fig_1_3, scatter_plot_html_location_1_3)
+        with self.profiler.span("Saving the 2D histogram images of channels 1 and 3"):
+            scatter_plot_png_location_1_3 = self.drawScatterHistogram(scatterHistogram_1_3, ChannelLabel1_in_csv, ChannelLabel3_in_csv, outputDirectory, cacheEntry)
+        self.showImage(widget, 'imageWidget3', scatter_plot_png_location_1_3, task)
 
 
         # Draw the scatter diagram/2d histogram for the second and third selected channels.
-        df_hist_2_3 = pd.DataFrame({ChannelLabel2_in_csv: channel2_in_scatter_c2_c3.ravel(), ChannelLabel3_in_csv: channel3_in_scatter_c2_c3.ravel()})
-        df_hist_2_3 = df_hist_2_3.groupby(df_hist_2_3.columns.tolist()).size().reset_index(name="count")
-        df_hist_2_3["log count"] = np.log10(df_hist_2_3["count"])
-        hv_fig_2_3 = hv.Points(
-            data=df_hist_2_3, kdims=[ChannelLabel2_in_csv, ChannelLabel3_in_csv], vdims=["log count"]
-        ).opts(
-            cmap="viridis",
-            color="log count",
-            colorbar=True,
-            colorbar_opts={"title": "log₁₀ count"},
-            frame_height=250,
-            frame_width=250,
-            padding=0.02,
-        )
-
-        # Display and save the scatter diagram.
-        scatter_plot_png_location_2_3 = slicer.app.defaultScenePath + "/" + ChannelLabel2_in_csv + ' and ' +ChannelLabel3_in_csv+ '_2D Histogram.png'
-        hv.save(hv_fig_2_3, scatter_plot_png_location_2_3, fmt='png')
-        pm4 = qt.QPixmap(scatter_plot_png_location_2_3)
-        widget.imageWidget4 = qt.QLabel()
-        widget.imageWidget4.setPixmap(pm4)
-        widget.imageWidget4.setScaledContents(True)
-        widget.imageWidget4.show()
-        scatter_plot_html_location_2_3 = slicer.app.defaultScenePath + "/" + ChannelLabel2_in_csv + ' and ' + ChannelLabel3_in_csv + '_2D Histogram.html'
-        hv.save(hv_fig_2_3, scatter_plot_html_location_2_3)
+        with self.profiler.span("Saving the 2D histogram images of channels 2 and 3"):
+            scatter_plot_png_location_2_3 = self.drawScatterHistogram(scatterHistogram_2_3, ChannelLabel2_in_csv, ChannelLabel3_in_csv, outputDirectory, cacheEntry)
+        self.showImage(widget, 'imageWidget4', scatter_plot_png_location_2_3, task)
 
 
         # Create a spreadsheet to save the colocalization and ROI information.
@@ -1784,56 +2421,14 @@ class ColocZStatsLogic(ScriptedLoadableModuleLogic):
         volume_intersection_column_5 = [str(i3)]
         image_intersection = {'Global Intersection Coefficient (I)': volume_intersection_column_2, 'i1': volume_intersection_column_3, 'i2': volume_intersection_column_4,'i3': volume_intersection_column_5 }
 
-        ROI_Information_column_1 = ["Coordinate System: ", "Center: ", "Orientation: ", "Size: ", "ROI JSON File Location: "]
-        ROI_Information_column_2 = ["LPS", roi_center_coords_str, orientation_str, roiSize_str, jsonFileName]
-        ROI_Information = {"ROI Information": ROI_Information_column_1, "Values": ROI_Information_column_2}
-
-        annotation_column_1 = [annotation_text]
-        annotation_information = {"Annotation": annotation_column_1}
-
-        current_timestamp = time.ctime()
-        timestamp_column_1 = [current_timestamp]
-        timestamp_information = {"Timestamp": timestamp_column_1}
-
-        df1 = pd.DataFrame.from_dict(threshold_Range, orient='index')
-        df1 = df1.transpose()
-
-        df2 = pd.DataFrame.from_dict(ROI_Information, orient='index')
-        df2 = df2.transpose()
-
-        df3 = pd.DataFrame.from_dict(image_pearson, orient='index')
-        df3 = df3.transpose()
-
-        df4 = pd.DataFrame.from_dict(image_intersection, orient='index')
-        df4 = df4.transpose()
-
-        df5 = pd.DataFrame.from_dict(annotation_information, orient='index')
-        df5 = df5.transpose()
-
-        df6 = pd.DataFrame.from_dict(timestamp_information, orient='index')
-        df6 = df6.transpose()
-
-        try:
-            import xlsxwriter
-        except ModuleNotFoundError:
-            slicer.util.pip_install("xlsxwriter")
-            import xlsxwriter
-
-        excel_out_path = slicer.app.defaultScenePath + "/" + imageName + " Statistics.xlsx"
-        writer = pd.ExcelWriter(excel_out_path, engine='xlsxwriter')
-        df1.to_excel(writer, sheet_name='Threshold Ranges', index=False)
-        df2.to_excel(writer, sheet_name='ROI Information', header=False, index=False)
-        df3.to_excel(writer, sheet_name='PCCs', index=False)
-        df4.to_excel(writer, sheet_name='Intersection Coefficients', index=False)
-        venn_subsheet = writer.book.add_worksheet('Venn Diagram')
-        venn_subsheet.insert_image('A1', vennImagefileLocation)
-        scatter_subsheet = writer.book.add_worksheet('2D Histograms')
-        scatter_subsheet.insert_image('A1', scatter_plot_png_location_1_2)
-        scatter_subsheet.insert_image('I1', scatter_plot_png_location_1_3)
-        scatter_subsheet.insert_image('Q1', scatter_plot_png_location_2_3)
-        df5.to_excel(writer, sheet_name='Annotation', index=False)
-        df6.to_excel(writer, sheet_name='Timestamp', index=False)
-        writer.close()
+        self.reportStage(task, "Exporting the spreadsheet")
+        excel_out_path = outputDirectory + "/" + imageName + " Statistics.xlsx"
+        sheets = [('Threshold Ranges', threshold_Range, True),
+                  SpreadsheetExport.roiInformationSheet(["LPS", roi_center_coords_str, orientation_str, roiSize_str, jsonFileName]),
+                  ('PCCs', image_pearson, True), ('Intersection Coefficients', image_intersection, True),
+                  ('Venn Diagram', [('A1', vennImagefileLocation)], True),
+                  ('2D Histograms', [('A1', scatter_plot_png_location_1_2), ('I1', scatter_plot_png_location_1_3), ('Q1', scatter_plot_png_location_2_3)], True)] + SpreadsheetExport.annotationSheets(annotation_text)
+        SpreadsheetExport.writeSpreadsheet(excel_out_path, sheets, self.writeProfilingSheet, self.profiler)
 
 
 #
@@ -1846,7 +2441,480 @@ class ColocZStatsTest(ScriptedLoadableModuleTest):
 
     def runTest(self):
         self.test_ColocZStats()
+        self.test_ColocEngine()
+        self.test_ChannelCache()
+        self.test_PackedIntersections()
+        self.test_Pyramid()
+        self.test_ThresholdSweep()
+        self.test_SpreadsheetExport()
+        self.test_ResultCache()
+        self.test_Instrumentation()
+        self.test_ImageRegistry()
+        self.test_CompositeRendering()
+        self.test_LoadedChannelSelection()
+        self.test_IntegralVolume()
+        self.test_ColocalizationByLabel()
+        self.test_Batch()
+        self.test_BackgroundTask()
+        self.test_Dependencies()
 
     def test_ColocZStats(self):
+        """
+        Run the benchmark on small synthetic stacks and check the engine against the dense formulas.
+        """
         self.delayDisplay("Starting the test")
+        try:
+            import tifffile
+        except ModuleNotFoundError:
+            slicer.util.pip_install("tifffile")
+            import tifffile
+        results = Benchmark.runBenchmark(sizes=['40x32x24'], channelCount=3, printFunction=logging.info)
+        self.assertEqual(len(results['cases']), 1)
+        self.assertTrue(results['cases'][0]['agreement']['passed'])
+        self.assertGreater(results['cases'][0]['stages']['pcc']['wallTime'], 0)
+        results = Benchmark.runBenchmark(sizes=['40x32x24'], dtype=np.float32, overlap=1.0, correlation=1.0, printFunction=logging.info)
+        self.assertTrue(results['cases'][0]['agreement']['passed'])
+        self.assertEqual(Benchmark.compareResults(results, results), [])
+        self.delayDisplay('Test passed!')
+
+    def nestedChannels(self):
+        """
+        Four nested channels of one 4x4 slice: channel c covers the columns >= c.
+        """
+        channels = list()
+        for channel in range(4):
+            channelData = np.zeros((1, 4, 4), dtype=np.uint8)
+            channelData[:, :, channel:] = 100
+            channels.append(channelData)
+        return channels
+
+    def test_ColocEngine(self):
+        """
+        Check the Slicer-free engine on a small synthetic two-channel volume and on four nested channels.
+        """
+        self.delayDisplay("Starting the engine test")
+        channel1 = np.zeros((2, 4, 4), dtype=np.uint16)
+        channel2 = np.zeros((2, 4, 4), dtype=np.uint16)
+        channel1[:, :2, :] = 100
+        channel2[:, 1:3, :] = 200
+        result = ColocEngine.computeColocalization([channel1, channel2], None, [(50, 255), (50, 255)])
+        self.assertEqual(result.channelVolumes, [16, 16])
+        self.assertEqual(result.intersectionVolume([0, 1]), 8)
+        intersectionCoefficient, channelCoefficients = result.intersectionCoefficients()
+        self.assertEqual(intersectionCoefficient, '0.3333')
+        self.assertEqual(channelCoefficients, ['0.5000', '0.5000'])
+        self.assertEqual(result.pearsonCoefficient(0, 1), '0.0000')
+
+        channels = self.nestedChannels()
+        result = ColocEngine.computeColocalization(channels, None, [(50, 255)] * 4)
+        self.assertEqual(result.channelVolumes, [16, 12, 8, 4])
+        self.assertEqual(result.intersectionVolume([0, 1, 2, 3]), 4)
+        regionVolumes = result.exclusiveRegionVolumes()
+        self.assertEqual([regionVolumes[0b0001], regionVolumes[0b0011], regionVolumes[0b0111], regionVolumes[0b1111]], [4, 4, 4, 4])
+        self.assertEqual(result.unionVolume(), 16)
+        self.delayDisplay('Test passed!')
+
+    def test_ChannelCache(self):
+        """
+        Check that the cached thresholded masks are reused and give the same statistics as the engine.
+        """
+        self.delayDisplay("Starting the channel cache test")
+        channels = self.nestedChannels()
+        channelCache = ChannelCache.ChannelCache()
+        channelMasks = [channelCache.channelMask(channel, channels[channel], [1, 4, 0, 3, 0, 1], 50, 255) for channel in range(4)]
+        self.assertIs(channelCache.channelMask(0, channels[0], [1, 4, 0, 3, 0, 1], 50, 255), channelMasks[0])
+        cachedResult = ColocEngine.computeColocalization(channels, [1, 4, 0, 3, 0, 1], [(50, 255)] * 4, channelMasks=channelMasks)
+        result = ColocEngine.computeColocalization(channels, [1, 4, 0, 3, 0, 1], [(50, 255)] * 4)
+        self.assertEqual(cachedResult.channelVolumes, result.channelVolumes)
+        self.assertEqual(cachedResult.intersectionVolumes, result.intersectionVolumes)
+
+        # With a budget of two masks, the least recently used one is evicted.
+        channelCache = ChannelCache.ChannelCache(memoryBudget=2 * channelMasks[0].nbytes)
+        firstMask = channelCache.channelMask(0, channels[0], [1, 4, 0, 3, 0, 1], 50, 255)
+        channelCache.channelMask(1, channels[1], [1, 4, 0, 3, 0, 1], 50, 255)
+        channelCache.channelMask(2, channels[2], [1, 4, 0, 3, 0, 1], 50, 255)
+        self.assertIsNot(channelCache.channelMask(0, channels[0], [1, 4, 0, 3, 0, 1], 50, 255), firstMask)
+        self.assertLessEqual(channelCache.nbytes, channelCache.memoryBudget)
+        self.delayDisplay('Test passed!')
+
+    def test_PackedIntersections(self):
+        """
+        Check the intersection counts of bit-packed masks.
+        """
+        self.delayDisplay("Starting the packed intersections test")
+        channels = self.nestedChannels()
+        packedCounts = ColocEngine.packedIntersectionCounts([np.packbits(channelData.reshape(-1) > 50) for channelData in channels])
+        self.assertEqual(packedCounts[(0, 1)], 12)
+        self.assertEqual(packedCounts[(0, 1, 2, 3)], 4)
+        self.delayDisplay('Test passed!')
+
+    def test_Pyramid(self):
+        """
+        Check that the preview on the full-resolution level is exact, and the extents of the sampled levels.
+        """
+        self.delayDisplay("Starting the pyramid test")
+        pyramids = [Pyramid.ChannelPyramid(channelData) for channelData in self.nestedChannels()]
+        estimate = Pyramid.estimateColocalization(pyramids, None, [(50, 255)] * 4, factor=1)
+        self.assertEqual(estimate.channelVolume(1)[0], 12)
+        self.assertEqual(estimate.intersectionCoefficient()[0], 0.25)
+        self.assertEqual(Pyramid.levelExtent([1, 4, 0, 3, 0, 1], (1, 4, 4), 2), [1, 2, 0, 2, 0, 1])
+        self.delayDisplay('Test passed!')
+
+    def test_ThresholdSweep(self):
+        """
+        Check that the sweep builds the result of each grid point once, and that its rows and grids agree with the engine.
+        """
+        self.delayDisplay("Starting the threshold sweep test")
+        channels = self.nestedChannels()[:2]
+        sweep = ThresholdSweep.ThresholdSweep(channels, [[0, 50], [0, 50]], [255, 255])
+        results = sweep.results()
+        self.assertIs(sweep.results(), results)
+        self.assertIs(sweep.result((1, 1)), results[1, 1])
+        self.assertEqual(results[1, 1].channelVolumes, ColocEngine.computeColocalization(channels, None, [(50, 255)] * 2).channelVolumes)
+        self.assertEqual(len(sweep.rows(["Channel 1", "Channel 2"])), 4)
+        self.assertEqual(sweep.coefficientGrid('I')[1, 1], float(results[1, 1].intersectionCoefficients()[0]))
+        self.delayDisplay('Test passed!')
+
+    def test_SpreadsheetExport(self):
+        """
+        Check the sheets of the exported spreadsheet with one row per Venn region, shared with the benchmark.
+        """
+        self.delayDisplay("Starting the spreadsheet export test")
+        result = ColocEngine.computeColocalization(self.nestedChannels(), None, [(50, 255)] * 4)
+        sheets = SpreadsheetExport.regionStatisticsSheets(result, [(50, 255)] * 4, ["A", "B", "C", "D"], ["LPS", "", "", "", ""], "note", "chart.png")
+        self.assertEqual([sheetName for sheetName, content, header in sheets],
+                         ['Threshold Ranges', 'ROI Information', 'PCCs', 'Intersection Coefficients', 'Venn Regions', 'Venn Regions Chart', 'Annotation', 'Timestamp'])
+        sheets = dict((sheetName, content) for sheetName, content, header in sheets)
+        self.assertEqual(sheets['Threshold Ranges']['Threshold Ranges'], ['50~255'] * 4)
+        self.assertEqual(len(sheets['PCCs']['Channel Pairs']), 6)
+        self.assertEqual(sheets['Venn Regions']['Region Volume'], [volume for channels, volume, percentage in result.vennRegions()])
+        self.assertTrue(SpreadsheetExport.isImageSheet(sheets['Venn Regions Chart']))
+        self.assertFalse(SpreadsheetExport.isImageSheet([{'Segment': "Segment_1"}]))
+        self.assertEqual(sheets['Annotation'], {"Annotation": ["note"]})
+        self.delayDisplay('Test passed!')
+
+    def test_ResultCache(self):
+        """
+        Check that cached results and figures are restored, and that the size cap evicts the least recently used entries.
+        """
+        import tempfile
+        self.delayDisplay("Starting the result cache test")
+        channel1 = np.arange(32, dtype=np.uint16).reshape((2, 4, 4))
+        result = ColocEngine.computeColocalization([channel1, channel1[::-1]], None, [(5, 30), (5, 30)])
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache.ResultCache(os.path.join(directory, "cache"), maxBytes=1 << 20)
+            figureLocation = os.path.join(directory, "figure.png")
+            with open(figureLocation, 'wb') as figureFile:
+                figureFile.write(b'figure')
+            key = cache.key("file", [0, 1], [[5, 30], [5, 30]], [0, 4, 0, 4, 0, 2])
+            entry = cache.open(key)
+            self.assertFalse(entry.hit)
+            entry.addArtifact(figureLocation)
+            cache.store(entry, result)
+            os.remove(figureLocation)
+
+            entry = cache.open(key)
+            self.assertTrue(entry.hit)
+            self.assertEqual(entry.result.channelVolumes, result.channelVolumes)
+            self.assertEqual(entry.result.pearsonCoefficient(0, 1), result.pearsonCoefficient(0, 1))
+            self.assertTrue(entry.restoreArtifact(figureLocation))
+            self.assertTrue(os.path.exists(figureLocation))
+            self.assertFalse(cache.open(cache.key("file", [0, 2])).hit)
+
+            # With a cap smaller than one entry, storing another entry evicts the first one.
+            cache.maxBytes = 1
+            otherEntry = cache.open(cache.key("other file"))
+            cache.store(otherEntry, result)
+            self.assertFalse(cache.open(key).hit)
+            self.assertTrue(cache.open(cache.key("other file")).hit)
+        self.delayDisplay('Test passed!')
+
+    def test_Instrumentation(self):
+        """
+        Check that nested spans are reported in the order they started, with the memory they allocated.
+        """
+        self.delayDisplay("Starting the instrumentation test")
+        profiler = Instrumentation.Profiler(enabled=True)
+        with profiler.span("Ignored"):
+            pass
+        start = profiler.mark()
+        with profiler.span("Run"):
+            with profiler.span("Allocating"):
+                data = np.ones(1 << 20, dtype=np.uint8)
+            with profiler.span("Summing"):
+                self.assertEqual(int(data.sum()), 1 << 20)
+        del data
+        rows = profiler.report(start)
+        self.assertEqual([row['Stage'].strip() for row in rows], ["Run", "Allocating", "Summing"])
+        self.assertTrue(rows[1]['Stage'].startswith('    '))
+        self.assertGreaterEqual(rows[1]['Peak Memory (MiB)'], 1.0)
+        self.assertGreaterEqual(rows[0]['Peak Memory (MiB)'], rows[1]['Peak Memory (MiB)'])
+        self.assertGreaterEqual(rows[0]['Wall Time (s)'], rows[2]['Wall Time (s)'])
+
+        # Spans open at the same time on two threads have no peak memory; a later span alone has one again.
+        import threading
+        workerStarted = threading.Event()
+        mainDone = threading.Event()
+
+        def worker():
+            with profiler.span("Worker"):
+                workerStarted.set()
+                mainDone.wait(10)
+
+        workerThread = threading.Thread(target=worker, name="Worker thread")
+        workerThread.start()
+        workerStarted.wait(10)
+        overlapStart = profiler.mark()
+        with profiler.span("Main"):
+            pass
+        mainDone.set()
+        workerThread.join()
+        with profiler.span("Alone"):
+            pass
+        rows = dict((row['Stage'], row) for row in profiler.report(overlapStart))
+        self.assertIsNone(rows["Main"]['Peak Memory (MiB)'])
+        self.assertIsNone(rows["Worker"]['Peak Memory (MiB)'])
+        self.assertEqual(rows["Alone"]['Peak Memory (MiB)'], 0.0)
+        profiler.enabled = False
+        with profiler.span("Disabled"):
+            pass
+        self.assertEqual(len(profiler.report(overlapStart)), 3)
+        self.delayDisplay('Test passed!')
+
+    def test_ImageRegistry(self):
+        """
+        Check that the channel state of an image is found from its volumes and gives the selected channels.
+        """
+        self.delayDisplay("Starting the image registry test")
+        volumes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode") for channelIndex in range(3)]
+        images = ImageRegistry.ImageRegistry()
+        image = images.add(ImageRegistry.ImageState("image.tif", volumes, ["Channel 1", "Channel 2", "Channel 3"]))
+        self.assertEqual(images.channel(volumes[2].GetID()), (image, 2))
+        image.visible[:] = (True, False, True)
+        image.setThreshold(0, 10, 200)
+        image.setThreshold(2, 20, 100, 0, 255)
+        selectedVolumes, thresholds, colors, labels = image.selection()
+        self.assertEqual(selectedVolumes, [volumes[0], volumes[2]])
+        self.assertEqual(thresholds, [10.0, 200.0, 20.0, 100.0])
+        self.assertEqual(colors, [ImageRegistry.CHANNEL_COLORS[0], ImageRegistry.CHANNEL_COLORS[2]])
+        self.assertEqual(labels, ["Channel 1", "Channel 3"])
+
+        # The state saved in the parameter node restores the channel state, and so does the state of previous versions.
+        state = ImageRegistry.loadState(ImageRegistry.dumpState("Image", [("Image", "Note", image)]))
+        self.assertEqual((state['currentText'], state['images'][0]['annotation']), ("Image", "Note"))
+        restored = ImageRegistry.ImageState("image.tif", volumes, ["", "", ""])
+        restored.applyDict(state['images'][0])
+        self.assertEqual(restored.selection(), image.selection())
+        self.assertEqual(restored.thresholdBounds.tolist(), image.thresholdBounds.tolist())
+        with self.assertRaises(ValueError):
+            ImageRegistry.loadState('{"version": ' + str(ImageRegistry.STATE_VERSION + 1) + ', "images": []}')
+        parameters = {"Count": "1", "CurrentText": "Image", "ItemText0": "Image", "Filepath0": "image.tif", "InputVisibility0": "true",
+                      "Channel Count0": "1", "ChannelLabel0_0": "Channel 1", "Visibility0_0": "true", "LowerThreshold0_0": "10.0",
+                      "UpperThreshold0_0": "200.0", "LowerThresholdBound0_0": "0.0", "UpperThresholdBound0_0": "255.0"}
+        state = ImageRegistry.stateFromParameters(lambda name: parameters.get(name, ""))
+        self.assertEqual(state['images'][0]['channels'][0]['thresholds'], [10, 200])
+        self.assertTrue(all(ImageRegistry.LEGACY_PARAMETER_PATTERN.match(name) for name in parameters))
+        self.assertIsNone(ImageRegistry.LEGACY_PARAMETER_PATTERN.match("State"))
+
+        self.assertIs(images.remove("image.tif"), image)
+        self.assertEqual(images.channel(volumes[0].GetID()), (None, -1))
+        self.assertEqual(len(images), 0)
+        for volume in volumes:
+            slicer.mrmlScene.RemoveNode(volume)
+        self.delayDisplay('Test passed!')
+
+    def test_CompositeRendering(self):
+        """
+        Check that updating the composite for one channel gives the same volume as blending all channels again.
+        """
+        self.delayDisplay("Starting the composite rendering test")
+        channel1 = np.arange(240, dtype=np.uint8).reshape((4, 6, 10))
+        channel2 = channel1[::-1].copy()
+        red = CompositeRendering.colorFromHex('#ff0000')
+        green = CompositeRendering.colorFromHex('#00ff00')
+        composite = CompositeRendering.CompositeVolume(channel1.shape, 2, blockVoxels=60)
+        self.assertEqual(composite.update([('a', channel1, True, 10, 200, red), ('b', channel2, True, 10, 200, green)]), [0, 1])
+        self.assertEqual(composite.update([('a', channel1, True, 10, 200, red), ('b', channel2, True, 50, 100, green)]), [1])
+        self.assertEqual(composite.update([('a', channel1, True, 10, 200, red), ('b', channel2, True, 50, 100, green)]), [])
+        expected = CompositeRendering.CompositeVolume(channel1.shape, 2)
+        expected.update([('a', channel1, True, 10, 200, red), ('b', channel2, True, 50, 100, green)])
+        self.assertTrue(np.array_equal(composite.rgba, expected.rgba))
+        # Voxels outside the threshold ranges are transparent.
+        self.assertEqual(int(composite.rgba[0, 0, 0, 3]), 0)
+        composite.update([('a', channel1, False, 10, 200, red), ('b', channel2, False, 50, 100, green)])
+        self.assertEqual(int(composite.rgba.max()), 0)
+        self.delayDisplay('Test passed!')
+
+    def test_LoadedChannelSelection(self):
+        """
+        Check that the live ROI statistics keep the thresholds and labels of the loaded channels when a visible channel isn't loaded.
+        """
+        self.delayDisplay("Starting the loaded channel selection test")
+        volumes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode") for channelIndex in range(3)]
+        # A placeholder of lazy loading: its data is only decoded when it is displayed.
+        volumes[1].SetAttribute("ColocZStats.SourceFile", "image.tif")
+        image = ImageRegistry.ImageState("image.tif", volumes, ["Channel 1", "Channel 2", "Channel 3"])
+        image.visible[:] = True
+        for channelIndex in range(3):
+            image.setThreshold(channelIndex, 10 * (channelIndex + 1), 100 * (channelIndex + 1))
+        selectedVolumes, thresholdPairs, labels = ColocZStatsLogic().loadedChannelSelection(*image.selection())
+        self.assertEqual(selectedVolumes, [volumes[0], volumes[2]])
+        self.assertEqual(thresholdPairs, [(10.0, 100.0), (30.0, 300.0)])
+        self.assertEqual(labels, ["Channel 1", "Channel 3"])
+        for volume in volumes:
+            slicer.mrmlScene.RemoveNode(volume)
+        self.delayDisplay('Test passed!')
+
+    def test_IntegralVolume(self):
+        """
+        Check that the statistics of ROI boxes looked up from the summed-volume tables match the engine on the cropped arrays.
+        """
+        self.delayDisplay("Starting the integral volume test")
+        generator = np.random.default_rng(0)
+        base = generator.integers(0, 200, (6, 7, 9))
+        cropExtents = [[0, 9, 0, 7, 0, 6], [1, 8, 2, 6, 1, 5], [3, 4, 0, 7, 2, 3], [5, 5, 0, 7, 0, 6]]
+        for channelCount in (2, 3, 4):
+            channelArrays = [(base + generator.integers(0, 100, base.shape)).astype(np.uint16) for channel in range(channelCount)]
+            thresholdPairs = [(60 + 10 * channel, 250) for channel in range(channelCount)]
+            integralVolume = IntegralVolume.IntegralVolume(channelArrays, thresholdPairs)
+            for cropExtent in cropExtents:
+                result = integralVolume.result(cropExtent)
+                expected = ColocEngine.computeColocalization(channelArrays, cropExtent, thresholdPairs)
+                self.assertEqual(result.voxelCount, expected.voxelCount)
+                self.assertEqual(result.channelVolumes, expected.channelVolumes)
+                self.assertEqual(result.intersectionVolumes, expected.intersectionVolumes)
+                for channel1, channel2 in itertools.combinations(range(channelCount), 2):
+                    self.assertEqual(result.pearsonCoefficient(channel1, channel2), expected.pearsonCoefficient(channel1, channel2))
+        self.delayDisplay('Test passed!')
+
+    def test_ColocalizationByLabel(self):
+        """
+        Check that the per-label statistics of a label map match the engine on the crop extents of the labels.
+        """
+        self.delayDisplay("Starting the label map test")
+        generator = np.random.default_rng(1)
+        base = generator.integers(0, 200, (6, 7, 9))
+        channelArrays = [(base + generator.integers(0, 100, base.shape)).astype(np.uint16) for channel in range(3)]
+        thresholdPairs = [(60, 250), (70, 250), (80, 250)]
+        # Two boxes, given as crop extents [iMin, iMax, jMin, jMax, kMin, kMax].
+        labelExtents = {1: [0, 4, 0, 3, 0, 6], 2: [5, 9, 2, 7, 1, 4]}
+        labelArray = np.zeros(base.shape, dtype=np.int32)
+        for label, (iMin, iMax, jMin, jMax, kMin, kMax) in labelExtents.items():
+            labelArray[kMin:kMax, jMin:jMax, iMin:iMax] = label
+        results = ColocEngine.computeColocalizationByLabel(channelArrays, labelArray, thresholdPairs, blockVoxels=100)
+        self.assertEqual(sorted(results), [1, 2])
+        for label, cropExtent in labelExtents.items():
+            expected = ColocEngine.computeColocalization(channelArrays, cropExtent, thresholdPairs)
+            self.assertEqual(results[label].voxelCount, expected.voxelCount)
+            self.assertEqual(results[label].channelVolumes, expected.channelVolumes)
+            self.assertEqual(results[label].intersectionVolumes, expected.intersectionVolumes)
+            for channel1, channel2 in itertools.combinations(range(3), 2):
+                self.assertEqual(results[label].pearsonCoefficient(channel1, channel2), expected.pearsonCoefficient(channel1, channel2))
+        self.assertEqual(ColocEngine.computeColocalizationByLabel(channelArrays, np.zeros(base.shape, dtype=np.int32), thresholdPairs), dict())
+        self.delayDisplay('Test passed!')
+
+    def test_Batch(self):
+        """
+        Check that the batch CLI records failed files and skips the files of the manifest when it is run again.
+        """
+        import contextlib
+        import csv
+        import io
+        import json
+        import tempfile
+        from ColocZStatsLib import Batch
+        self.delayDisplay("Starting the batch test")
+        with tempfile.TemporaryDirectory() as directory:
+            for seed in range(2):
+                Benchmark.generateStack(os.path.join(directory, "stack" + str(seed) + ".tif"), (8, 8, 4), np.uint16, 2, seed=seed)
+            with open(os.path.join(directory, "broken.tif"), 'wb') as brokenFile:
+                brokenFile.write(b'not a TIFF file')
+            outputFile = os.path.join(directory, "results.csv")
+            arguments = [directory, '--channels', '1', '2', '--thresholds', '1000:65535', '1000:65535', '--output', outputFile, '--workers', '1']
+
+            def runBatch():
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    Batch.main(arguments)
+                with open(outputFile, newline='') as tableFile:
+                    return output.getvalue(), list(csv.DictReader(tableFile))
+
+            output, rows = runBatch()
+            self.assertIn("3 files, 0 already done, 3 to process.", output)
+            self.assertEqual([row['Image'] for row in rows], ["broken.tif", "stack0.tif", "stack1.tif"])
+            self.assertEqual([row['Status'] for row in rows], ['failed', 'done', 'done'])
+            self.assertTrue(rows[0]['Error'])
+            expected = TiffStreaming.computeColocalizationFromTiff(os.path.join(directory, "stack0.tif"), [0, 1], None, [(1000, 65535), (1000, 65535)])
+            self.assertEqual(int(rows[1]['Intersection Volume']), expected.intersectionVolume([0, 1]))
+            with open(outputFile + '.manifest.jsonl') as manifestFile:
+                self.assertEqual(sorted(json.loads(line)['status'] for line in manifestFile), ['done', 'done', 'failed'])
+
+            # Only the failed file is processed again.
+            output, rerunRows = runBatch()
+            self.assertIn("3 files, 2 already done, 1 to process.", output)
+            self.assertEqual(rerunRows, rows)
+        self.delayDisplay('Test passed!')
+
+    def test_BackgroundTask(self):
+        """
+        Check that a cancelled task stops at its next progress report, and that queued calls run on the polling thread.
+        """
+        import threading
+        self.delayDisplay("Starting the background task test")
+        callThreads = list()
+
+        def work(task, started):
+            task.setProgress("Computing", 0.5)
+            task.callOnMainThread(lambda: callThreads.append(threading.current_thread()))
+            started.set()
+            while True:
+                task.setProgress("Computing", 0.5)
+                time.sleep(0.001)
+
+        task = BackgroundTask.BackgroundTask(["Loading", "Computing"])
+        started = threading.Event()
+        task.start(work, task, started)
+        self.assertTrue(started.wait(10))
+        self.assertEqual(task.progress, 0.75)
+        self.assertEqual(callThreads, [])
+        self.assertFalse(task.poll())
+        self.assertEqual(callThreads, [threading.current_thread()])
+        task.cancel()
+        task.wait(10)
+        self.assertTrue(task.done and task.cancelled)
+        self.assertIsNone(task.error)
+        self.assertTrue(task.poll())
+        self.assertEqual(task.progress, 1.0)
+
+        # Errors of the worker are kept for the main thread; its queued calls still run.
+        def fail(task):
+            task.callOnMainThread(callThreads.append, None)
+            raise ValueError("failed")
+
+        task = BackgroundTask.BackgroundTask(["Computing"])
+        task.start(fail, task)
+        task.wait(10)
+        self.assertIsInstance(task.error, ValueError)
+        self.assertIn("ValueError", task.errorTraceback)
+        self.assertTrue(task.poll())
+        self.assertEqual(callThreads[-1], None)
+        self.delayDisplay('Test passed!')
+
+    def test_Dependencies(self):
+        """
+        Check that provisioning installs only the missing packages, once per session, and that backends are initialized once.
+        """
+        self.delayDisplay("Starting the dependencies test")
+        installed = list()
+        packages = [('json', 'json'), ('coloczstats_test_missing_package', 'coloczstats-test-missing-package')]
+        self.assertEqual(Dependencies.missingPackages(packages), [packages[1]])
+        self.assertEqual(Dependencies.provision(packages, installed.append), ['coloczstats-test-missing-package'])
+        self.assertEqual(installed, ['coloczstats-test-missing-package'])
+        self.assertEqual(Dependencies.provision(packages, installed.append), [])
+        self.assertEqual(installed, ['coloczstats-test-missing-package'])
+
+        calls = list()
+        for repetition in range(2):
+            Dependencies.initializeOnce('coloczstats test backend', lambda: calls.append(repetition))
+        self.assertEqual(calls, [0])
         self.delayDisplay('Test passed!')
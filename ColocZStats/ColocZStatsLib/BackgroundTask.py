@@ -0,0 +1,120 @@
+"""
+Run a long computation on a worker thread with staged progress and cancellation.
+
+The worker reports its stage through setProgress, which also raises TaskCancelled once the task was
+cancelled, and queues everything that must happen on the main thread (e.g. showing images) with
+callOnMainThread. The main thread calls poll periodically (e.g. from a QTimer) to run the queued calls
+and to read the progress, so this file doesn't depend on Qt.
+"""
+import collections
+import threading
+import traceback
+
+
+class TaskCancelled(Exception):
+    """
+    Raised in the worker thread when the task was cancelled.
+    """
+    pass
+
+
+class BackgroundTask(object):
+    """
+    A function running on a worker thread, going through a fixed list of named stages.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.stage = self.stages[0] if self.stages else ''
+        self.fraction = 0.0
+        self.result = None
+        self.error = None
+        self.errorTraceback = None
+        self.done = False
+        self._cancelEvent = threading.Event()
+        self._mainThreadCalls = collections.deque()
+        self._thread = None
+
+    @property
+    def cancelled(self):
+        return self._cancelEvent.is_set()
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    @property
+    def progress(self):
+        """
+        Overall progress between 0 and 1, each stage counting equally.
+        """
+        if self.done:
+            return 1.0
+        if self.stage not in self.stages:
+            return 0.0
+        return (self.stages.index(self.stage) + min(max(self.fraction, 0.0), 1.0)) / float(len(self.stages))
+
+    def start(self, function, *args):
+        """
+        Call function(*args) on a new worker thread.
+        """
+        self._thread = threading.Thread(target=self._run, args=(function, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, function, args):
+        try:
+            self.result = function(*args)
+        except TaskCancelled:
+            pass
+        except Exception as error:
+            self.error = error
+            self.errorTraceback = traceback.format_exc()
+        finally:
+            self.done = True
+
+    def cancel(self):
+        """
+        Ask the worker to stop at its next progress report.
+        """
+        self._cancelEvent.set()
+
+    def setProgress(self, stage, fraction=0.0):
+        """
+        Called from the worker: set the current stage and the completed fraction of that stage.
+        Raises TaskCancelled if the task was cancelled.
+        """
+        if self.cancelled:
+            raise TaskCancelled()
+        self.stage = stage
+        self.fraction = fraction
+
+    def callOnMainThread(self, function, *args):
+        """
+        Called from the worker: queue function(*args) to be called by the next poll on the main thread.
+        """
+        self._mainThreadCalls.append((function, args))
+
+    def discardMainThreadCalls(self):
+        """
+        Drop the queued calls, e.g. when the widgets they refer to are going away.
+        """
+        self._mainThreadCalls.clear()
+
+    def poll(self):
+        """
+        Called from the main thread: run the queued calls. Returns True once the worker has finished
+        and all its queued calls have been run.
+        """
+        done = self.done
+        while self._mainThreadCalls:
+            function, args = self._mainThreadCalls.popleft()
+            function(*args)
+        return done and not self._mainThreadCalls
+
+    def wait(self, timeout=None):
+        """
+        Wait for the worker thread to finish.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,285 @@
+"""
+Batch colocalization of many multi-channel Z-stack TIFF files, without the ColocZStats widget.
+
+The files are streamed slab by slab (see TiffStreaming) by a pool of worker processes, with a bounded
+number of files in flight. Every finished file is appended to a manifest (one JSON object per line), so
+an interrupted run that is started again with the same manifest skips the files that were already done.
+The results of all the files are written to one CSV table at the end, or to an xlsx spreadsheet (which
+needs pandas and xlsxwriter) if the output file name ends with .xlsx.
+
+Run it with plain Python:
+
+    python ColocZStatsLib/Batch.py "plate1/*.tif" --channels 1 2 --thresholds 100:4095 80:4095 --output plate1.csv
+
+or from 3D Slicer without its main window:
+
+    Slicer --no-main-window --python-script ColocZStatsLib/Batch.py plate1 --channels 1 2 --thresholds 100:4095 80:4095 --output plate1.csv
+"""
+import argparse
+import concurrent.futures
+import csv
+import glob
+import itertools
+import json
+import os
+import sys
+import time
+
+if __package__ in (None, ''):
+    # Run as a script: make the ColocZStatsLib package importable.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ColocZStatsLib import SpreadsheetExport, TiffStreaming
+
+# File name extensions of the images found in input directories.
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def findInputFiles(inputs, recursive=False):
+    """
+    TIFF files of a list of directories, glob patterns and file names, sorted and without duplicates.
+    """
+    filenames = list()
+    for path in inputs:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*') if recursive else os.path.join(path, '*')
+            candidates = glob.glob(pattern, recursive=recursive)
+        elif glob.has_magic(path):
+            candidates = glob.glob(path, recursive=recursive)
+        else:
+            candidates = [path]
+        filenames += [os.path.abspath(candidate) for candidate in candidates
+                      if os.path.isfile(candidate) and candidate.lower().endswith(TIFF_EXTENSIONS)]
+    return sorted(set(filenames))
+
+
+def parseThresholds(values):
+    """
+    Threshold pairs from "lower:upper" strings, one per channel.
+    """
+    thresholds = list()
+    for value in values:
+        lower, separator, upper = value.partition(':')
+        if not separator:
+            raise ValueError("Thresholds must be given as lower:upper, got " + value)
+        thresholds.append((float(lower), float(upper)))
+    return thresholds
+
+
+def fileSignature(filename):
+    """
+    Size and modification time of a file, to notice files that changed since they were processed.
+    """
+    status = os.stat(filename)
+    return [status.st_size, int(status.st_mtime)]
+
+
+class BatchManifest(object):
+    """
+    Append-only record of the files that were processed, with their result rows.
+    Entries of other parameters or of files that changed since are ignored.
+    """
+
+    def __init__(self, filename, parameters):
+        self.filename = filename
+        self.parameters = parameters
+        self.rows = dict()
+        if os.path.exists(filename):
+            with open(filename, 'r') as manifestFile:
+                for line in manifestFile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interruption.
+                        continue
+                    if entry.get('parameters') != parameters or entry.get('status') != 'done':
+                        continue
+                    self.rows[entry['file']] = (entry['signature'], entry['row'])
+
+    def isDone(self, filename):
+        if filename not in self.rows:
+            return False
+        try:
+            return self.rows[filename][0] == fileSignature(filename)
+        except OSError:
+            return False
+
+    def row(self, filename):
+        return self.rows[filename][1]
+
+    def record(self, filename, signature, status, row):
+        """
+        Append the outcome of a file; it is flushed right away so that it survives an interruption.
+        """
+        entry = {'file': filename, 'signature': signature, 'parameters': self.parameters, 'status': status, 'row': row}
+        with open(self.filename, 'a') as manifestFile:
+            manifestFile.write(json.dumps(entry) + '\n')
+            manifestFile.flush()
+            os.fsync(manifestFile.fileno())
+        if status == 'done':
+            self.rows[filename] = (signature, row)
+
+
+def resultRow(filename, result, channels, cropExtent):
+    """
+    One table row (dict) with the thresholds, volumes and coefficients of a file.
+    """
+    channelLabels = ['Channel ' + str(channel + 1) for channel in channels]
+    intersectionCoefficient, channelCoefficients = result.intersectionCoefficients()
+    row = {'Image': os.path.basename(filename), 'File': filename, 'Status': 'done', 'Error': ''}
+    row['ROI Extent'] = 'full volume' if cropExtent is None else ','.join(str(value) for value in cropExtent)
+    for channel, label in enumerate(channelLabels):
+        row[label + ' Threshold Range'] = str(result.thresholds[channel][0]) + '~' + str(result.thresholds[channel][1])
+    row['Voxel Count'] = result.voxelCount
+    for channel, label in enumerate(channelLabels):
+        row[label + ' Volume'] = result.channelVolumes[channel]
+    row['Intersection Volume'] = result.intersectionVolume(range(len(channels)))
+    row['Global Intersection Coefficient (I)'] = intersectionCoefficient
+    for channel in range(len(channels)):
+        row['i' + str(channel + 1)] = channelCoefficients[channel]
+    for channel1, channel2 in itertools.combinations(range(len(channels)), 2):
+        row['PCC ' + channelLabels[channel1] + ' and ' + channelLabels[channel2]] = result.pearsonCoefficient(channel1, channel2)
+    return row
+
+
+def processFile(filename, channels, thresholds, cropExtent, memoryBudget):
+    """
+    Compute the colocalization of one file; runs in a worker process.
+    Returns the file signature, the status and the result row.
+    """
+    signature = fileSignature(filename)
+    try:
+        result = TiffStreaming.computeColocalizationFromTiff(filename, channels, cropExtent, thresholds, memoryBudget)
+    except Exception as error:
+        row = {'Image': os.path.basename(filename), 'File': filename, 'Status': 'failed', 'Error': str(error)}
+        return signature, 'failed', row
+    return signature, 'done', resultRow(filename, result, channels, cropExtent)
+
+
+def runBatch(filenames, channels, thresholds, cropExtent=None, outputFile=None, manifestFile=None, workers=None,
+             maxInFlight=None, memoryBudget=TiffStreaming.DEFAULT_MEMORY_BUDGET, printFunction=print):
+    """
+    Compute the colocalization of the same channels, thresholds and crop extent in many TIFF files.
+
+    :param filenames: paths of the multi-channel Z-stack TIFF files.
+    :param channels: indices of the channels to analyse (0-based).
+    :param thresholds: list of (lower, upper) threshold pairs, one per channel.
+    :param cropExtent: voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax], or None for the whole stacks.
+    :param outputFile: path of the consolidated CSV table (or .xlsx spreadsheet), not written if None.
+    :param manifestFile: path of the manifest used to resume interrupted runs, outputFile + '.manifest.jsonl' by default.
+    :param workers: number of worker processes, the number of CPUs by default; 1 processes the files in this process.
+    :param maxInFlight: maximum number of files submitted to the workers at once, twice the number of workers by default.
+    :param memoryBudget: approximate number of bytes each worker may use for the slabs of one file.
+    :return: list of result rows, in the order of filenames.
+    """
+    if len(channels) != len(thresholds):
+        raise ValueError("One threshold pair is required for each channel.")
+    if len(channels) < 2:
+        raise ValueError("At least two channels are required.")
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    maxInFlight = max(1, int(maxInFlight or 2 * workers))
+
+    parameters = {'channels': list(channels), 'thresholds': [list(pair) for pair in thresholds],
+                  'cropExtent': None if cropExtent is None else list(cropExtent)}
+    if manifestFile is None and outputFile is not None:
+        manifestFile = outputFile + '.manifest.jsonl'
+    manifest = BatchManifest(manifestFile, parameters) if manifestFile else None
+
+    rows = dict()
+    pending = list()
+    for filename in filenames:
+        if manifest is not None and manifest.isDone(filename):
+            rows[filename] = manifest.row(filename)
+        else:
+            pending.append(filename)
+    printFunction(str(len(filenames)) + " files, " + str(len(filenames) - len(pending)) + " already done, " + str(len(pending)) + " to process.")
+
+    startTime = time.time()
+
+    def finish(filename, outcome):
+        signature, status, row = outcome
+        rows[filename] = row
+        if manifest is not None:
+            manifest.record(filename, signature, status, row)
+        message = "[" + str(len(rows)) + "/" + str(len(filenames)) + "] " + os.path.basename(filename) + ": " + status
+        if status != 'done':
+            message += " (" + row['Error'] + ")"
+        printFunction(message)
+
+    if workers == 1:
+        for filename in pending:
+            finish(filename, processFile(filename, channels, thresholds, cropExtent, memoryBudget))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            remaining = iter(pending)
+            inFlight = dict()
+            while True:
+                # Keep at most maxInFlight files submitted, so that long runs don't queue every file up front.
+                for filename in itertools.islice(remaining, maxInFlight - len(inFlight)):
+                    future = executor.submit(processFile, filename, channels, thresholds, cropExtent, memoryBudget)
+                    inFlight[future] = filename
+                if not inFlight:
+                    break
+                done, notDone = concurrent.futures.wait(inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    filename = inFlight.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as error:
+                        # The worker process itself failed (e.g. it ran out of memory).
+                        outcome = (None, 'failed', {'Image': os.path.basename(filename), 'File': filename, 'Status': 'failed', 'Error': str(error)})
+                    finish(filename, outcome)
+
+    printFunction("Processed " + str(len(pending)) + " files in " + format(time.time() - startTime, '.1f') + " s.")
+    orderedRows = [rows[filename] for filename in filenames]
+    if outputFile is not None:
+        writeResultTable(orderedRows, outputFile)
+        printFunction("Results saved to " + outputFile)
+    return orderedRows
+
+
+def writeResultTable(rows, outputFile):
+    """
+    Write result rows to a CSV table, with the union of their columns in order of first appearance.
+    An output file name ending with .xlsx is written as the Results sheet of a spreadsheet instead.
+    """
+    columns = list()
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+    if outputFile.lower().endswith('.xlsx'):
+        SpreadsheetExport.writeSpreadsheet(outputFile, [('Results', [dict((column, row.get(column, '')) for column in columns) for row in rows], True)])
+        return
+    with open(outputFile, 'w', newline='') as tableFile:
+        writer = csv.DictWriter(tableFile, fieldnames=columns, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch colocalization of multi-channel Z-stack TIFF files.")
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns or TIFF files")
+    parser.add_argument('--channels', nargs='+', type=int, required=True, help="channels to analyse, starting from 1")
+    parser.add_argument('--thresholds', nargs='+', required=True, help="lower:upper threshold range of each channel")
+    parser.add_argument('--roi', nargs=6, type=int, metavar=('IMIN', 'IMAX', 'JMIN', 'JMAX', 'KMIN', 'KMAX'),
+                        help="voxel crop extent (exclusive ends); the whole volume if omitted")
+    parser.add_argument('--output', required=True, help="consolidated CSV table, or xlsx spreadsheet if it ends with .xlsx")
+    parser.add_argument('--manifest', help="manifest of the finished files (default: OUTPUT.manifest.jsonl)")
+    parser.add_argument('--workers', type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--max-in-flight', type=int, help="maximum number of files submitted at once (default: twice the workers)")
+    parser.add_argument('--memory-budget', type=int, default=TiffStreaming.DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        help="memory budget per worker, in MiB")
+    parser.add_argument('--recursive', action='store_true', help="also search the subdirectories of input directories")
+    args = parser.parse_args(argv)
+
+    filenames = findInputFiles(args.inputs, args.recursive)
+    if not filenames:
+        parser.error("No TIFF files found.")
+    runBatch(filenames, [channel - 1 for channel in args.channels], parseThresholds(args.thresholds), args.roi,
+             args.output, args.manifest, args.workers, args.max_in_flight, args.memory_budget * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
+    if 'slicer' in sys.modules:
+        # Started with Slicer --python-script: the application keeps running unless it is asked to exit.
+        sys.modules['slicer'].util.exit()
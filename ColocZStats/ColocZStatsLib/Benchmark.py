@@ -0,0 +1,354 @@
+"""
+Benchmarks of the colocalization pipeline on synthetic multi-channel Z-stacks.
+
+generateStack writes a ZCYX TIFF whose channels have a controlled foreground fraction, overlap and
+intensity correlation. runBenchmark times each stage of the pipeline (loading, thresholding, intersection
+counting, PCC, 2D histogram plot and xlsx spreadsheet export, with the writer the module uses) over a matrix
+of stack sizes, checks the engine against the dense formulas ColocZStats used originally on the stacks that
+are small enough, and saves the timings as JSON so that the results of two versions can be compared with
+compareResults.
+
+Run it with plain Python:
+
+    python ColocZStatsLib/Benchmark.py --sizes 256x256x256 1024x1024x100 --channels 3 --output benchmark.json
+    python ColocZStatsLib/Benchmark.py --sizes 256x256x256 --output new.json --compare benchmark.json
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+if __package__ in (None, ''):
+    # Run as a script: make the ColocZStatsLib package importable.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ColocZStatsLib import ChannelCache, ColocEngine, Instrumentation, JointHistogram, SpreadsheetExport, TiffStreaming
+
+# Part of the JSON results; bump it when the stages or their meaning change.
+BENCHMARK_VERSION = 2
+
+# Stack sizes (width x height x depth) of the default size matrix.
+DEFAULT_SIZES = ('256x256x256', '512x512x512', '1024x1024x100', '2048x2048x300')
+
+# Stacks with more voxels are not checked against the dense formulas, which need several float64 copies.
+DEFAULT_CHECK_MAX_VOXELS = 1 << 24
+
+# Largest difference between the PCCs of the engine and of the dense formulas.
+PCC_TOLERANCE = 1e-6
+
+# Stages slower than the previous results by more than this fraction are reported as regressions.
+DEFAULT_REGRESSION_TOLERANCE = 0.1
+
+# Stages faster than this, in seconds, are not compared.
+DEFAULT_MINIMUM_TIME = 0.05
+
+
+def parseSize(text):
+    """
+    Shape (depth, height, width) of a "WIDTHxHEIGHTxDEPTH" string.
+    """
+    try:
+        width, height, depth = [int(value) for value in text.lower().split('x')]
+    except ValueError:
+        raise ValueError("Sizes must be given as WIDTHxHEIGHTxDEPTH, got " + text)
+    return depth, height, width
+
+
+def intensityRange(dtype):
+    """
+    Largest intensity of the synthetic stacks of a data type: the full range of integer types, 1 for floats.
+    """
+    dtype = np.dtype(dtype)
+    return float(np.iinfo(dtype).max) if np.issubdtype(dtype, np.integer) else 1.0
+
+
+def defaultThresholds(dtype, channelCount):
+    """
+    Threshold pairs that keep most of the foreground of the synthetic channels.
+    """
+    maximum = intensityRange(dtype)
+    return [(0.25 * maximum, maximum)] * channelCount
+
+
+def generateStack(filename, shape, dtype=np.uint16, channelCount=2, foreground=0.2, overlap=0.5, correlation=0.5, seed=0):
+    """
+    Write a synthetic multi-channel Z-stack TIFF with the axes ZCYX, one Z slice at a time.
+
+    Each voxel is in the foreground of a channel with probability foreground. With probability overlap,
+    a channel takes the foreground of a mask shared by all channels instead of its own, so overlap 0 gives
+    independent channels and overlap 1 identical foregrounds. Foreground intensities are normally
+    distributed around half of the intensity range, with a correlation between channels of about
+    correlation; background intensities are uniform in the lowest tenth of the range.
+
+    :param shape: (depth, height, width) of the stack.
+    :return: filename
+    """
+    import tifffile
+
+    depth, height, width = shape
+    dtype = np.dtype(dtype)
+    maximum = intensityRange(dtype)
+    correlation = min(max(float(correlation), -1.0), 1.0)
+    independence = math.sqrt(1.0 - correlation * correlation)
+    stackBytes = depth * channelCount * height * width * dtype.itemsize
+    stack = tifffile.memmap(filename, shape=(depth, channelCount, height, width), dtype=dtype,
+                            metadata={'axes': 'ZCYX'}, bigtiff=stackBytes > (1 << 31))
+    random = np.random.default_rng(seed)
+    for z in range(depth):
+        sharedMask = random.random((height, width), dtype=np.float32) < foreground
+        sharedSignal = random.standard_normal((height, width), dtype=np.float32)
+        for channel in range(channelCount):
+            ownMask = random.random((height, width), dtype=np.float32) < foreground
+            useShared = random.random((height, width), dtype=np.float32) < overlap
+            mask = np.where(useShared, sharedMask, ownMask)
+            signal = correlation * sharedSignal + independence * random.standard_normal((height, width), dtype=np.float32)
+            values = np.where(mask, maximum * (0.5 + 0.15 * signal), maximum * 0.1 * random.random((height, width), dtype=np.float32))
+            np.clip(values, 0, maximum, out=values)
+            stack[z, channel] = values.astype(dtype) if dtype.kind in 'iu' else values
+    stack.flush()
+    del stack
+    return filename
+
+
+def referenceStatistics(channelArrays, thresholds):
+    """
+    Channel volumes, intersection volumes and PCCs with the dense formulas that computeStatsForVolumes used
+    before the engine: float64 copies of the channels, the PCC computed over every voxel on the channel
+    values minus the lower threshold, set to 0 outside the threshold range.
+    """
+    masks = list()
+    pearsonVolumes = list()
+    for arrayData, (lowerThreshold, upperThreshold) in zip(channelArrays, thresholds):
+        arrayData = arrayData.astype(float)
+        masks.append(np.logical_and(arrayData > lowerThreshold, arrayData <= upperThreshold))
+        thresholded = np.where(arrayData > upperThreshold, 0, arrayData - lowerThreshold)
+        pearsonVolumes.append(np.where(thresholded < 0, 0, thresholded))
+    channelVolumes = [int(np.sum(mask)) for mask in masks]
+    intersectionVolumes = dict()
+    for size in range(2, len(masks) + 1):
+        for channels in itertools.combinations(range(len(masks)), size):
+            intersectionVolumes[channels] = int(np.sum(np.logical_and.reduce([masks[channel] for channel in channels])))
+    pearsonCoefficients = dict()
+    for channel1, channel2 in itertools.combinations(range(len(masks)), 2):
+        centered1 = pearsonVolumes[channel1] - np.average(pearsonVolumes[channel1])
+        centered2 = pearsonVolumes[channel2] - np.average(pearsonVolumes[channel2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pearsonCoefficients[(channel1, channel2)] = float(np.sum(centered1 * centered2) / (np.sqrt(np.sum(centered1 ** 2)) * np.sqrt(np.sum(centered2 ** 2))))
+    return channelVolumes, intersectionVolumes, pearsonCoefficients
+
+
+def checkAgreement(result, channelArrays, thresholds):
+    """
+    Compare a ColocResult with the dense formulas. Returns a dict with the outcome.
+    """
+    channelVolumes, intersectionVolumes, pearsonCoefficients = referenceStatistics(channelArrays, thresholds)
+    volumesMatch = list(result.channelVolumes) == channelVolumes and all(
+        result.intersectionVolume(channels) == volume for channels, volume in intersectionVolumes.items())
+    pccError = 0.0
+    for pair, value in pearsonCoefficients.items():
+        engineValue = result.pearsonCoefficients[pair]
+        if math.isnan(value) or math.isnan(engineValue):
+            pccError = max(pccError, 0.0 if math.isnan(value) and math.isnan(engineValue) else float('inf'))
+        else:
+            pccError = max(pccError, abs(value - engineValue))
+    return {'checked': True, 'volumesMatch': volumesMatch, 'maxPccError': pccError,
+            'passed': volumesMatch and pccError <= PCC_TOLERANCE}
+
+
+def benchmarkStack(filename, thresholds, outputDirectory, checkMaxVoxels=DEFAULT_CHECK_MAX_VOXELS, profiler=None):
+    """
+    Time the stages of the pipeline on one stack, the way the module runs them.
+
+    :return: dict of stage measurements (wall time, CPU time and peak memory) and the agreement check.
+    """
+    if profiler is None:
+        profiler = Instrumentation.Profiler(enabled=True)
+    stages = dict()
+
+    with profiler.span('load') as span:
+        with TiffStreaming.TiffChannelReader(filename) as reader:
+            channelArrays = [reader.readChannel(channel) for channel in range(len(thresholds))]
+    stages['load'] = span.toDict()
+
+    with profiler.span('threshold') as span:
+        channelMasks = [ChannelCache.ChannelMask(arrayData, *threshold) for arrayData, threshold in zip(channelArrays, thresholds)]
+    stages['threshold'] = span.toDict()
+
+    with profiler.span('intersection') as span:
+        ColocEngine.packedIntersectionCounts([channelMask.bits for channelMask in channelMasks])
+    stages['intersection'] = span.toDict()
+
+    # With the masks given, the engine only accumulates the terms that mix channels, i.e. the PCC sums.
+    with profiler.span('pcc') as span:
+        result = ColocEngine.computeColocalization(channelArrays, None, thresholds, channelMasks=channelMasks)
+    stages['pcc'] = span.toDict()
+
+    with profiler.span('streaming') as span:
+        TiffStreaming.computeColocalizationFromTiff(filename, list(range(len(thresholds))), None, thresholds)
+    stages['streaming'] = span.toDict()
+
+    histogramLocation = os.path.join(outputDirectory, 'benchmark 2D Histogram.png')
+    with profiler.span('plot') as span:
+        scatterHistogram = JointHistogram.ScatterHistogram(channelArrays[0], channelArrays[1], thresholds[0], thresholds[1], channelMasks=channelMasks[:2])
+        try:
+            JointHistogram.saveScatterHistogramImage(scatterHistogram, 'Channel 1', 'Channel 2', histogramLocation)
+            plotted = True
+        except ImportError:
+            # Without matplotlib only the histogram itself is computed; the stage isn't comparable.
+            plotted = False
+    stages['plot'] = span.toDict() if plotted else None
+
+    # The xlsx spreadsheet the module exports with one row per Venn region, with the 2D histogram as its chart.
+    with profiler.span('export') as span:
+        sheets = SpreadsheetExport.regionStatisticsSheets(result, thresholds, ['Channel ' + str(channel + 1) for channel in range(len(thresholds))],
+                                                          ['LPS', '', '', '', ''], '', histogramLocation if plotted else None)
+        try:
+            SpreadsheetExport.writeSpreadsheet(os.path.join(outputDirectory, 'benchmark Statistics.xlsx'), sheets)
+            exported = True
+        except ImportError:
+            # Without pandas or xlsxwriter nothing is written; the stage isn't comparable.
+            exported = False
+    stages['export'] = span.toDict() if exported else None
+
+    if channelArrays[0].size <= checkMaxVoxels:
+        agreement = checkAgreement(result, channelArrays, thresholds)
+    else:
+        agreement = {'checked': False}
+    return {'stages': stages, 'agreement': agreement}
+
+
+def runBenchmark(sizes=DEFAULT_SIZES, dtype=np.uint16, channelCount=2, foreground=0.2, overlap=0.5, correlation=0.5, seed=0,
+                 workDirectory=None, checkMaxVoxels=DEFAULT_CHECK_MAX_VOXELS, outputFile=None, printFunction=print):
+    """
+    Benchmark the pipeline on a synthetic stack of each size.
+
+    :param sizes: "WIDTHxHEIGHTxDEPTH" strings.
+    :param workDirectory: directory of the synthetic stacks and plots; stacks already generated with the same
+      parameters are reused. A temporary directory, removed afterwards, if None.
+    :param outputFile: path of the JSON results, not written if None.
+    :return: results dict.
+    """
+    dtype = np.dtype(dtype)
+    thresholds = defaultThresholds(dtype, channelCount)
+    results = {'version': BENCHMARK_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                            'system': platform.system(), 'cpuCount': os.cpu_count()},
+               'parameters': {'dtype': dtype.name, 'channels': channelCount, 'foreground': foreground, 'overlap': overlap,
+                              'correlation': correlation, 'seed': seed, 'thresholds': [list(pair) for pair in thresholds]},
+               'cases': list()}
+
+    temporaryDirectory = None
+    if workDirectory is None:
+        temporaryDirectory = tempfile.TemporaryDirectory()
+        workDirectory = temporaryDirectory.name
+    os.makedirs(workDirectory, exist_ok=True)
+    profiler = Instrumentation.Profiler(enabled=True)
+    try:
+        # Import the plotting library up front, so that its import time isn't part of the first plot stage.
+        import matplotlib.pyplot
+    except ImportError:
+        pass
+    try:
+        for size in sizes:
+            shape = parseSize(size)
+            filename = os.path.join(workDirectory, 'synthetic_' + size + '_' + dtype.name + '_c' + str(channelCount) + '_f' + str(foreground)
+                                    + '_o' + str(overlap) + '_r' + str(correlation) + '_s' + str(seed) + '.tif')
+            generationTime = None
+            if not os.path.exists(filename):
+                printFunction("Generating " + os.path.basename(filename))
+                startTime = time.perf_counter()
+                generateStack(filename, shape, dtype, channelCount, foreground, overlap, correlation, seed)
+                generationTime = time.perf_counter() - startTime
+            printFunction("Benchmarking " + size)
+            case = benchmarkStack(filename, thresholds, workDirectory, checkMaxVoxels, profiler)
+            case.update({'size': size, 'shape': list(shape), 'voxels': int(np.prod(shape)), 'generationTime': generationTime})
+            results['cases'].append(case)
+            for stage, measurement in case['stages'].items():
+                if measurement is not None:
+                    printFunction("  " + stage + ": " + format(measurement['wallTime'], '.3f') + " s")
+            if case['agreement']['checked']:
+                printFunction("  agreement with the dense formulas: " + ("passed" if case['agreement']['passed'] else "FAILED"))
+    finally:
+        if temporaryDirectory is not None:
+            temporaryDirectory.cleanup()
+
+    if outputFile is not None:
+        with open(outputFile, 'w') as resultsFile:
+            json.dump(results, resultsFile, indent=2)
+        printFunction("Results saved to " + outputFile)
+    return results
+
+
+def compareResults(previous, current, tolerance=DEFAULT_REGRESSION_TOLERANCE, minimumTime=DEFAULT_MINIMUM_TIME):
+    """
+    Stages of the cases of the current results that are slower than in the previous results by more than tolerance.
+    Stages shorter than minimumTime seconds are ignored, their timings are mostly noise.
+    Returns a list of (size, stage, previous wall time, current wall time).
+    """
+    previousCases = dict((case['size'], case) for case in previous.get('cases', []))
+    regressions = list()
+    for case in current.get('cases', []):
+        previousCase = previousCases.get(case['size'])
+        if previousCase is None:
+            continue
+        for stage, measurement in case['stages'].items():
+            previousMeasurement = previousCase['stages'].get(stage)
+            if measurement is None or previousMeasurement is None:
+                continue
+            if measurement['wallTime'] < minimumTime:
+                continue
+            if measurement['wallTime'] > previousMeasurement['wallTime'] * (1.0 + tolerance):
+                regressions.append((case['size'], stage, previousMeasurement['wallTime'], measurement['wallTime']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the colocalization pipeline on synthetic multi-channel Z-stacks.")
+    parser.add_argument('--sizes', nargs='+', default=list(DEFAULT_SIZES), help="stack sizes as WIDTHxHEIGHTxDEPTH")
+    parser.add_argument('--dtype', default='uint16', help="voxel type of the stacks (default: uint16)")
+    parser.add_argument('--channels', type=int, default=2, help="number of channels (default: 2)")
+    parser.add_argument('--foreground', type=float, default=0.2, help="fraction of foreground voxels of each channel")
+    parser.add_argument('--overlap', type=float, default=0.5, help="probability that a channel uses the shared foreground")
+    parser.add_argument('--correlation', type=float, default=0.5, help="correlation of the foreground intensities")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    parser.add_argument('--work-directory', help="directory keeping the synthetic stacks between runs (default: a temporary directory)")
+    parser.add_argument('--check-max-voxels', type=int, default=DEFAULT_CHECK_MAX_VOXELS,
+                        help="largest stack checked against the dense formulas")
+    parser.add_argument('--output', help="JSON results")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_REGRESSION_TOLERANCE,
+                        help="slowdown reported as a regression, as a fraction (default: 0.1)")
+    args = parser.parse_args(argv)
+    if args.channels < 2:
+        parser.error("At least two channels are required.")
+
+    results = runBenchmark(args.sizes, args.dtype, args.channels, args.foreground, args.overlap, args.correlation, args.seed,
+                           args.work_directory, args.check_max_voxels, args.output)
+    failed = [case['size'] for case in results['cases'] if case['agreement']['checked'] and not case['agreement']['passed']]
+    if args.compare:
+        with open(args.compare, 'r') as previousFile:
+            previous = json.load(previousFile)
+        if previous.get('version') != results['version'] or previous.get('parameters') != results['parameters']:
+            print("Warning: the previous results were obtained with other stages or parameters.")
+        regressions = compareResults(previous, results, args.tolerance)
+        for size, stage, previousTime, currentTime in regressions:
+            print("Regression: " + size + " " + stage + " " + format(previousTime, '.3f') + " s -> " + format(currentTime, '.3f') + " s")
+        if not regressions:
+            print("No regressions.")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exitCode = main()
+    if 'slicer' in sys.modules:
+        # Started with Slicer --python-script: the application keeps running unless it is asked to exit.
+        sys.modules['slicer'].util.exit(exitCode)
+    else:
+        sys.exit(exitCode)
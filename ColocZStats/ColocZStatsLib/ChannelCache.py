@@ -0,0 +1,109 @@
+"""
+In-memory cache of the thresholded masks of single channels.
+
+A ChannelMask holds the mask of one cropped channel for one threshold range, packed to one bit per voxel,
+together with the per-channel sums of ColocMoments (count, sum x and sum x^2 over the mask). When only the
+threshold of one channel changes, the other channels are taken from the cache and only the terms that mix
+channels are accumulated again. The cropped data itself is not cached: cropping is a view of the channel
+array and never copies it.
+"""
+import collections
+import threading
+
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Default maximum size of the cached masks, in bytes.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class ChannelMask(object):
+    """
+    Bit-packed thresholded mask of a cropped channel (kji order, C-ordered bits) and the channel sums over it.
+    """
+
+    def __init__(self, croppedArray, lowerThreshold, upperThreshold, blockVoxels=ColocEngine.DEFAULT_BLOCK_VOXELS):
+        self.shape = croppedArray.shape
+        self.threshold = (float(lowerThreshold), float(upperThreshold))
+        self.exact = np.issubdtype(croppedArray.dtype, np.integer) and croppedArray.dtype.itemsize <= 2
+        self.count = 0
+        self.sum = 0
+        self.squareSum = 0
+
+        packedChunks = list()
+        # Bits of the previous slab that didn't fill a whole byte.
+        carry = np.zeros(0, dtype=bool)
+        for slab in ColocEngine.iterateSlabs(self.shape, blockVoxels):
+            block = croppedArray[slab]
+            mask = ColocEngine.nativeThresholdMask(block, *self.threshold)
+            values = block.astype(np.int64 if self.exact else np.float64)
+            self.count += int(np.count_nonzero(mask))
+            self.sum += ColocEngine.toPythonNumber(np.sum(values, where=mask))
+            self.squareSum += ColocEngine.toPythonNumber(np.sum(values * values, where=mask))
+            bits = np.concatenate((carry, mask.reshape(-1)))
+            wholeBytes = len(bits) // 8 * 8
+            packedChunks.append(np.packbits(bits[:wholeBytes]))
+            carry = bits[wholeBytes:]
+        packedChunks.append(np.packbits(carry))
+        self.bits = np.concatenate(packedChunks)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def slabMask(self, slab):
+        """
+        Boolean mask of a slab of whole K slices.
+        """
+        sliceVoxels = self.shape[1] * self.shape[2]
+        start = slab.start * sliceVoxels
+        stop = slab.stop * sliceVoxels
+        byteStart = start // 8
+        bits = np.unpackbits(self.bits[byteStart:(stop + 7) // 8])[start - byteStart * 8:stop - byteStart * 8]
+        return bits.view(bool).reshape((slab.stop - slab.start,) + tuple(self.shape[1:]))
+
+
+class ChannelCache(object):
+    """
+    Least recently used ChannelMasks, keyed by (channel key, crop extent, threshold range), within a memory budget.
+    The channel key identifies the channel data, e.g. the volume node ID and the modification time of its image data.
+    """
+
+    def __init__(self, memoryBudget=DEFAULT_MEMORY_BUDGET):
+        self.memoryBudget = int(memoryBudget)
+        self._masks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(mask.nbytes for mask in self._masks.values())
+
+    def channelMask(self, channelKey, arrayData, cropExtent, lowerThreshold, upperThreshold):
+        """
+        Mask of a channel cropped to a crop extent for a threshold range, thresholded only if it isn't cached.
+        """
+        key = (channelKey, None if cropExtent is None else tuple(int(value) for value in cropExtent),
+               float(lowerThreshold), float(upperThreshold))
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+        mask = ChannelMask(ColocEngine.cropArray(arrayData, cropExtent), lowerThreshold, upperThreshold)
+        with self._lock:
+            if mask.nbytes <= self.memoryBudget:
+                self._masks[key] = mask
+                self._evict()
+        return mask
+
+    def _evict(self):
+        totalBytes = sum(mask.nbytes for mask in self._masks.values())
+        while totalBytes > self.memoryBudget and self._masks:
+            key, mask = self._masks.popitem(last=False)
+            totalBytes -= mask.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
@@ -0,0 +1,604 @@
+"""
+Colocalization engine working on plain NumPy arrays.
+
+The functions in this file contain all the math that ColocZStatsLogic.computeStatsForVolumes
+used to do inline: cropping the channels to the ROI extent, thresholding them, counting the
+voxels of each channel and of their intersections, and computing the Pearson correlation
+coefficient of each channel pair. The result is returned as a ColocResult object, which also
+derives the Venn diagram percentages and the intersection coefficients (I, i1, i2, i3).
+"""
+import itertools
+import math
+from decimal import Decimal
+
+import numpy as np
+
+
+def formatCoefficient(value):
+    """
+    Format a coefficient the way it is shown in the Venn diagram and in the spreadsheet.
+    """
+    if value is None or math.isnan(float(value)):
+        return '0.0000'
+    return format(float(value), '.4f')
+
+
+def cropArray(arrayData, cropExtent):
+    """
+    Crop volume data to a voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax].
+    Note that numpy array index order is kji, not ijk.
+    """
+    if cropExtent is None:
+        return arrayData
+    cropExtent = [max(0, int(value)) for value in cropExtent]
+    return arrayData[cropExtent[4]: cropExtent[5], cropExtent[2]: cropExtent[3], cropExtent[0]: cropExtent[1]]
+
+
+def thresholdMask(arrayData, lowerThreshold, upperThreshold):
+    """
+    Voxels that are considered to have some interesting signal for the given threshold range.
+    """
+    return np.logical_and(arrayData > lowerThreshold, arrayData <= upperThreshold)
+
+
+def nativeThresholdMask(block, lowerThreshold, upperThreshold):
+    """
+    Same as thresholdMask, but integer data is compared without leaving its native dtype.
+    """
+    if np.issubdtype(block.dtype, np.integer):
+        bounds = nativeThresholdBounds(block.dtype, lowerThreshold, upperThreshold)
+        if bounds is None:
+            return np.zeros(block.shape, dtype=bool)
+        mask = block >= bounds[0]
+        mask &= block <= bounds[1]
+        return mask
+    return thresholdMask(block, lowerThreshold, upperThreshold)
+
+
+class ColocResult(object):
+    """
+    Colocalization statistics of the thresholded channels within one crop extent.
+
+    Channel subsets are referred to by tuples of channel indices in ascending order, e.g. (0, 2).
+    Venn regions are referred to by bit codes, where bit c is set when the region belongs to channel c,
+    which is also the order of the subsets expected by matplotlib_venn.
+    """
+
+    def __init__(self, thresholds, voxelCount, channelVolumes, intersectionVolumes, pearsonCoefficients):
+        # List of (lower, upper) threshold pairs, one per channel.
+        self.thresholds = list(thresholds)
+        # Number of voxels within the crop extent.
+        self.voxelCount = int(voxelCount)
+        # Number of thresholded voxels of each channel.
+        self.channelVolumes = [int(volume) for volume in channelVolumes]
+        # Number of voxels within the threshold range of all channels of a subset (2 channels or more).
+        self.intersectionVolumes = {tuple(channels): int(volume) for channels, volume in intersectionVolumes.items()}
+        # Pearson correlation coefficient of each channel pair (NaN if undefined).
+        self.pearsonCoefficients = dict(pearsonCoefficients)
+
+    @property
+    def channelCount(self):
+        return len(self.channelVolumes)
+
+    def intersectionVolume(self, channels):
+        """
+        Number of voxels within the threshold range of every channel in the given subset.
+        """
+        channels = tuple(sorted(channels))
+        if len(channels) == 1:
+            return self.channelVolumes[channels[0]]
+        return self.intersectionVolumes[channels]
+
+    def pearsonCoefficient(self, channel1, channel2):
+        """
+        Pearson correlation coefficient of a channel pair, formatted with four decimals.
+        """
+        return formatCoefficient(self.pearsonCoefficients[tuple(sorted((channel1, channel2)))])
+
+    def exclusiveRegionVolumes(self):
+        """
+        Number of voxels of each Venn region, indexed by region bit code (index 0 is unused).
+        Derived from the intersection volumes by inclusion-exclusion.
+        """
+        channelCount = self.channelCount
+        regionVolumes = [0] * (1 << channelCount)
+        for code in range(1, 1 << channelCount):
+            regionVolumes[code] = self.intersectionVolume([channel for channel in range(channelCount) if code >> channel & 1])
+        # Inverse of the superset sums: remove from each intersection the voxels that also belong to another channel.
+        for channel in range(channelCount):
+            for code in range(1, 1 << channelCount):
+                if not code >> channel & 1:
+                    regionVolumes[code] -= regionVolumes[code | 1 << channel]
+        return regionVolumes
+
+    def vennRegions(self, percentages=None):
+        """
+        One (channels, volume, percentage) tuple per Venn region, in matplotlib_venn subset order.
+        Works for any number of channels; the percentage is None if there are no thresholded voxels.
+        """
+        if percentages is None:
+            percentages = self.vennPercentages()
+        regionVolumes = self.exclusiveRegionVolumes()
+        regions = list()
+        for code in range(1, 1 << self.channelCount):
+            channels = tuple(channel for channel in range(self.channelCount) if code >> channel & 1)
+            regions.append((channels, regionVolumes[code], percentages[code - 1] if percentages is not None else None))
+        return regions
+
+    def unionVolume(self):
+        """
+        Number of voxels that are within the threshold range of at least one channel.
+        """
+        return sum(self.exclusiveRegionVolumes())
+
+    def vennPercentages(self):
+        """
+        Volume percentage of each Venn region in matplotlib_venn subset order, as Decimals with four decimals.
+        The largest region absorbs the rounding error so that the percentages add up to exactly 100.
+        Returns None if there are no thresholded voxels.
+        """
+        regionVolumes = self.exclusiveRegionVolumes()[1:]
+        totalVolume = Decimal(str(sum(regionVolumes)))
+        if not float(totalVolume) > 0:
+            return None
+
+        results = [Decimal(format(float((Decimal(str(volume)) / totalVolume) * Decimal('100.0000')), '.4f')) for volume in regionVolumes]
+        others = list(results)
+        others.remove(max(others))
+        results[results.index(max(results))] = Decimal('100.0000') - sum(others)
+        return results
+
+    def subsetPercentage(self, channels, percentages=None):
+        """
+        Volume percentage of the intersection of the given channels (sum of the Venn regions they share).
+        """
+        if percentages is None:
+            percentages = self.vennPercentages()
+        mask = 0
+        for channel in channels:
+            mask |= 1 << channel
+        return sum(percentage for code, percentage in enumerate(percentages, 1) if code & mask == mask)
+
+    def intersectionCoefficients(self, percentages=None):
+        """
+        Global intersection coefficient I and the per-channel coefficients i1, i2, (i3), formatted with four decimals.
+        """
+        if percentages is None:
+            percentages = self.vennPercentages()
+        if percentages is None:
+            return '0.0000', ['0.0000'] * self.channelCount
+
+        allChannelsPercentage = format(float(percentages[-1]), '.4f')
+        intersectionCoefficient = format(float(Decimal(allChannelsPercentage) * Decimal('0.01')), '.4f')
+
+        allChannelsVolume = Decimal(str(self.intersectionVolume(range(self.channelCount))))
+        channelCoefficients = list()
+        for channelVolume in self.channelVolumes:
+            if channelVolume == 0:
+                channelCoefficients.append('0.0000')
+            else:
+                channelCoefficients.append(format(float(allChannelsVolume / Decimal(str(channelVolume))), '.4f'))
+        return intersectionCoefficient, channelCoefficients
+
+
+def nativeThresholdBounds(dtype, lowerThreshold, upperThreshold):
+    """
+    Convert a threshold range (lower, upper] into inclusive bounds [low, high] that can be compared
+    directly with voxels of the given integer dtype, so the data never has to be cast to float.
+    Returns None if no voxel of that dtype can be within the range.
+    """
+    info = np.iinfo(dtype)
+    low = max(int(math.floor(lowerThreshold)) + 1, int(info.min))
+    high = min(int(math.floor(upperThreshold)), int(info.max))
+    if low > high:
+        return None
+    return dtype.type(low), dtype.type(high)
+
+
+class ColocMoments(object):
+    """
+    Streaming accumulator of the raw sums needed for the colocalization statistics.
+
+    For each channel c with mask m_c (voxels within its threshold range) and intensity x_c it keeps
+    count(m_c), sum(x_c * m_c) and sum(x_c^2 * m_c); for each channel pair (a, b) it keeps
+    count(m_a & m_b), sum(x_a * m_a & m_b), sum(x_b * m_a & m_b) and sum(x_a * x_b * m_a & m_b);
+    and for every larger channel subset the count of the intersection of the masks, which comes from a
+    single bincount of the per-voxel Venn region codes.
+    Those sums are enough to reproduce the thresholded Pearson correlation coefficients exactly.
+    Blocks are accumulated in the native dtype of the data, and accumulators can be merged,
+    so the same kernel serves in-memory, slab-streamed and parallel computations.
+    """
+
+    def __init__(self, thresholds):
+        self.thresholds = [(float(lower), float(upper)) for lower, upper in thresholds]
+        channelCount = len(self.thresholds)
+        self.voxelCount = 0
+        self.channelCounts = [0] * channelCount
+        self.channelSums = [0] * channelCount
+        self.channelSquareSums = [0] * channelCount
+        self.pairCounts = dict()
+        self.pairSums = dict()
+        self.pairProducts = dict()
+        for pair in itertools.combinations(range(channelCount), 2):
+            self.pairCounts[pair] = 0
+            self.pairSums[pair] = (0, 0)
+            self.pairProducts[pair] = 0
+        self.subsetCounts = dict()
+        for subsetSize in range(3, channelCount + 1):
+            for channels in itertools.combinations(range(channelCount), subsetSize):
+                self.subsetCounts[channels] = 0
+        # Sums are exact integers as long as only integer data was accumulated.
+        self.exact = True
+
+    @property
+    def channelCount(self):
+        return len(self.thresholds)
+
+    def channelMask(self, channel, block):
+        """
+        Thresholded mask of one channel block, computed without leaving the native dtype.
+        """
+        return nativeThresholdMask(block, *self.thresholds[channel])
+
+    def accumulate(self, blocks, masks=None, channelSums=True, intersectionCounts=True):
+        """
+        Add one block (e.g. a Z-slab) of every channel. All blocks must have the same shape.
+        The thresholded masks of the blocks can be given if they are already known (e.g. cached). Without the
+        per-channel sums (channelSums False) or the intersection counts (intersectionCounts False), those terms
+        are left for the caller to fill in, e.g. from bit-packed masks.
+        """
+        if len(blocks) != self.channelCount:
+            raise ValueError("One block is required for each channel.")
+        self.voxelCount += blocks[0].size
+
+        if masks is None:
+            masks = [self.channelMask(channel, block) for channel, block in enumerate(blocks)]
+        values = list()
+        for channel, block in enumerate(blocks):
+            mask = masks[channel]
+            if np.issubdtype(block.dtype, np.integer) and block.dtype.itemsize <= 2:
+                # Squares of 16-bit values and their sums over a block fit easily into int64.
+                block = block.astype(np.int64)
+            else:
+                block = block.astype(np.float64)
+                self.exact = False
+            values.append(block)
+            if channelSums:
+                self.channelCounts[channel] += int(np.count_nonzero(mask))
+                self.channelSums[channel] += toPythonNumber(np.sum(block, where=mask))
+                self.channelSquareSums[channel] += toPythonNumber(np.sum(block * block, where=mask))
+
+        for pair in self.pairCounts:
+            channel1, channel2 = pair
+            pairMask = masks[channel1] & masks[channel2]
+            if intersectionCounts:
+                self.pairCounts[pair] += int(np.count_nonzero(pairMask))
+            sum1, sum2 = self.pairSums[pair]
+            self.pairSums[pair] = (sum1 + toPythonNumber(np.sum(values[channel1], where=pairMask)),
+                                   sum2 + toPythonNumber(np.sum(values[channel2], where=pairMask)))
+            self.pairProducts[pair] += toPythonNumber(np.sum(values[channel1] * values[channel2], where=pairMask))
+
+        if self.subsetCounts and intersectionCounts:
+            # One bincount of the region codes gives every Venn region, and from them every intersection.
+            intersectionCounts = supersetSums(np.bincount(regionCodes(masks).reshape(-1), minlength=1 << self.channelCount))
+            for channels in self.subsetCounts:
+                self.subsetCounts[channels] += int(intersectionCounts[channelCode(channels)])
+
+    def merge(self, other):
+        """
+        Add the sums of another accumulator with the same thresholds (e.g. from another slab or worker).
+        """
+        if other.thresholds != self.thresholds:
+            raise ValueError("Cannot merge moments computed with different thresholds.")
+        self.voxelCount += other.voxelCount
+        for channel in range(self.channelCount):
+            self.channelCounts[channel] += other.channelCounts[channel]
+            self.channelSums[channel] += other.channelSums[channel]
+            self.channelSquareSums[channel] += other.channelSquareSums[channel]
+        for pair in self.pairCounts:
+            self.pairCounts[pair] += other.pairCounts[pair]
+            self.pairSums[pair] = (self.pairSums[pair][0] + other.pairSums[pair][0], self.pairSums[pair][1] + other.pairSums[pair][1])
+            self.pairProducts[pair] += other.pairProducts[pair]
+        for channels in self.subsetCounts:
+            self.subsetCounts[channels] += other.subsetCounts[channels]
+        self.exact = self.exact and other.exact
+        return self
+
+    def pearsonCoefficient(self, channel1, channel2):
+        """
+        Pearson correlation coefficient of the thresholded channels (x - lower where lower < x <= upper, 0 elsewhere).
+        Returns NaN if one of the thresholded channels is constant.
+        """
+        number = _fraction if self.exact else float
+        voxelCount = number(self.voxelCount)
+        if voxelCount == 0:
+            return float('nan')
+        lower1 = number(self.thresholds[channel1][0])
+        lower2 = number(self.thresholds[channel2][0])
+
+        # Sums of the thresholded values, their squares and their products, expanded from the raw sums.
+        sum1 = number(self.channelSums[channel1]) - lower1 * self.channelCounts[channel1]
+        sum2 = number(self.channelSums[channel2]) - lower2 * self.channelCounts[channel2]
+        squareSum1 = number(self.channelSquareSums[channel1]) - 2 * lower1 * self.channelSums[channel1] + lower1 * lower1 * self.channelCounts[channel1]
+        squareSum2 = number(self.channelSquareSums[channel2]) - 2 * lower2 * self.channelSums[channel2] + lower2 * lower2 * self.channelCounts[channel2]
+        pairSum1, pairSum2 = self.pairSums[(channel1, channel2)]
+        productSum = (number(self.pairProducts[(channel1, channel2)]) - lower2 * pairSum1 - lower1 * pairSum2
+                      + lower1 * lower2 * self.pairCounts[(channel1, channel2)])
+
+        covariance = productSum - sum1 * sum2 / voxelCount
+        variance1 = squareSum1 - sum1 * sum1 / voxelCount
+        variance2 = squareSum2 - sum2 * sum2 / voxelCount
+        if variance1 <= 0 or variance2 <= 0:
+            return float('nan')
+        return float(covariance) / (math.sqrt(float(variance1)) * math.sqrt(float(variance2)))
+
+    def toResult(self):
+        """
+        Convert the accumulated sums into a ColocResult.
+        """
+        intersectionVolumes = dict(self.pairCounts)
+        intersectionVolumes.update(self.subsetCounts)
+        pearsonCoefficients = dict()
+        for pair in self.pairCounts:
+            pearsonCoefficients[pair] = self.pearsonCoefficient(*pair)
+        return ColocResult(self.thresholds, self.voxelCount, self.channelCounts, intersectionVolumes, pearsonCoefficients)
+
+
+def channelCode(channels):
+    """
+    Venn region bit code of a channel subset (bit c is set for channel c).
+    """
+    code = 0
+    for channel in channels:
+        code |= 1 << channel
+    return code
+
+
+def regionCodes(masks):
+    """
+    Pack the thresholded masks of the channels into one small integer per voxel: the bit code of its Venn region
+    (0 for voxels outside every threshold range).
+    """
+    codeDtype = np.uint8 if len(masks) <= 8 else np.uint16 if len(masks) <= 16 else np.uint32
+    codes = np.zeros(masks[0].shape, dtype=codeDtype)
+    for channel, mask in enumerate(masks):
+        codes |= mask.astype(codeDtype) << codeDtype(channel)
+    return codes
+
+
+def supersetSums(regionCounts):
+    """
+    Turn per-region counts (indexed by bit code) into intersection counts: entry c becomes the number of voxels
+    whose region contains all the channels of c, i.e. the sum over every region code that is a superset of c.
+    """
+    sums = np.array(regionCounts, dtype=np.int64)
+    channelCount = max(0, len(sums) - 1).bit_length()
+    codes = np.arange(len(sums))
+    for channel in range(channelCount):
+        withoutChannel = codes[(codes >> channel & 1) == 0]
+        sums[withoutChannel] += sums[withoutChannel | (1 << channel)]
+    return sums
+
+
+# Bytes of each bit-packed mask that are combined at once; small enough for the chunks of all the channel
+# subsets to stay in the CPU cache.
+PACKED_CHUNK_BYTES = 1 << 15
+
+# Number of set bits of every byte value.
+_BYTE_POPCOUNTS = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def popcount(packedBits):
+    """
+    Number of set bits in a uint8 array of packed bits.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packedBits).sum(dtype=np.int64))
+    return int(_BYTE_POPCOUNTS[packedBits].sum(dtype=np.int64))
+
+
+def packedIntersectionCounts(packedMasks, chunkBytes=PACKED_CHUNK_BYTES):
+    """
+    Count the voxels in the intersection of every subset of 2 or more channels, from the bit-packed masks of the
+    channels (uint8 arrays of the same length, e.g. from np.packbits) with AND and population counts.
+    Returns a dict from the channel subset (sorted tuple) to the count.
+    """
+    channelCount = len(packedMasks)
+    codes = [code for code in range(1, 1 << channelCount) if bin(code).count('1') >= 2]
+    counts = dict((code, 0) for code in codes)
+    for start in range(0, len(packedMasks[0]), chunkBytes):
+        # Intersection of a subset = intersection of the subset without its highest channel & that channel.
+        chunks = dict((1 << channel, packedMask[start:start + chunkBytes]) for channel, packedMask in enumerate(packedMasks))
+        for code in codes:
+            highestChannelCode = 1 << (code.bit_length() - 1)
+            chunks[code] = chunks[code ^ highestChannelCode] & chunks[highestChannelCode]
+            counts[code] += popcount(chunks[code])
+    return dict((tuple(channel for channel in range(channelCount) if code >> channel & 1), count) for code, count in counts.items())
+
+
+def toPythonNumber(value):
+    """
+    Convert a numpy sum into a Python number so that the accumulated sums never overflow.
+    """
+    return int(value) if np.issubdtype(np.asarray(value).dtype, np.integer) else float(value)
+
+
+def _fraction(value):
+    from fractions import Fraction
+    return Fraction(value)
+
+
+# Number of voxels per channel that is processed at once; bounds the size of the temporaries.
+DEFAULT_BLOCK_VOXELS = 1 << 22
+
+
+def iterateSlabs(shape, blockVoxels=DEFAULT_BLOCK_VOXELS):
+    """
+    Split a kji-ordered volume shape into slabs of whole K slices of at most blockVoxels voxels (at least one slice).
+    """
+    sliceVoxels = max(1, int(np.prod(shape[1:])))
+    slabSlices = max(1, int(blockVoxels) // sliceVoxels)
+    for kStart in range(0, shape[0], slabSlices):
+        yield slice(kStart, min(kStart + slabSlices, shape[0]))
+
+
+def computeColocalization(channelArrays, cropExtent, thresholds, blockVoxels=DEFAULT_BLOCK_VOXELS, progressCallback=None, channelMasks=None):
+    """
+    Compute the colocalization statistics of the channels within the crop extent.
+
+    The cropped arrays are never copied or cast to float: they are streamed slab by slab through ColocMoments.
+
+    :param channelArrays: list of 3D numpy arrays (kji order), one per channel.
+    :param cropExtent: voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax], or None for the whole volume.
+    :param thresholds: list of (lower, upper) threshold pairs, one per channel.
+    :param blockVoxels: maximum number of voxels per channel processed at once.
+    :param progressCallback: optional function called with the completed fraction after each slab;
+        it may raise an exception to abort the computation.
+    :param channelMasks: optional list of ChannelCache.ChannelMask, one per channel, of the cropped channels
+        for the same thresholds; the channels are then not thresholded again and their own sums are reused.
+    :return: ColocResult
+    """
+    if len(channelArrays) != len(thresholds):
+        raise ValueError("One threshold pair is required for each channel.")
+
+    croppedArrays = [cropArray(arrayData, cropExtent) for arrayData in channelArrays]
+    shape = croppedArrays[0].shape
+    for croppedArray in croppedArrays:
+        if croppedArray.shape != shape:
+            raise ValueError("All channels must have the same dimensions.")
+
+    moments = ColocMoments(thresholds)
+    if channelMasks is not None:
+        for channel, channelMask in enumerate(channelMasks):
+            if channelMask.shape != shape or channelMask.threshold != moments.thresholds[channel]:
+                raise ValueError("The channel masks don't match the cropped channels and thresholds.")
+    for slab in iterateSlabs(shape, blockVoxels):
+        blocks = [croppedArray[slab] for croppedArray in croppedArrays]
+        if channelMasks is None:
+            moments.accumulate(blocks)
+        else:
+            moments.accumulate(blocks, [channelMask.slabMask(slab) for channelMask in channelMasks], channelSums=False, intersectionCounts=False)
+        if progressCallback is not None:
+            progressCallback(slab.stop / float(shape[0]))
+    if channelMasks is not None:
+        for channel, channelMask in enumerate(channelMasks):
+            moments.channelCounts[channel] = channelMask.count
+            moments.channelSums[channel] = channelMask.sum
+            moments.channelSquareSums[channel] = channelMask.squareSum
+        # The intersection counts come straight from the bit-packed masks.
+        for channels, count in packedIntersectionCounts([channelMask.bits for channelMask in channelMasks]).items():
+            if len(channels) == 2:
+                moments.pairCounts[channels] = count
+            else:
+                moments.subsetCounts[channels] = count
+    return moments.toResult()
+
+
+# Voxels per block of the per-label computation; small enough that the per-block sums of squared
+# 16-bit values stay exact in float64.
+LABEL_BLOCK_VOXELS = 1 << 20
+
+
+def labelBoundingExtent(labelArray):
+    """
+    Voxel based extent [iMin, iMax, jMin, jMax, kMin, kMax] (exclusive ends) of the nonzero labels, None if there are none.
+    """
+    extent = list()
+    for axis in (2, 1, 0):
+        otherAxes = tuple(otherAxis for otherAxis in range(3) if otherAxis != axis)
+        indices = np.flatnonzero(np.any(labelArray, axis=otherAxes))
+        if not indices.size:
+            return None
+        extent += [int(indices[0]), int(indices[-1]) + 1]
+    return extent
+
+
+def computeColocalizationByLabel(channelArrays, labelArray, thresholds, blockVoxels=LABEL_BLOCK_VOXELS, progressCallback=None):
+    """
+    Compute the colocalization statistics of the channels within every region of a label map, in one pass.
+
+    The per-label counts, region codes and PCC sums are all accumulated with np.bincount keyed by label,
+    and only the bounding box of the nonzero labels is visited.
+
+    :param channelArrays: list of 3D numpy arrays (kji order), one per channel.
+    :param labelArray: 3D integer numpy array with the same shape; 0 is background.
+    :param thresholds: list of (lower, upper) threshold pairs, one per channel.
+    :param blockVoxels: maximum number of voxels per channel processed at once.
+    :param progressCallback: optional function called with the completed fraction after each slab.
+    :return: dict mapping each nonzero label present in the label map to its ColocResult
+        (whose voxelCount is the number of voxels of the label).
+    """
+    if len(channelArrays) != len(thresholds):
+        raise ValueError("One threshold pair is required for each channel.")
+    for arrayData in channelArrays:
+        if arrayData.shape != labelArray.shape:
+            raise ValueError("The label map and all channels must have the same dimensions.")
+    extent = labelBoundingExtent(labelArray)
+    if extent is None:
+        return dict()
+    labelArray = cropArray(labelArray, extent)
+    channelArrays = [cropArray(arrayData, extent) for arrayData in channelArrays]
+
+    channelCount = len(channelArrays)
+    codeCount = 1 << channelCount
+    labelCount = int(labelArray.max()) + 1
+    pairs = list(itertools.combinations(range(channelCount), 2))
+    exact = all(np.issubdtype(arrayData.dtype, np.integer) and arrayData.dtype.itemsize <= 2 for arrayData in channelArrays)
+    sumDtype = np.int64 if exact else np.float64
+
+    def toSums(blockSums):
+        # Per-block float sums of 8/16-bit data are exact integers.
+        return np.rint(blockSums).astype(np.int64) if exact else blockSums
+
+    maskDefinition = ColocMoments(thresholds)
+    voxelCounts = np.zeros(labelCount, dtype=np.int64)
+    regionCounts = np.zeros(labelCount * codeCount, dtype=np.int64)
+    channelSums = np.zeros((channelCount, labelCount), dtype=sumDtype)
+    channelSquareSums = np.zeros((channelCount, labelCount), dtype=sumDtype)
+    pairSums = np.zeros((len(pairs), 2, labelCount), dtype=sumDtype)
+    pairProducts = np.zeros((len(pairs), labelCount), dtype=sumDtype)
+    for slab in iterateSlabs(labelArray.shape, blockVoxels):
+        labels = np.maximum(labelArray[slab].reshape(-1), 0).astype(np.intp)
+        masks = list()
+        values = list()
+        for channel, arrayData in enumerate(channelArrays):
+            block = arrayData[slab].reshape(-1)
+            masks.append(maskDefinition.channelMask(channel, block))
+            values.append(block.astype(np.float64))
+        voxelCounts += np.bincount(labels, minlength=labelCount)
+        regionCounts += np.bincount(labels * codeCount + regionCodes(masks), minlength=labelCount * codeCount)
+        for channel in range(channelCount):
+            maskedValues = np.where(masks[channel], values[channel], 0.0)
+            channelSums[channel] += toSums(np.bincount(labels, weights=maskedValues, minlength=labelCount))
+            channelSquareSums[channel] += toSums(np.bincount(labels, weights=maskedValues * maskedValues, minlength=labelCount))
+        for pairIndex, (channel1, channel2) in enumerate(pairs):
+            pairMask = masks[channel1] & masks[channel2]
+            maskedValues1 = np.where(pairMask, values[channel1], 0.0)
+            maskedValues2 = np.where(pairMask, values[channel2], 0.0)
+            pairSums[pairIndex, 0] += toSums(np.bincount(labels, weights=maskedValues1, minlength=labelCount))
+            pairSums[pairIndex, 1] += toSums(np.bincount(labels, weights=maskedValues2, minlength=labelCount))
+            pairProducts[pairIndex] += toSums(np.bincount(labels, weights=maskedValues1 * maskedValues2, minlength=labelCount))
+        if progressCallback is not None:
+            progressCallback(slab.stop / float(labelArray.shape[0]))
+
+    regionCounts = regionCounts.reshape((labelCount, codeCount))
+    results = dict()
+    for label in range(1, labelCount):
+        if not voxelCounts[label]:
+            continue
+        intersectionCounts = supersetSums(regionCounts[label])
+        moments = ColocMoments(thresholds)
+        moments.exact = exact
+        moments.voxelCount = int(voxelCounts[label])
+        for channel in range(channelCount):
+            moments.channelCounts[channel] = int(intersectionCounts[1 << channel])
+            moments.channelSums[channel] = toPythonNumber(channelSums[channel, label])
+            moments.channelSquareSums[channel] = toPythonNumber(channelSquareSums[channel, label])
+        for pairIndex, pair in enumerate(pairs):
+            moments.pairCounts[pair] = int(intersectionCounts[channelCode(pair)])
+            moments.pairSums[pair] = (toPythonNumber(pairSums[pairIndex, 0, label]), toPythonNumber(pairSums[pairIndex, 1, label]))
+            moments.pairProducts[pair] = toPythonNumber(pairProducts[pairIndex, label])
+        for channels in moments.subsetCounts:
+            moments.subsetCounts[channels] = int(intersectionCounts[channelCode(channels)])
+        results[label] = moments.toResult()
+    return results
@@ -0,0 +1,96 @@
+"""
+Fusion of the channels of an image into one RGBA volume, for the composite rendering mode.
+
+Instead of one volume rendering per channel, the visible channels are blended into one 4-component
+unsigned char volume that is rendered with direct colors. Within its threshold range, a channel adds its
+color weighted by its intensity, ramping from 0 at the lower threshold to 1 at the upper threshold; the
+alpha component is the sum of the weights. Voxels outside the threshold range don't contribute.
+
+The sums of the contributions are kept in a 16-bit accumulator, so that when the threshold, color or
+visibility of one channel changes, its previous contribution is subtracted and the new one added, without
+reading the other channels. The renderer only holds the RGBA volume, whatever the number of channels.
+"""
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+
+def colorFromHex(color):
+    """
+    The (red, green, blue) components, between 0 and 1, of a '#rrggbb' color.
+    """
+    return tuple(int(color[index:index + 2], 16) / 255.0 for index in (1, 3, 5))
+
+
+def channelContribution(block, lowerThreshold, upperThreshold, color):
+    """
+    The RGBA contribution (uint16, values up to 255) of a block of a channel for a threshold range and an RGB color.
+    """
+    mask = ColocEngine.nativeThresholdMask(block, lowerThreshold, upperThreshold)
+    thresholdRange = float(upperThreshold) - float(lowerThreshold)
+    if thresholdRange > 0:
+        weights = (block.astype(np.float32) - np.float32(lowerThreshold)) * np.float32(1.0 / thresholdRange)
+        np.clip(weights, 0.0, 1.0, out=weights)
+    else:
+        weights = np.ones(block.shape, dtype=np.float32)
+    weights *= mask
+    contribution = np.empty(block.shape + (4,), dtype=np.uint16)
+    for component, value in enumerate(tuple(color) + (1.0,)):
+        contribution[..., component] = np.rint(weights * np.float32(255.0 * value))
+    return contribution
+
+
+class CompositeVolume(object):
+    """
+    RGBA composite (kji order, 4 uint8 components) of the channels of an image, updated incrementally.
+    """
+
+    def __init__(self, shape, channelCount, blockVoxels=ColocEngine.DEFAULT_BLOCK_VOXELS):
+        self.shape = tuple(shape)
+        self.blockVoxels = blockVoxels
+        self.rgba = np.zeros(self.shape + (4,), dtype=np.uint8)
+        # At most 15 channels of 255 are summed, which fits in 16 bits.
+        self._accumulator = np.zeros(self.shape + (4,), dtype=np.uint16)
+        # (data key, lower threshold, upper threshold, color) of the channels in the accumulator, or None.
+        self._applied = [None] * channelCount
+
+    @property
+    def nbytes(self):
+        return self.rgba.nbytes + self._accumulator.nbytes
+
+    def update(self, channels):
+        """
+        Blend the channels whose state changed since the last update. channels has one entry per channel:
+        (data key, array, visible, lower threshold, upper threshold, color). The data key identifies the
+        channel data (e.g. its volume node ID and modification time); array is None for a channel without data.
+        Returns the indices of the channels that were blended again.
+        """
+        wanted = list()
+        for key, array, visible, lowerThreshold, upperThreshold, color in channels:
+            shown = visible and array is not None
+            wanted.append((key, float(lowerThreshold), float(upperThreshold), tuple(color)) if shown else None)
+        changed = [index for index in range(len(channels)) if wanted[index] != self._applied[index]]
+        if not changed:
+            return changed
+
+        # A previous contribution can only be subtracted if its data is still the same.
+        rebuild = any(self._applied[index] is not None and (channels[index][1] is None or channels[index][0] != self._applied[index][0])
+                      for index in changed)
+        if rebuild:
+            changed = [index for index in range(len(channels)) if wanted[index] is not None or self._applied[index] is not None]
+
+        for slab in ColocEngine.iterateSlabs(self.shape, self.blockVoxels):
+            accumulator = self._accumulator[slab]
+            if rebuild:
+                accumulator[...] = 0
+            for index in changed:
+                array = channels[index][1]
+                if not rebuild and self._applied[index] is not None:
+                    accumulator -= channelContribution(array[slab], *self._applied[index][1:])
+                if wanted[index] is not None:
+                    accumulator += channelContribution(array[slab], *wanted[index][1:])
+            np.minimum(accumulator, 255, out=self.rgba[slab], casting='unsafe')
+
+        for index in changed:
+            self._applied[index] = wanted[index]
+        return changed
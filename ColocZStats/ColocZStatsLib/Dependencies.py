@@ -0,0 +1,105 @@
+"""
+One-time provisioning of the optional Python packages and background warm-up of the heavy ones.
+
+The packages that draw the figures and write the spreadsheets are checked (without importing them) and
+installed once, when the module is set up, instead of on every computation. The heavy ones are then
+imported on a background thread, and backends that need a setup call (e.g. the Bokeh extension of
+HoloViews) are initialized once per session, so that the first computation is as fast as the next ones.
+The install function is given by the caller (slicer.util.pip_install in Slicer), so this file doesn't
+depend on Slicer.
+"""
+import importlib
+import importlib.util
+import threading
+
+# Packages needed to compute, draw and export the statistics, as (module name, pip requirement).
+COMPUTE_PACKAGES = [('tifffile', 'tifffile'), ('matplotlib', 'matplotlib'), ('matplotlib_venn', 'matplotlib_venn'),
+                    ('pandas', 'pandas'), ('xlsxwriter', 'xlsxwriter')]
+
+# Packages needed for the interactive HTML 2D histograms.
+HTML_EXPORT_PACKAGES = [('holoviews', 'holoviews'), ('bokeh', 'bokeh')]
+
+# Modules imported by the warm-up, slowest first.
+COMPUTE_WARM_UP_MODULES = ['matplotlib.pyplot', 'matplotlib_venn', 'pandas', 'xlsxwriter', 'tifffile']
+HTML_EXPORT_WARM_UP_MODULES = ['holoviews']
+
+_lock = threading.Lock()
+# Module names found or installed in this session.
+_provisioned = set()
+# Names of the backends initialized in this session, and the lock of each initialization.
+_initializedBackends = set()
+_backendLocks = dict()
+
+
+def missingPackages(packages):
+    """
+    The (module name, pip requirement) pairs of packages that can't be imported, without importing any of them.
+    """
+    missing = list()
+    for moduleName, requirement in packages:
+        if moduleName in _provisioned:
+            continue
+        try:
+            found = importlib.util.find_spec(moduleName) is not None
+        except (ImportError, ValueError):
+            found = False
+        if found:
+            with _lock:
+                _provisioned.add(moduleName)
+        else:
+            missing.append((moduleName, requirement))
+    return missing
+
+
+def provision(packages, installFunction):
+    """
+    Install the missing packages with installFunction(requirement). Packages already found in this session
+    aren't checked again. Returns the requirements that were installed.
+    """
+    installed = list()
+    for moduleName, requirement in missingPackages(packages):
+        installFunction(requirement)
+        importlib.invalidate_caches()
+        with _lock:
+            _provisioned.add(moduleName)
+        installed.append(requirement)
+    return installed
+
+
+def _importModules(moduleNames):
+    for moduleName in moduleNames:
+        if moduleName.startswith('matplotlib'):
+            # Select the non-interactive backend before pyplot is imported, as the drawing functions do.
+            import matplotlib
+            matplotlib.use("Agg")
+        try:
+            importlib.import_module(moduleName)
+        except Exception:
+            # A broken optional package is reported when it is actually used.
+            pass
+
+
+def warmUp(moduleNames):
+    """
+    Import modules on a daemon thread. Returns the thread. Importing the same modules from another thread
+    meanwhile just waits for the warm-up import to finish.
+    """
+    thread = threading.Thread(target=_importModules, args=(list(moduleNames),), name="ColocZStats warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def initializeOnce(name, function):
+    """
+    Call function() the first time a backend name is initialized in this session, and never again.
+    """
+    if name in _initializedBackends:
+        return
+    with _lock:
+        backendLock = _backendLocks.setdefault(name, threading.Lock())
+    with backendLock:
+        if name in _initializedBackends:
+            return
+        function()
+        _initializedBackends.add(name)
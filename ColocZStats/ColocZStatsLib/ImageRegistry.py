@@ -0,0 +1,202 @@
+"""
+Registry of the images shown by the module and of the state of their channels.
+
+Each image is an ImageState, keyed by the path of its file. It holds the channel volumes, the ROI and
+annotation nodes and the channel widgets of the image, and keeps the visibility, threshold range, label and
+color of the channels in arrays indexed by channel. The widget slots update the state as the user changes
+it, so the computations and the parameter node read it directly instead of walking the widget tree. Channel
+volumes are also indexed by node ID, so that the image and channel of a volume are found in constant time.
+Nodes and widgets are only stored here: this file doesn't depend on Slicer.
+
+The state of all images is saved in the parameter node as one versioned JSON string (dumpState and
+loadState). The node references of the volumes, ROIs and annotations are saved next to it, as node
+references, so that the scene can remap their IDs. stateFromParameters reads the state saved by the
+versions of the module that had one parameter per image and channel property.
+"""
+import collections
+import json
+import re
+
+import numpy as np
+
+# Colors of the channels in the figures, by channel index. They follow the color nodes of the channel volumes.
+CHANNEL_COLORS = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#00ffff', '#ff00ff', '#eb711a', '#baeb1a', '#1aeb86',
+                  '#1ab7eb', '#7f1aeb', '#d620a0', '#851d1d', '#9ba33e', '#3e9641']
+
+# Version of the state written by dumpState. loadState rejects states of newer versions.
+STATE_VERSION = 1
+
+# Parameters of the state saved by the previous versions of the module, to be removed once the state is saved again.
+LEGACY_PARAMETER_PATTERN = re.compile(r"^(Count|CurrentText|(ItemText|Filepath|InputVisibility|ROI|Annotation|Channel Count)\d+"
+                                      r"|(ChannelLabel|Visibility|LowerThreshold|UpperThreshold|LowerThresholdBound|UpperThresholdBound)\d+_\d+)$")
+
+
+class ImageState(object):
+    """
+    State of one image and of its channels. The channel volumes may be None when a saved scene lost some of them.
+    """
+    __slots__ = ('filename', 'volumes', 'volumeIDs', 'labels', 'colors', 'visible', 'thresholds', 'thresholdBounds',
+                 'inputVisible', 'roiNode', 'roiVisible', 'annotationNode', 'groupBox', 'checkBoxes', 'thresholdSliders')
+
+    def __init__(self, filename, volumes, labels):
+        channelCount = len(volumes)
+        self.filename = filename
+        self.volumes = list(volumes)
+        self.volumeIDs = [volume.GetID() if volume else None for volume in self.volumes]
+        self.labels = list(labels)
+        self.colors = CHANNEL_COLORS[:channelCount]
+        self.visible = np.zeros(channelCount, dtype=bool)
+        # Lower and upper threshold of each channel, and the range the thresholds can be set in.
+        self.thresholds = np.zeros((channelCount, 2))
+        self.thresholdBounds = np.zeros((channelCount, 2))
+        # Visibility of the whole image, and its ROI box.
+        self.inputVisible = True
+        self.roiNode = None
+        self.roiVisible = False
+        self.annotationNode = None
+        # Group box of the channel widgets, and the checkbox and threshold slider of each channel.
+        self.groupBox = None
+        self.checkBoxes = [None] * channelCount
+        self.thresholdSliders = [None] * channelCount
+
+    @property
+    def channelCount(self):
+        return len(self.volumes)
+
+    def setThreshold(self, channelIndex, lower, upper, lowerBound=None, upperBound=None):
+        self.thresholds[channelIndex] = (lower, upper)
+        if lowerBound is not None and upperBound is not None:
+            self.thresholdBounds[channelIndex] = (lowerBound, upperBound)
+
+    def toDict(self):
+        """
+        The state of the image and of its channels, without the nodes and widgets, as JSON-compatible values.
+        """
+        channels = list()
+        for channelIndex in range(self.channelCount):
+            channels.append({'label': self.labels[channelIndex], 'visible': bool(self.visible[channelIndex]),
+                             'thresholds': [float(value) for value in self.thresholds[channelIndex]],
+                             'thresholdBounds': [float(value) for value in self.thresholdBounds[channelIndex]]})
+        return {'filepath': self.filename, 'inputVisible': bool(self.inputVisible), 'roiVisible': bool(self.roiVisible), 'channels': channels}
+
+    def applyDict(self, imageState):
+        """
+        Restore the state returned by toDict (the channels beyond the channel count of the image are ignored).
+        """
+        self.inputVisible = bool(imageState.get('inputVisible', True))
+        self.roiVisible = bool(imageState.get('roiVisible', False))
+        for channelIndex, channelState in enumerate(imageState.get('channels', [])[:self.channelCount]):
+            self.labels[channelIndex] = str(channelState['label'])
+            self.visible[channelIndex] = bool(channelState['visible'])
+            self.setThreshold(channelIndex, *(list(channelState['thresholds']) + list(channelState['thresholdBounds'])))
+
+    def selectedChannels(self):
+        """
+        Indices of the visible channels.
+        """
+        return np.flatnonzero(self.visible)
+
+    def selection(self):
+        """
+        The volumes, thresholds ([lower1, upper1, lower2, upper2, ...]), colors and labels of the visible channels.
+        """
+        selectedChannels = self.selectedChannels()
+        volumes = [self.volumes[index] for index in selectedChannels]
+        thresholds = [float(threshold) for threshold in self.thresholds[selectedChannels].reshape(-1)]
+        colors = [self.colors[index] for index in selectedChannels]
+        labels = [self.labels[index] for index in selectedChannels]
+        return volumes, thresholds, colors, labels
+
+
+class ImageRegistry(object):
+    """
+    ImageStates by file path, in the order they were added, and the (image, channel index) of each channel volume by node ID.
+    """
+    __slots__ = ('_images', '_channels')
+
+    def __init__(self):
+        self._images = collections.OrderedDict()
+        self._channels = dict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, filename):
+        return filename in self._images
+
+    def __iter__(self):
+        return iter(list(self._images.values()))
+
+    def get(self, filename):
+        return self._images.get(filename)
+
+    def add(self, image):
+        self.remove(image.filename)
+        self._images[image.filename] = image
+        for channelIndex, volumeID in enumerate(image.volumeIDs):
+            if volumeID is not None:
+                self._channels[volumeID] = (image, channelIndex)
+        return image
+
+    def remove(self, filename):
+        """
+        Remove the image of a file path, and return it (None if there was none).
+        """
+        image = self._images.pop(filename, None)
+        if image is not None:
+            for volumeID in image.volumeIDs:
+                if self._channels.get(volumeID, (None,))[0] is image:
+                    del self._channels[volumeID]
+        return image
+
+    def channel(self, volumeID):
+        """
+        The image and the channel index of a channel volume node ID, or (None, -1) if it is no channel.
+        """
+        return self._channels.get(volumeID, (None, -1))
+
+
+def dumpState(currentText, images):
+    """
+    The state of the module as a JSON string. images is a list of (item text, annotation text, ImageState),
+    in the order of the input volume's combobox; currentText is the item text of the selected image.
+    """
+    imageStates = list()
+    for itemText, annotationText, image in images:
+        imageState = image.toDict()
+        imageState['itemText'] = itemText
+        imageState['annotation'] = annotationText
+        imageStates.append(imageState)
+    return json.dumps({'version': STATE_VERSION, 'currentText': currentText, 'images': imageStates}, sort_keys=True, separators=(',', ':'))
+
+
+def loadState(text):
+    """
+    Parse a state written by dumpState. Raises ValueError if the text is no state, or a state of a newer version.
+    """
+    state = json.loads(text)
+    if not isinstance(state, dict) or not isinstance(state.get('version'), int) or not isinstance(state.get('images'), list):
+        raise ValueError("The saved ColocZStats state is invalid.")
+    if state['version'] > STATE_VERSION:
+        raise ValueError("The ColocZStats state was saved by a newer version of the module (state version " + str(state['version']) + ").")
+    return state
+
+
+def stateFromParameters(getParameter):
+    """
+    Read the state saved by the previous versions of the module, as the state returned by loadState.
+    getParameter(name) returns the value of a parameter of the parameter node, or an empty string.
+    """
+    imageStates = list()
+    for index in range(int(getParameter("Count") or 0)):
+        indexStr = str(index)
+        channels = list()
+        for channelIndex in range(int(getParameter("Channel Count" + indexStr))):
+            suffix = indexStr + "_" + str(channelIndex)
+            channels.append({'label': str(getParameter("ChannelLabel" + suffix)), 'visible': getParameter("Visibility" + suffix) == "true",
+                             'thresholds': [int(float(getParameter("LowerThreshold" + suffix))), int(float(getParameter("UpperThreshold" + suffix)))],
+                             'thresholdBounds': [int(float(getParameter("LowerThresholdBound" + suffix))), int(float(getParameter("UpperThresholdBound" + suffix)))]})
+        imageStates.append({'filepath': getParameter("Filepath" + indexStr), 'itemText': getParameter("ItemText" + indexStr),
+                            'inputVisible': getParameter("InputVisibility" + indexStr) == "true", 'roiVisible': getParameter("ROI" + indexStr) == "true",
+                            'annotation': getParameter("Annotation" + indexStr) or "", 'channels': channels})
+    return {'version': 0, 'currentText': getParameter("CurrentText"), 'images': imageStates}
@@ -0,0 +1,189 @@
+"""
+Timing and memory instrumentation of the stages of the ColocZStats pipelines.
+
+Stages are wrapped in Profiler.span context managers. Each span records its wall time, the CPU time of
+its thread and the peak of the memory traced by tracemalloc (NumPy reports its array buffers there) above
+the memory in use when the span started. Finished spans are written to the "ColocZStats.profile" logger
+as one JSON object per line, and can be collected into a per-run report. A disabled profiler only costs
+one attribute check per span.
+
+The traced memory and its peak are process-wide, so the memory of a span can only be attributed to it while
+the spans of a single thread are open. A span that was open at the same time as a span of another thread
+(e.g. a main-thread span during a compute on the worker thread) has no peak memory (None).
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# Environment variable that enables the instrumentation when set to 1, true, yes or on.
+ENVIRONMENT_VARIABLE = "COLOCZSTATS_PROFILE"
+
+# Logger receiving one JSON line per finished span.
+LOGGER_NAME = "ColocZStats.profile"
+
+
+def enabledByEnvironment():
+    return os.environ.get(ENVIRONMENT_VARIABLE, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class Span(object):
+    """
+    Measurements of one stage.
+    """
+
+    def __init__(self, name, depth, threadName):
+        self.name = name
+        self.depth = depth
+        self.threadName = threadName
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.startMemory = 0
+        self.peakMemory = 0
+        # Whether a span of another thread was open at the same time, which makes the peak memory unknown.
+        self.overlapped = False
+
+    @property
+    def peakMemoryIncrease(self):
+        if self.overlapped:
+            return None
+        return max(0, self.peakMemory - self.startMemory)
+
+    def toDict(self):
+        return {'stage': self.name, 'depth': self.depth, 'thread': self.threadName, 'wallTime': round(self.wallTime, 6),
+                'cpuTime': round(self.cpuTime, 6), 'peakMemoryBytes': self.peakMemoryIncrease}
+
+
+class Profiler(object):
+    """
+    Records nested spans, per thread. Spans of all threads are kept in the order they finished.
+    """
+
+    def __init__(self, enabled=False):
+        self.spans = list()
+        self._enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Open spans of all threads, to detect the spans whose memory can't be attributed.
+        self._openSpans = list()
+        self._startedTracing = False
+        self.enabled = enabled
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        enabled = bool(enabled)
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        elif not enabled and self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+        self._enabled = enabled
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Measure the enclosed block as the stage name (nested within the enclosing span of the same thread).
+        """
+        if not self._enabled:
+            yield None
+            return
+        stack = self._stack()
+        span = Span(name, len(stack), threading.current_thread().name)
+        with self._lock:
+            if any(openSpan.threadName != span.threadName for openSpan in self._openSpans):
+                # Another thread allocates meanwhile, and resetting the peak would break its spans.
+                for openSpan in self._openSpans:
+                    openSpan.overlapped = True
+                span.overlapped = True
+            self._openSpans.append(span)
+            tracing = tracemalloc.is_tracing() and not span.overlapped
+            if tracing:
+                currentMemory, peakMemory = tracemalloc.get_traced_memory()
+                # The peak is about to be reset: keep it for the enclosing span first.
+                if stack:
+                    stack[-1].peakMemory = max(stack[-1].peakMemory, peakMemory)
+                tracemalloc.reset_peak()
+                span.startMemory = span.peakMemory = currentMemory
+        stack.append(span)
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time()
+        try:
+            yield span
+        finally:
+            span.wallTime = time.perf_counter() - wallStart
+            span.cpuTime = time.thread_time() - cpuStart
+            stack.pop()
+            with self._lock:
+                self._openSpans.remove(span)
+                if tracing and not span.overlapped and tracemalloc.is_tracing():
+                    span.peakMemory = max(span.peakMemory, tracemalloc.get_traced_memory()[1])
+                    if stack:
+                        stack[-1].peakMemory = max(stack[-1].peakMemory, span.peakMemory)
+                self.spans.append(span)
+            logging.getLogger(LOGGER_NAME).info(json.dumps(span.toDict()))
+
+    def mark(self):
+        """
+        Position in the list of finished spans, to collect the spans of a run with report.
+        """
+        with self._lock:
+            return len(self.spans)
+
+    def report(self, since=0):
+        """
+        Table rows (dicts) of the spans finished since a mark, grouped by thread, in the order the stages started.
+        """
+        with self._lock:
+            spans = self.spans[since:]
+        threadNames = list()
+        for span in spans:
+            if span.threadName not in threadNames:
+                threadNames.append(span.threadName)
+        rows = list()
+        for threadName in threadNames:
+            for span in _startOrder([span for span in spans if span.threadName == threadName]):
+                peakMemoryIncrease = span.peakMemoryIncrease
+                rows.append({'Stage': '    ' * span.depth + span.name, 'Wall Time (s)': round(span.wallTime, 4), 'CPU Time (s)': round(span.cpuTime, 4),
+                             'Peak Memory (MiB)': None if peakMemoryIncrease is None else round(peakMemoryIncrease / (1024.0 * 1024.0), 2)})
+        return rows
+
+
+def _startOrder(spans):
+    """
+    Reorder spans from finishing order to starting order: each span is preceded by its enclosing span.
+    """
+    ordered = list()
+    pending = list()
+    for span in spans:
+        # The spans pending with a larger depth are the children of this span.
+        children = [child for child in pending if child.depth > span.depth]
+        pending = [child for child in pending if child.depth <= span.depth]
+        pending.append(_SpanGroup(span, children))
+    for group in pending:
+        group.flatten(ordered)
+    return ordered
+
+
+class _SpanGroup(object):
+    def __init__(self, span, children):
+        self.span = span
+        self.children = children
+        self.depth = span.depth
+
+    def flatten(self, ordered):
+        ordered.append(self.span)
+        for child in self.children:
+            child.flatten(ordered)
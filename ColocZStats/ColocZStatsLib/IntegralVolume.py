@@ -0,0 +1,139 @@
+"""
+3D summed-volume tables of the colocalization sums for fixed thresholds.
+
+For every term that ColocMoments accumulates (channel masks, intersection masks and the PCC moment sums)
+a summed-volume table is built once over the whole volume. Afterwards the statistics of any axis-aligned
+box are the inclusion-exclusion of eight table entries per term, which is fast enough to follow the ROI
+while it is dragged.
+"""
+import itertools
+
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Default maximum size of all the tables together, in bytes.
+DEFAULT_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+
+def tableCount(channelCount):
+    """
+    Number of summed-volume tables needed for a number of channels.
+    """
+    pairCount = channelCount * (channelCount - 1) // 2
+    largerSubsetCount = (1 << channelCount) - 1 - channelCount - pairCount
+    return 3 * channelCount + 4 * pairCount + largerSubsetCount
+
+
+def tableBytes(shape, channelCount):
+    """
+    Memory needed by the tables of a volume shape (kji order) and a number of channels, in bytes.
+    """
+    return tableCount(channelCount) * (shape[0] + 1) * (shape[1] + 1) * (shape[2] + 1) * np.dtype(np.int64).itemsize
+
+
+class IntegralVolume(object):
+    """
+    Summed-volume tables of the thresholded channels, for the colocalization statistics of any box.
+    """
+
+    def __init__(self, channelArrays, thresholds, memoryBudget=DEFAULT_MEMORY_BUDGET, blockVoxels=ColocEngine.DEFAULT_BLOCK_VOXELS):
+        if len(channelArrays) != len(thresholds):
+            raise ValueError("One threshold pair is required for each channel.")
+        self.shape = channelArrays[0].shape
+        for arrayData in channelArrays:
+            if arrayData.shape != self.shape:
+                raise ValueError("All channels must have the same dimensions.")
+        channelCount = len(channelArrays)
+        if tableBytes(self.shape, channelCount) > memoryBudget:
+            raise MemoryError("The volume is too large for the summed-volume tables of " + str(channelCount) + " channels.")
+
+        self.thresholds = [(float(lower), float(upper)) for lower, upper in thresholds]
+        self.exact = all(np.issubdtype(arrayData.dtype, np.integer) and arrayData.dtype.itemsize <= 2 for arrayData in channelArrays)
+        self.pairs = list(itertools.combinations(range(channelCount), 2))
+        self.subsets = [channels for subsetSize in range(3, channelCount + 1) for channels in itertools.combinations(range(channelCount), subsetSize)]
+
+        tableDtype = np.int64 if self.exact else np.float64
+        tableShape = (self.shape[0] + 1, self.shape[1] + 1, self.shape[2] + 1)
+        # Tables: per channel count, sum x and sum x^2; per pair count, sum x_a, sum x_b and sum x_a * x_b;
+        # per larger subset count.
+        self._tables = [np.zeros(tableShape, dtype=tableDtype) for index in range(tableCount(channelCount))]
+
+        maskDefinition = ColocEngine.ColocMoments(self.thresholds)
+        for slab in ColocEngine.iterateSlabs(self.shape, blockVoxels):
+            masks = list()
+            values = list()
+            for channel, arrayData in enumerate(channelArrays):
+                block = arrayData[slab]
+                masks.append(maskDefinition.channelMask(channel, block))
+                values.append(block.astype(tableDtype))
+            terms = list()
+            for channel in range(channelCount):
+                maskedValues = np.where(masks[channel], values[channel], 0)
+                terms += [masks[channel], maskedValues, maskedValues * maskedValues]
+            for channel1, channel2 in self.pairs:
+                pairMask = masks[channel1] & masks[channel2]
+                maskedValues1 = np.where(pairMask, values[channel1], 0)
+                maskedValues2 = np.where(pairMask, values[channel2], 0)
+                terms += [pairMask, maskedValues1, maskedValues2, maskedValues1 * maskedValues2]
+            for channels in self.subsets:
+                subsetMask = masks[channels[0]].copy()
+                for channel in channels[1:]:
+                    subsetMask &= masks[channel]
+                terms.append(subsetMask)
+            for table, term in zip(self._tables, terms):
+                _accumulateSlab(table, term.astype(tableDtype), slab)
+
+    def _boxSums(self, cropExtent):
+        """
+        Sum of every term over the box of a crop extent [iMin, iMax, jMin, jMax, kMin, kMax] (exclusive ends).
+        """
+        extent = [max(0, int(value)) for value in cropExtent]
+        i0, i1 = min(extent[0], self.shape[2]), min(extent[1], self.shape[2])
+        j0, j1 = min(extent[2], self.shape[1]), min(extent[3], self.shape[1])
+        k0, k1 = min(extent[4], self.shape[0]), min(extent[5], self.shape[0])
+        i1, j1, k1 = max(i0, i1), max(j0, j1), max(k0, k1)
+        voxelCount = (i1 - i0) * (j1 - j0) * (k1 - k0)
+        sums = [ColocEngine.toPythonNumber(table[k1, j1, i1] - table[k0, j1, i1] - table[k1, j0, i1] - table[k1, j1, i0]
+                                           + table[k0, j0, i1] + table[k0, j1, i0] + table[k1, j0, i0] - table[k0, j0, i0])
+                for table in self._tables]
+        return voxelCount, sums
+
+    def moments(self, cropExtent):
+        """
+        ColocMoments of the channels within the box of a crop extent, from eight lookups per table.
+        """
+        voxelCount, sums = self._boxSums(cropExtent)
+        moments = ColocEngine.ColocMoments(self.thresholds)
+        moments.exact = self.exact
+        moments.voxelCount = voxelCount
+        index = 0
+        for channel in range(moments.channelCount):
+            moments.channelCounts[channel], moments.channelSums[channel], moments.channelSquareSums[channel] = sums[index:index + 3]
+            index += 3
+        for pair in self.pairs:
+            moments.pairCounts[pair] = sums[index]
+            moments.pairSums[pair] = (sums[index + 1], sums[index + 2])
+            moments.pairProducts[pair] = sums[index + 3]
+            index += 4
+        for channels in self.subsets:
+            moments.subsetCounts[channels] = sums[index]
+            index += 1
+        return moments
+
+    def result(self, cropExtent):
+        """
+        ColocResult of the channels within the box of a crop extent.
+        """
+        return self.moments(cropExtent).toResult()
+
+
+def _accumulateSlab(table, term, slab):
+    """
+    Write the summed-volume table entries of the slices of a slab, continuing the sums of the previous slices.
+    """
+    np.cumsum(term, axis=1, out=term)
+    np.cumsum(term, axis=2, out=term)
+    np.cumsum(term, axis=0, out=term)
+    term += table[slab.start, 1:, 1:]
+    table[slab.start + 1:slab.stop + 1, 1:, 1:] = term
@@ -0,0 +1,255 @@
+"""
+Joint intensity histogram of a channel pair with summed-area tables.
+
+The histogram is built once from the cropped channels. Afterwards the voxel counts, the intersection
+volume and the thresholded PCC moments of any threshold pair are looked up with a few summed-area table
+reads instead of another pass over the voxels, which is fast enough to follow the threshold sliders.
+"""
+import math
+
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Default maximum number of bins per channel.
+DEFAULT_BINS = 1024
+
+# Default maximum number of bins per channel of the 2D histograms shown to the user.
+DEFAULT_SCATTER_BINS = 256
+
+
+class JointHistogram(object):
+    """
+    Joint histogram of two channels within one crop extent.
+
+    Each cell stores the voxel count and the sums of x, y, x^2, y^2 and x*y of its voxels, where x and y
+    are the intensities relative to the minimum of each channel. When the intensity range of a channel
+    fits in the bins, every bin holds exactly one intensity and all lookups are exact; otherwise
+    thresholds are snapped to the nearest bin edge.
+    """
+
+    def __init__(self, arrayData1, arrayData2, bins=DEFAULT_BINS, blockVoxels=ColocEngine.DEFAULT_BLOCK_VOXELS):
+        if arrayData1.shape != arrayData2.shape:
+            raise ValueError("Both channels must have the same dimensions.")
+        self.voxelCount = int(arrayData1.size)
+        self.axes = [_HistogramAxis(arrayData1, bins), _HistogramAxis(arrayData2, bins)]
+        self.exact = self.axes[0].exact and self.axes[1].exact
+
+        binCount1 = self.axes[0].binCount
+        binCount2 = self.axes[1].binCount
+        cellCount = binCount1 * binCount2
+        counts = np.zeros(cellCount, dtype=np.int64)
+        sumDtype = np.int64 if self.exact else np.float64
+        sums = [np.zeros(cellCount, dtype=sumDtype) for index in range(5)]
+        if self.voxelCount:
+            for slab in ColocEngine.iterateSlabs(arrayData1.shape, blockVoxels):
+                values1 = self.axes[0].relativeValues(arrayData1[slab]).reshape(-1)
+                values2 = self.axes[1].relativeValues(arrayData2[slab]).reshape(-1)
+                cells = self.axes[0].binIndices(values1) * binCount2 + self.axes[1].binIndices(values2)
+                counts += np.bincount(cells, minlength=cellCount)
+                if not self.exact:
+                    for index, weights in enumerate((values1, values2, values1 * values1, values2 * values2, values1 * values2)):
+                        sums[index] += np.bincount(cells, weights=weights, minlength=cellCount)
+
+        counts = counts.reshape((binCount1, binCount2))
+        if self.exact:
+            # One intensity per bin: the sums follow from the counts and the bin values.
+            values1 = np.arange(binCount1, dtype=np.int64).reshape((-1, 1))
+            values2 = np.arange(binCount2, dtype=np.int64).reshape((1, -1))
+            sums = [counts * values1, counts * values2, counts * values1 * values1, counts * values2 * values2, counts * values1 * values2]
+        else:
+            sums = [cellSums.reshape((binCount1, binCount2)) for cellSums in sums]
+        self.counts = counts
+        self._tables = [_summedAreaTable(cellValues) for cellValues in [counts] + sums]
+
+    def _rectangleSums(self, binRange1, binRange2):
+        """
+        Count, sum x, sum y, sum x^2, sum y^2 and sum x*y over the cells [bin1Start, bin1Stop) x [bin2Start, bin2Stop).
+        """
+        (start1, stop1), (start2, stop2) = binRange1, binRange2
+        if start1 >= stop1 or start2 >= stop2:
+            return [0] * len(self._tables)
+        return [ColocEngine.toPythonNumber(table[stop1, stop2] - table[start1, stop2] - table[stop1, start2] + table[start1, start2])
+                for table in self._tables]
+
+    def moments(self, threshold1, threshold2):
+        """
+        ColocMoments of the channel pair for a threshold pair, looked up from the summed-area tables.
+        The moments are relative to the channel minimums, which leaves the thresholded values unchanged.
+        """
+        binRange1 = self.axes[0].binRange(*threshold1)
+        binRange2 = self.axes[1].binRange(*threshold2)
+        fullRange1 = (0, self.axes[0].binCount)
+        fullRange2 = (0, self.axes[1].binCount)
+
+        relativeThresholds = [(threshold1[0] - self.axes[0].minimum, threshold1[1] - self.axes[0].minimum),
+                              (threshold2[0] - self.axes[1].minimum, threshold2[1] - self.axes[1].minimum)]
+        moments = ColocEngine.ColocMoments(relativeThresholds)
+        moments.exact = self.exact
+        moments.voxelCount = self.voxelCount
+
+        count, sum1, sum2, squareSum1, squareSum2, productSum = self._rectangleSums(binRange1, fullRange2)
+        moments.channelCounts[0] = count
+        moments.channelSums[0] = sum1
+        moments.channelSquareSums[0] = squareSum1
+        count, sum1, sum2, squareSum1, squareSum2, productSum = self._rectangleSums(fullRange1, binRange2)
+        moments.channelCounts[1] = count
+        moments.channelSums[1] = sum2
+        moments.channelSquareSums[1] = squareSum2
+        count, sum1, sum2, squareSum1, squareSum2, productSum = self._rectangleSums(binRange1, binRange2)
+        moments.pairCounts[(0, 1)] = count
+        moments.pairSums[(0, 1)] = (sum1, sum2)
+        moments.pairProducts[(0, 1)] = productSum
+        return moments
+
+    def result(self, threshold1, threshold2):
+        """
+        ColocResult of the channel pair for a threshold pair.
+        """
+        result = self.moments(threshold1, threshold2).toResult()
+        result.thresholds = [tuple(threshold1), tuple(threshold2)]
+        return result
+
+
+class ScatterHistogram(object):
+    """
+    Binned 2D histogram of the intensities of a channel pair at the voxels where at least one of the channels
+    is within its threshold range. Its size is bounded by the number of bins, whatever the number of voxels.
+    """
+
+    def __init__(self, arrayData1, arrayData2, threshold1, threshold2, bins=DEFAULT_SCATTER_BINS, blockVoxels=ColocEngine.DEFAULT_BLOCK_VOXELS, progressCallback=None, channelMasks=None):
+        if arrayData1.shape != arrayData2.shape:
+            raise ValueError("Both channels must have the same dimensions.")
+        self.axes = [_HistogramAxis(arrayData1, bins), _HistogramAxis(arrayData2, bins)]
+        binCount1 = self.axes[0].binCount
+        binCount2 = self.axes[1].binCount
+        cellCount = binCount1 * binCount2
+        # Voxels outside both threshold ranges go to one extra cell, which is dropped afterwards.
+        counts = np.zeros(cellCount + 1, dtype=np.int64)
+        if arrayData1.size:
+            for slab in ColocEngine.iterateSlabs(arrayData1.shape, blockVoxels):
+                block1 = arrayData1[slab]
+                block2 = arrayData2[slab]
+                if channelMasks is None:
+                    union = ColocEngine.nativeThresholdMask(block1, *threshold1)
+                    union |= ColocEngine.nativeThresholdMask(block2, *threshold2)
+                else:
+                    # Cached masks of both channels (ChannelCache.ChannelMask) for the same thresholds.
+                    union = channelMasks[0].slabMask(slab) | channelMasks[1].slabMask(slab)
+                cells = self.axes[0].binIndices(self.axes[0].relativeValues(block1)) * binCount2
+                cells += self.axes[1].binIndices(self.axes[1].relativeValues(block2))
+                counts += np.bincount(np.where(union, cells, cellCount).reshape(-1), minlength=cellCount + 1)
+                if progressCallback is not None:
+                    progressCallback(slab.stop / float(arrayData1.shape[0]))
+        self.counts = counts[:cellCount].reshape((binCount1, binCount2))
+
+    def binEdges(self, axis):
+        """
+        Intensity edges of the bins of one channel (binCount + 1 values).
+        """
+        histogramAxis = self.axes[axis]
+        return float(histogramAxis.minimum) + np.arange(histogramAxis.binCount + 1) * histogramAxis.binWidth - (0.5 if histogramAxis.integer else 0.0)
+
+    def binCenters(self, axis):
+        """
+        Intensity at the center of the bins of one channel; the intensity itself when every bin holds a single value.
+        """
+        edges = self.binEdges(axis)
+        return (edges[:-1] + edges[1:]) / 2.0
+
+    def nonEmptyBins(self):
+        """
+        Bin centers of both channels and voxel counts of the non-empty cells, as three 1D arrays.
+        """
+        index1, index2 = np.nonzero(self.counts)
+        return self.binCenters(0)[index1], self.binCenters(1)[index2], self.counts[index1, index2]
+
+
+class _HistogramAxis(object):
+    """
+    Binning of the intensities of one channel.
+    """
+
+    def __init__(self, arrayData, bins):
+        self.integer = np.issubdtype(arrayData.dtype, np.integer)
+        if arrayData.size:
+            self.minimum = arrayData.min().item()
+            maximum = arrayData.max().item()
+        else:
+            self.minimum = maximum = 0
+        if self.integer:
+            valueCount = int(maximum) - int(self.minimum) + 1
+            self.binWidth = max(1, int(math.ceil(valueCount / float(bins))))
+            self.binCount = max(1, int(math.ceil(valueCount / float(self.binWidth))))
+        else:
+            self.binCount = int(bins)
+            self.binWidth = (float(maximum) - float(self.minimum)) / self.binCount or 1.0
+        self.exact = self.integer and self.binWidth == 1
+
+    def relativeValues(self, block):
+        if self.exact:
+            return (block.astype(np.int64) - int(self.minimum))
+        return block.astype(np.float64) - float(self.minimum)
+
+    def binIndices(self, relativeValues):
+        if self.exact:
+            return relativeValues
+        return np.minimum((relativeValues // self.binWidth).astype(np.int64), self.binCount - 1)
+
+    def binRange(self, lowerThreshold, upperThreshold):
+        """
+        Bins [start, stop) of the voxels within the threshold range (lower, upper].
+        """
+        if self.integer:
+            # Integer voxels are within the range if floor(lower) < x <= floor(upper).
+            start = math.floor(lowerThreshold) + 1 - int(self.minimum)
+            stop = math.floor(upperThreshold) + 1 - int(self.minimum)
+        else:
+            start = float(lowerThreshold) - float(self.minimum)
+            stop = float(upperThreshold) - float(self.minimum)
+        if not self.exact:
+            start = int(math.floor(start / self.binWidth + 0.5))
+            stop = int(math.floor(stop / self.binWidth + 0.5))
+        start = min(max(int(start), 0), self.binCount)
+        stop = min(max(int(stop), 0), self.binCount)
+        return start, max(start, stop)
+
+
+def _summedAreaTable(cellValues):
+    """
+    2D cumulative sums padded with a leading row and column of zeros.
+    """
+    table = np.zeros((cellValues.shape[0] + 1, cellValues.shape[1] + 1), dtype=cellValues.dtype)
+    np.cumsum(cellValues, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def saveScatterHistogramImage(scatterHistogram, label1, label2, fileLocation):
+    """
+    Save a 2D histogram as a PNG raster image with a logarithmic color scale, without any browser dependency.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+
+    counts = np.ma.masked_equal(scatterHistogram.counts.T, 0)
+    edges1 = scatterHistogram.binEdges(0)
+    edges2 = scatterHistogram.binEdges(1)
+    colormap = plt.get_cmap('viridis').copy()
+    colormap.set_bad('white')
+
+    figure, axis = plt.subplots(figsize=(4.5, 3.6), dpi=150)
+    image = axis.imshow(counts, origin='lower', aspect='auto', interpolation='nearest', cmap=colormap,
+                        extent=[edges1[0], edges1[-1], edges2[0], edges2[-1]],
+                        norm=LogNorm(vmin=1, vmax=max(1, int(scatterHistogram.counts.max()))))
+    axis.set_xlabel(label1, fontsize=8)
+    axis.set_ylabel(label2, fontsize=8)
+    axis.tick_params(labelsize=7)
+    colorbar = figure.colorbar(image, ax=axis)
+    colorbar.set_label('count (log scale)', fontsize=8)
+    colorbar.ax.tick_params(labelsize=7)
+    figure.tight_layout()
+    figure.savefig(fileLocation)
+    plt.close(figure)
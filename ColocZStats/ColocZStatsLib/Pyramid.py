@@ -0,0 +1,167 @@
+"""
+Coarse levels of the channels for quick previews of the colocalization statistics.
+
+Each level keeps every f-th voxel along K, J and I (f = 2, 4, 8), so it holds 1/f^3 of the voxels.
+Computing the statistics on a level is a uniform sample of the full-resolution computation: the volumes
+are scaled up by the sampling ratio, the coefficients are estimated directly, and every estimate comes with
+an approximate 95% error bound from its sampling error. Averaged or max-pooled levels would be smoother to
+look at, but they change the intensities that are thresholded and bias every metric in an unknown way.
+"""
+import math
+
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Sampling factors of the coarse levels.
+DEFAULT_FACTORS = (2, 4, 8)
+
+# The preview uses the coarsest level that still samples at least this many voxels of the ROI.
+PREVIEW_MIN_SAMPLES = 1 << 16
+
+# Normal quantile of the two-sided 95% error bounds.
+CONFIDENCE_Z = 1.96
+
+
+class ChannelPyramid(object):
+    """
+    Coarse levels of one channel, decimated on first use.
+    """
+
+    def __init__(self, arrayData, factors=DEFAULT_FACTORS):
+        self.arrayData = arrayData
+        self.factors = tuple(sorted(factors))
+        self._levels = dict()
+
+    def level(self, factor):
+        """
+        Channel array keeping every factor-th voxel along each axis (the full array for factor 1).
+        """
+        if factor == 1:
+            return self.arrayData
+        if factor not in self._levels:
+            self._levels[factor] = np.ascontiguousarray(self.arrayData[::factor, ::factor, ::factor])
+        return self._levels[factor]
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self._levels.values())
+
+
+def levelExtent(cropExtent, shape, factor):
+    """
+    Crop extent on a level of the voxels of a full-resolution crop extent (None for the whole volume).
+    A level voxel n is the full-resolution voxel n * factor, so the range [start, stop) becomes [ceil(start / f), ceil(stop / f)).
+    """
+    if cropExtent is None:
+        cropExtent = [0, shape[2], 0, shape[1], 0, shape[0]]
+    return [-(-max(0, int(value)) // factor) for value in cropExtent]
+
+
+def previewFactor(cropExtent, shape, factors=DEFAULT_FACTORS, minSamples=PREVIEW_MIN_SAMPLES):
+    """
+    Coarsest sampling factor that keeps at least minSamples voxels of the crop extent (1 if none does).
+    """
+    for factor in sorted(factors, reverse=True):
+        extent = levelExtent(cropExtent, shape, factor)
+        if max(0, extent[1] - extent[0]) * max(0, extent[3] - extent[2]) * max(0, extent[5] - extent[4]) >= minSamples:
+            return factor
+    return 1
+
+
+class PreviewEstimate(object):
+    """
+    Colocalization statistics of a crop extent estimated from a sampled level, with 95% error bounds.
+    """
+
+    def __init__(self, result, factor, fullVoxelCount):
+        # ColocResult of the sampled voxels.
+        self.result = result
+        self.factor = factor
+        # Number of full-resolution voxels represented by each sampled voxel.
+        self.scale = float(fullVoxelCount) / result.voxelCount if result.voxelCount else 0.0
+
+    def channelVolume(self, channel):
+        """
+        Estimated thresholded volume of a channel and its error bound, in full-resolution voxels.
+        """
+        return self._scaledCount(self.result.channelVolumes[channel])
+
+    def intersectionVolume(self, channels):
+        """
+        Estimated intersection volume of some channels and its error bound, in full-resolution voxels.
+        """
+        return self._scaledCount(self.result.intersectionVolume(channels))
+
+    def intersectionCoefficient(self):
+        """
+        Estimated global intersection coefficient I and its error bound.
+        """
+        channels = range(self.result.channelCount)
+        return _proportion(self.result.intersectionVolume(channels), self.result.unionVolume())
+
+    def channelCoefficient(self, channel):
+        """
+        Estimated intersection coefficient i of a channel and its error bound.
+        """
+        return _proportion(self.result.intersectionVolume(range(self.result.channelCount)), self.result.channelVolumes[channel])
+
+    def pearsonCoefficient(self, channel1, channel2):
+        """
+        Estimated Pearson correlation coefficient of a channel pair and its error bound (Fisher z interval).
+        """
+        value = self.result.pearsonCoefficients[tuple(sorted((channel1, channel2)))]
+        sampleCount = self.result.voxelCount
+        if value is None or math.isnan(value) or sampleCount <= 3:
+            return 0.0, 1.0
+        value = max(-0.999999, min(0.999999, value))
+        z = math.atanh(value)
+        halfWidth = CONFIDENCE_Z / math.sqrt(sampleCount - 3)
+        lower = math.tanh(z - halfWidth)
+        upper = math.tanh(z + halfWidth)
+        return value, max(value - lower, upper - value)
+
+    def _scaledCount(self, count):
+        """
+        A sampled voxel count scaled to full resolution, with the binomial error bound of the sampled proportion.
+        """
+        sampleCount = self.result.voxelCount
+        if sampleCount == 0:
+            return 0.0, 0.0
+        proportion, bound = _proportion(count, sampleCount)
+        fullVoxelCount = self.scale * sampleCount
+        return proportion * fullVoxelCount, bound * fullVoxelCount
+
+
+def _proportion(count, sampleCount):
+    """
+    Proportion count / sampleCount and the half-width of its 95% (Wilson) interval.
+    """
+    if sampleCount == 0:
+        return 0.0, 0.0
+    proportion = float(count) / sampleCount
+    z2 = CONFIDENCE_Z * CONFIDENCE_Z
+    center = (proportion + z2 / (2 * sampleCount)) / (1 + z2 / sampleCount)
+    halfWidth = CONFIDENCE_Z * math.sqrt(proportion * (1 - proportion) / sampleCount + z2 / (4 * sampleCount * sampleCount)) / (1 + z2 / sampleCount)
+    return proportion, max(abs(center + halfWidth - proportion), abs(proportion - (center - halfWidth)))
+
+
+def estimateColocalization(pyramids, cropExtent, thresholds, factor=None):
+    """
+    Estimate the colocalization statistics of the channels within a full-resolution crop extent from a coarse level.
+
+    :param pyramids: list of ChannelPyramid, one per channel.
+    :param cropExtent: voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax] at full resolution, or None.
+    :param thresholds: list of (lower, upper) threshold pairs, one per channel.
+    :param factor: sampling factor of the level, chosen with previewFactor if None.
+    :return: PreviewEstimate
+    """
+    shape = pyramids[0].arrayData.shape
+    if factor is None:
+        factor = previewFactor(cropExtent, shape, pyramids[0].factors)
+    fullExtent = cropExtent if cropExtent is not None else [0, shape[2], 0, shape[1], 0, shape[0]]
+    clamped = [min(max(0, int(fullExtent[index])), shape[2 - index // 2]) for index in range(6)]
+    fullVoxelCount = max(0, clamped[1] - clamped[0]) * max(0, clamped[3] - clamped[2]) * max(0, clamped[5] - clamped[4])
+    levelArrays = [pyramid.level(factor) for pyramid in pyramids]
+    result = ColocEngine.computeColocalization(levelArrays, levelExtent(cropExtent, shape, factor), thresholds)
+    return PreviewEstimate(result, factor, fullVoxelCount)
@@ -0,0 +1,152 @@
+"""
+On-disk cache of colocalization results and of the figures drawn from them.
+
+Entries are addressed by a hash of everything the outputs depend on (source file identity, channels,
+thresholds, crop extent, ...). Each entry is a directory holding the pickled result and copies of the
+figure files, so that computing the same statistics again only copies files back. The least recently
+used entries are removed when the cache grows over its size cap.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+# Default maximum size of the cache, in bytes.
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Part of every key; bump it when the cached result objects or figures change.
+CACHE_VERSION = 1
+
+# Name of the file holding the result within an entry directory.
+RESULT_FILENAME = 'result.pickle'
+
+
+def fileIdentity(filename):
+    """
+    Path, size and modification time of a source file, or None if it doesn't exist.
+    """
+    try:
+        status = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return [os.path.abspath(filename), status.st_size, status.st_mtime_ns]
+
+
+class CacheEntry(object):
+    """
+    One cache directory: the result (None until it is stored) and the figure files added to it.
+    """
+
+    def __init__(self, directory, result=None, artifactNames=None):
+        self.directory = directory
+        self.result = result
+        self.artifactNames = list(artifactNames or [])
+
+    @property
+    def hit(self):
+        return self.result is not None
+
+    def restoreArtifact(self, destination):
+        """
+        Copy the cached figure with the file name of destination to destination. Returns False if it isn't cached.
+        """
+        name = os.path.basename(destination)
+        if not self.hit or name not in self.artifactNames:
+            return False
+        shutil.copyfile(os.path.join(self.directory, name), destination)
+        return True
+
+    def addArtifact(self, location):
+        """
+        Keep a copy of a figure file, to be restored by later hits.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.basename(location)
+        shutil.copyfile(location, os.path.join(self.directory, name))
+        if name not in self.artifactNames:
+            self.artifactNames.append(name)
+
+
+class ResultCache(object):
+    """
+    Directory of cache entries with least recently used eviction.
+    """
+
+    def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = int(maxBytes)
+
+    def key(self, *parts):
+        """
+        Hash of the JSON representation of the key parts.
+        """
+        text = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def open(self, key):
+        """
+        Entry of a key. It is a hit if the result and all its figures are cached; otherwise it is
+        filled by the caller and stored with store.
+        """
+        entryDirectory = os.path.join(self.directory, key)
+        resultLocation = os.path.join(entryDirectory, RESULT_FILENAME)
+        try:
+            with open(resultLocation, 'rb') as resultFile:
+                result, artifactNames = pickle.load(resultFile)
+        except Exception:
+            # Missing, partial or written by an incompatible version: recompute.
+            return CacheEntry(entryDirectory)
+        if not all(os.path.exists(os.path.join(entryDirectory, name)) for name in artifactNames):
+            return CacheEntry(entryDirectory)
+        # The modification time of the result file is the last use of the entry.
+        os.utime(resultLocation)
+        return CacheEntry(entryDirectory, result, artifactNames)
+
+    def store(self, entry, result):
+        """
+        Save the result of an entry and evict the least recently used entries over the size cap.
+        """
+        os.makedirs(entry.directory, exist_ok=True)
+        resultLocation = os.path.join(entry.directory, RESULT_FILENAME)
+        temporaryLocation = resultLocation + '.tmp'
+        with open(temporaryLocation, 'wb') as resultFile:
+            pickle.dump((result, entry.artifactNames), resultFile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporaryLocation, resultLocation)
+        entry.result = result
+        self.evict(keep=entry.directory)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in maxBytes (the entry keep is never removed).
+        """
+        if not os.path.isdir(self.directory):
+            return
+        entries = list()
+        totalBytes = 0
+        for name in os.listdir(self.directory):
+            entryDirectory = os.path.join(self.directory, name)
+            if not os.path.isdir(entryDirectory):
+                continue
+            entryBytes = 0
+            lastUse = os.path.getmtime(entryDirectory)
+            for filename in os.listdir(entryDirectory):
+                location = os.path.join(entryDirectory, filename)
+                entryBytes += os.path.getsize(location)
+                if filename == RESULT_FILENAME:
+                    lastUse = os.path.getmtime(location)
+            entries.append((lastUse, entryDirectory, entryBytes))
+            totalBytes += entryBytes
+        for lastUse, entryDirectory, entryBytes in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            if keep is not None and os.path.abspath(entryDirectory) == os.path.abspath(keep):
+                continue
+            shutil.rmtree(entryDirectory, ignore_errors=True)
+            totalBytes -= entryBytes
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,100 @@
+"""
+The xlsx spreadsheets exported by ColocZStats, written with pandas and xlsxwriter.
+
+A spreadsheet is described as a list of sheets, each a (sheet name, content, header) tuple in order. The
+content of a table sheet is a dict of columns or a list of row dicts; the content of an image sheet is a list
+of (cell, image file) pairs, inserted in an otherwise empty sheet. writeSpreadsheet writes them; the other
+functions build the sheets shared by the module, the batch CLI and the benchmark. pandas is only imported
+when a spreadsheet is written, so this file can be imported without it.
+"""
+import itertools
+import time
+
+# Row labels of the ROI Information sheet of the exported spreadsheets.
+ROI_INFORMATION_LABELS = ["Coordinate System: ", "Center: ", "Orientation: ", "Size: ", "ROI JSON File Location: "]
+
+
+def isImageSheet(content):
+    """
+    Whether the content of a sheet is a list of (cell, image file) pairs rather than a table.
+    """
+    return isinstance(content, list) and len(content) > 0 and all(isinstance(item, tuple) for item in content)
+
+
+def writeSpreadsheet(outputFile, sheets, beforeClose=None, profiler=None):
+    """
+    Write the sheets (see the module docstring) to an xlsx file. beforeClose(writer) can add more sheets, and
+    the writing of the file is the "Writing the spreadsheet" span of the profiler, if given.
+    Raises ImportError if pandas or xlsxwriter is missing.
+    """
+    import pandas as pd
+    writer = pd.ExcelWriter(outputFile, engine='xlsxwriter')
+    for sheetName, content, header in sheets:
+        if isImageSheet(content):
+            worksheet = writer.book.add_worksheet(sheetName)
+            for cell, imageFile in content:
+                worksheet.insert_image(cell, imageFile)
+        else:
+            pd.DataFrame(content).to_excel(writer, sheet_name=sheetName, header=header, index=False)
+    if beforeClose is not None:
+        beforeClose(writer)
+    if profiler is None:
+        writer.close()
+    else:
+        with profiler.span("Writing the spreadsheet"):
+            writer.close()
+
+
+def thresholdRangeSheet(channelLabels, thresholdPairs):
+    """
+    The Threshold Ranges sheet, with the (lower, upper) thresholds as shown.
+    """
+    return ('Threshold Ranges', {'Channels': list(channelLabels),
+                                 'Threshold Ranges': [str(lowerThreshold) + '~' + str(upperThreshold) for lowerThreshold, upperThreshold in thresholdPairs]}, True)
+
+
+def roiInformationSheet(roiValues):
+    """
+    The ROI Information sheet, from the coordinate system, center, orientation, size and JSON file location of the ROI.
+    """
+    return ('ROI Information', {"ROI Information": ROI_INFORMATION_LABELS, "Values": list(roiValues)}, False)
+
+
+def annotationSheets(annotationText):
+    """
+    The Annotation sheet and the Timestamp sheet, with the current time.
+    """
+    return [('Annotation', {"Annotation": [annotationText]}, True), ('Timestamp', {"Timestamp": [time.ctime()]}, True)]
+
+
+def regionStatisticsSheets(result, thresholdPairs, channelLabels, roiValues, annotationText, chartImage=None, percentages=None):
+    """
+    Sheets of the statistics of a result with one row per Venn region, as ColocZStats exports them for any
+    number of channels. chartImage is the location of the region chart, if any.
+    """
+    channelCount = result.channelCount
+    if percentages is None:
+        percentages = result.vennPercentages()
+    regions = result.vennRegions(percentages)
+    intersectionCoefficient, channelCoefficients = result.intersectionCoefficients(percentages)
+
+    channelPairs = list(itertools.combinations(range(channelCount), 2))
+    pearsonCoefficients = {'Channel Pairs': [channelLabels[channel1] + " and " + channelLabels[channel2] for channel1, channel2 in channelPairs],
+                           'Pearson Correlation Coefficients (PCCs)': [result.pearsonCoefficient(channel1, channel2) for channel1, channel2 in channelPairs]}
+
+    intersectionCoefficients = {'Global Intersection Coefficient (I)': [intersectionCoefficient]}
+    for index in range(channelCount):
+        intersectionCoefficients['i' + str(index + 1)] = [channelCoefficients[index]]
+
+    vennRegions = dict()
+    for index in range(channelCount):
+        vennRegions[channelLabels[index]] = ['x' if index in channels else '' for channels, volume, percentage in regions]
+    vennRegions['Region Volume'] = [volume for channels, volume, percentage in regions]
+    vennRegions['Region Percentage (%)'] = [format(float(percentage), '.4f') for channels, volume, percentage in regions]
+    vennRegions['Intersection Volume'] = [result.intersectionVolume(channels) for channels, volume, percentage in regions]
+
+    sheets = [thresholdRangeSheet(channelLabels, thresholdPairs), roiInformationSheet(roiValues), ('PCCs', pearsonCoefficients, True),
+              ('Intersection Coefficients', intersectionCoefficients, True), ('Venn Regions', vennRegions, True)]
+    if chartImage is not None:
+        sheets.append(('Venn Regions Chart', [('A1', chartImage)], True))
+    return sheets + annotationSheets(annotationText)
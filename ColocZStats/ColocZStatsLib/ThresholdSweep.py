@@ -0,0 +1,199 @@
+"""
+Colocalization metrics over a grid of lower thresholds.
+
+Every voxel is mapped, for each channel, to the number of grid thresholds that are below its intensity
+(its "level"; voxels above the upper threshold get level 0). A voxel is within the threshold range of
+grid threshold t exactly when its level is greater than t. One pass over the data builds the histogram
+of the level combinations together with the per-cell sums needed for the PCC, and reverse cumulative
+sums of those tables give the ColocMoments of any grid point with a few lookups. The ColocResult of each
+grid point is built once, and the table rows and heatmap grids are derived from these results.
+"""
+import itertools
+
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Voxels per block; small enough that the per-block sums of squared 16-bit values stay exact in float64.
+SWEEP_BLOCK_VOXELS = 1 << 20
+
+
+def thresholdGrid(start, stop, step):
+    """
+    Thresholds from start to stop (inclusive) in increments of step.
+    """
+    if step <= 0:
+        raise ValueError("The threshold step must be positive.")
+    count = int(np.floor((float(stop) - float(start)) / float(step) + 1e-9)) + 1
+    return [float(start) + index * float(step) for index in range(max(count, 0))]
+
+
+class ThresholdSweep(object):
+    """
+    Colocalization statistics of 2 or more channels for every combination of grid lower thresholds,
+    with a fixed upper threshold per channel.
+    """
+
+    def __init__(self, channelArrays, lowerThresholdGrids, upperThresholds, blockVoxels=SWEEP_BLOCK_VOXELS):
+        if not (len(channelArrays) == len(lowerThresholdGrids) == len(upperThresholds)):
+            raise ValueError("One threshold grid and upper threshold is required for each channel.")
+        self.channelCount = len(channelArrays)
+        self.lowerThresholdGrids = [sorted(float(threshold) for threshold in grid) for grid in lowerThresholdGrids]
+        self.upperThresholds = [float(threshold) for threshold in upperThresholds]
+        self.voxelCount = int(channelArrays[0].size)
+        self.exact = all(np.issubdtype(arrayData.dtype, np.integer) and arrayData.dtype.itemsize <= 2 for arrayData in channelArrays)
+
+        self.pairs = list(itertools.combinations(range(self.channelCount), 2))
+        dimensions = tuple(len(grid) + 1 for grid in self.lowerThresholdGrids)
+        cellCount = int(np.prod(dimensions))
+        tableDtype = np.int64 if self.exact else np.float64
+        # Tables: count, sum x_c for each channel, sum x_c^2 for each channel, sum x_a * x_b for each pair.
+        tables = [np.zeros(cellCount, dtype=tableDtype) for index in range(1 + 2 * self.channelCount + len(self.pairs))]
+
+        for slab in ColocEngine.iterateSlabs(channelArrays[0].shape, blockVoxels):
+            values = list()
+            levels = list()
+            for channel, arrayData in enumerate(channelArrays):
+                block = arrayData[slab].reshape(-1)
+                level = np.searchsorted(np.asarray(self.lowerThresholdGrids[channel]), block, side='left')
+                level[block > self.upperThresholds[channel]] = 0
+                values.append(block.astype(np.float64))
+                levels.append(level)
+            cells = np.ravel_multi_index(levels, dimensions)
+            blockTables = [np.bincount(cells, minlength=cellCount)]
+            blockTables += [np.bincount(cells, weights=value, minlength=cellCount) for value in values]
+            blockTables += [np.bincount(cells, weights=value * value, minlength=cellCount) for value in values]
+            blockTables += [np.bincount(cells, weights=values[channel1] * values[channel2], minlength=cellCount) for channel1, channel2 in self.pairs]
+            for table, blockTable in zip(tables, blockTables):
+                table += np.rint(blockTable).astype(np.int64) if self.exact else blockTable
+
+        # Reverse cumulative sums: entry [l_1, ..., l_n] sums all cells with level_c >= l_c for every channel.
+        self._tables = list()
+        for table in tables:
+            table = table.reshape(dimensions)
+            for axis in range(self.channelCount):
+                table = np.flip(np.cumsum(np.flip(table, axis), axis=axis), axis)
+            self._tables.append(table)
+        # ColocResults of every grid point, built on first use.
+        self._results = None
+
+    @property
+    def gridShape(self):
+        return tuple(len(grid) for grid in self.lowerThresholdGrids)
+
+    def _lookup(self, tableIndex, gridIndex, channels):
+        levelIndex = [0] * self.channelCount
+        for channel in channels:
+            levelIndex[channel] = gridIndex[channel] + 1
+        return ColocEngine.toPythonNumber(self._tables[tableIndex][tuple(levelIndex)])
+
+    def moments(self, gridIndex):
+        """
+        ColocMoments of the channels for the lower thresholds at a grid index (one index per channel).
+        """
+        channelCount = self.channelCount
+        thresholds = [(self.lowerThresholdGrids[channel][gridIndex[channel]], self.upperThresholds[channel]) for channel in range(channelCount)]
+        moments = ColocEngine.ColocMoments(thresholds)
+        moments.exact = self.exact
+        moments.voxelCount = self.voxelCount
+        for channel in range(channelCount):
+            moments.channelCounts[channel] = self._lookup(0, gridIndex, [channel])
+            moments.channelSums[channel] = self._lookup(1 + channel, gridIndex, [channel])
+            moments.channelSquareSums[channel] = self._lookup(1 + channelCount + channel, gridIndex, [channel])
+        for pairIndex, pair in enumerate(self.pairs):
+            moments.pairCounts[pair] = self._lookup(0, gridIndex, pair)
+            moments.pairSums[pair] = (self._lookup(1 + pair[0], gridIndex, pair), self._lookup(1 + pair[1], gridIndex, pair))
+            moments.pairProducts[pair] = self._lookup(1 + 2 * channelCount + pairIndex, gridIndex, pair)
+        for channels in moments.subsetCounts:
+            moments.subsetCounts[channels] = self._lookup(0, gridIndex, channels)
+        return moments
+
+    def result(self, gridIndex):
+        """
+        ColocResult of the channels for the lower thresholds at a grid index.
+        """
+        if self._results is not None:
+            return self._results[tuple(gridIndex)]
+        return self.moments(gridIndex).toResult()
+
+    def results(self):
+        """
+        Array (shaped like gridShape) of the ColocResults of every grid point. They are built once, on the first call.
+        """
+        if self._results is None:
+            results = np.empty(self.gridShape, dtype=object)
+            for gridIndex in itertools.product(*[range(size) for size in self.gridShape]):
+                results[gridIndex] = self.moments(gridIndex).toResult()
+            self._results = results
+        return self._results
+
+    def rows(self, channelLabels):
+        """
+        One table row (dict) per grid point, with the thresholds, volumes and coefficients.
+        """
+        rows = list()
+        for result in self.results().reshape(-1):
+            intersectionCoefficient, channelCoefficients = result.intersectionCoefficients()
+            row = dict()
+            for channel, label in enumerate(channelLabels):
+                row[label + ' Threshold Range'] = str(result.thresholds[channel][0]) + '~' + str(result.thresholds[channel][1])
+            for channel, label in enumerate(channelLabels):
+                row[label + ' Volume'] = result.channelVolumes[channel]
+            row['Intersection Volume'] = result.intersectionVolume(range(self.channelCount))
+            row['Global Intersection Coefficient (I)'] = intersectionCoefficient
+            for channel in range(self.channelCount):
+                row['i' + str(channel + 1)] = channelCoefficients[channel]
+            for channel1, channel2 in self.pairs:
+                row['PCC ' + channelLabels[channel1] + ' and ' + channelLabels[channel2]] = result.pearsonCoefficient(channel1, channel2)
+            rows.append(row)
+        return rows
+
+    def coefficientGrid(self, name):
+        """
+        Grid (shaped like gridShape) of the global intersection coefficient ('I') or of a PCC ('PCC', first channel pair).
+        """
+        results = self.results()
+        grid = np.zeros(self.gridShape)
+        for gridIndex in itertools.product(*[range(size) for size in self.gridShape]):
+            result = results[gridIndex]
+            if name == 'I':
+                grid[gridIndex] = float(result.intersectionCoefficients()[0])
+            else:
+                grid[gridIndex] = float(result.pearsonCoefficient(0, 1))
+        return grid
+
+
+def saveSweepHeatmap(sweep, channelLabels, fileLocation):
+    """
+    Save heatmaps of the global intersection coefficient and of the PCC of the first two channels over their
+    lower thresholds. With three channels, one heatmap of I is drawn for a few lower thresholds of the third channel.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    intersectionGrid = sweep.coefficientGrid('I')
+    grid1 = sweep.lowerThresholdGrids[0]
+    grid2 = sweep.lowerThresholdGrids[1]
+    extent = [grid2[0], grid2[-1], grid1[0], grid1[-1]]
+
+    panels = list()
+    if sweep.channelCount == 2:
+        panels.append(('I', intersectionGrid))
+        panels.append(('PCC ' + channelLabels[0] + ' and ' + channelLabels[1], sweep.coefficientGrid('PCC')))
+    else:
+        grid3 = sweep.lowerThresholdGrids[2]
+        for index3 in sorted(set(np.linspace(0, len(grid3) - 1, min(4, len(grid3))).astype(int))):
+            selection = (slice(None), slice(None), index3) + (0,) * (sweep.channelCount - 3)
+            panels.append(('I, ' + channelLabels[2] + ' > ' + str(grid3[index3]), intersectionGrid[selection]))
+
+    figure, axes = plt.subplots(1, len(panels), figsize=(4.5 * len(panels), 4), dpi=150, squeeze=False)
+    for axis, (title, values) in zip(axes[0], panels):
+        image = axis.imshow(values, origin='lower', aspect='auto', extent=extent, cmap='viridis')
+        axis.set_title(title, fontsize=9)
+        axis.set_xlabel(channelLabels[1] + ' lower threshold')
+        axis.set_ylabel(channelLabels[0] + ' lower threshold')
+        figure.colorbar(image, ax=axis)
+    figure.tight_layout()
+    figure.savefig(fileLocation, bbox_inches='tight')
+    plt.close(figure)
@@ -0,0 +1,183 @@
+"""
+Z-slab access to multi-channel Z-stack TIFF files.
+
+TiffChannelReader reads only the Z slices (and the Y/X range) that are asked for, either through a
+memory map (uncompressed files) or by decoding the corresponding TIFF pages, so stacks that are larger
+than the available memory can still be analysed slab by slab.
+"""
+import numpy as np
+
+from ColocZStatsLib import ColocEngine
+
+# Default memory budget of the slab streaming, in bytes.
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# Bytes of temporaries the moment kernel needs per voxel and channel on top of the raw data
+# (mask, int64 copy and square of the slab).
+KERNEL_BYTES_PER_VOXEL = 24
+
+
+class TiffChannelReader(object):
+    """
+    Random access to the Z slices of each channel of a multi-channel Z-stack TIFF.
+    The first series of the file must have the axes C, Z, Y and X (in any order).
+    """
+
+    def __init__(self, filename):
+        import tifffile
+
+        self.filename = filename
+        self.tif = tifffile.TiffFile(filename)
+        series = self.tif.series[0]
+        self.axes = str(series.axes)
+        self.shape = tuple(series.shape)
+        self.dtype = np.dtype(series.dtype)
+
+        if 'Z' not in self.axes:
+            self.close()
+            raise ValueError("Z-stacked image required.")
+        if 'C' not in self.axes:
+            self.close()
+            raise ValueError("Multi-channel image required. The axes read by TiffFile library are:" + self.axes + ", without the inclusion of the channel indicator 'C'.")
+        if len(self.shape) != 4 or not ('Y' in self.axes and 'X' in self.axes):
+            self.close()
+            raise ValueError("The number of axes read by TiffFile library is incompatible. Expected 4. Got " + str(len(self.shape)))
+
+        self.channelCount = self.shape[self.axes.index('C')]
+        self.depth = self.shape[self.axes.index('Z')]
+        self.height = self.shape[self.axes.index('Y')]
+        self.width = self.shape[self.axes.index('X')]
+
+        # Uncompressed contiguous data can be memory mapped, otherwise pages are decoded on demand.
+        self._memmap = None
+        try:
+            self._memmap = tifffile.memmap(filename, series=0, mode='r')
+        except (ValueError, OSError):
+            self._memmap = None
+        if self._memmap is None:
+            # Axes before the page axes index the pages of the series, the page axes index the data of a page.
+            pageDimensions = len(series.keyframe.shape)
+            self._leadingAxes = self.axes[:len(self.axes) - pageDimensions]
+            self._pageAxes = self.axes[len(self._leadingAxes):]
+            if 'Z' not in self._leadingAxes or 'Y' not in self._pageAxes or 'X' not in self._pageAxes:
+                self.close()
+                raise ValueError("Unsupported TIFF layout for slab streaming: " + self.axes)
+            self._leadingShape = self.shape[:len(self._leadingAxes)]
+
+    @property
+    def dimensions(self):
+        """
+        Shape of a single channel in kji (ZYX) order.
+        """
+        return (self.depth, self.height, self.width)
+
+    def close(self):
+        self._memmap = None
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def clampedExtent(self, cropExtent):
+        """
+        Crop extent [iMin, iMax, jMin, jMax, kMin, kMax] clamped to the image, the whole image if None.
+        """
+        if cropExtent is None:
+            return [0, self.width, 0, self.height, 0, self.depth]
+        cropExtent = [max(0, int(value)) for value in cropExtent]
+        return [min(cropExtent[0], self.width), min(cropExtent[1], self.width),
+                min(cropExtent[2], self.height), min(cropExtent[3], self.height),
+                min(cropExtent[4], self.depth), min(cropExtent[5], self.depth)]
+
+    def readSlab(self, channel, zStart, zStop, cropExtent=None):
+        """
+        Read Z slices [zStart, zStop) of one channel, restricted to the Y/X range of the crop extent.
+        Returns an array in kji (ZYX) order.
+        """
+        extent = self.clampedExtent(cropExtent)
+        ySlice = slice(extent[2], extent[3])
+        xSlice = slice(extent[0], extent[1])
+        if self._memmap is not None:
+            index = list()
+            for axis in self.axes:
+                if axis == 'C':
+                    index.append(channel)
+                elif axis == 'Z':
+                    index.append(slice(zStart, zStop))
+                elif axis == 'Y':
+                    index.append(ySlice)
+                else:
+                    index.append(xSlice)
+            slab = self._memmap[tuple(index)]
+            remainingAxes = [axis for axis in self.axes if axis != 'C']
+            slab = np.transpose(slab, [remainingAxes.index(axis) for axis in 'ZYX'])
+            return np.ascontiguousarray(slab)
+
+        pageIndices = list()
+        for z in range(zStart, zStop):
+            position = [channel if axis == 'C' else z for axis in self._leadingAxes]
+            pageIndices.append(int(np.ravel_multi_index(position, self._leadingShape)))
+        if not pageIndices:
+            return np.zeros((0, extent[3] - extent[2], extent[1] - extent[0]), dtype=self.dtype)
+        pages = self.tif.asarray(key=pageIndices, series=0)
+        pages = pages.reshape((len(pageIndices),) + self.shape[len(self._leadingAxes):])
+        index = [slice(None)]
+        for axis in self._pageAxes:
+            if axis == 'C':
+                index.append(channel)
+            elif axis == 'Y':
+                index.append(ySlice)
+            else:
+                index.append(xSlice)
+        slab = pages[tuple(index)]
+        remainingAxes = ['Z'] + [axis for axis in self._pageAxes if axis != 'C']
+        slab = np.transpose(slab, [remainingAxes.index(axis) for axis in 'ZYX'])
+        return np.ascontiguousarray(slab)
+
+    def readChannel(self, channel):
+        """
+        Read a whole channel in kji (ZYX) order.
+        """
+        return self.readSlab(channel, 0, self.depth)
+
+    def slabSlicesForBudget(self, channelCount, memoryBudget):
+        """
+        Number of Z slices per slab so that the slabs of all channels plus the kernel temporaries fit in the budget.
+        """
+        bytesPerSlice = self.height * self.width * channelCount * (self.dtype.itemsize + KERNEL_BYTES_PER_VOXEL)
+        return max(1, int(memoryBudget) // max(1, bytesPerSlice))
+
+
+def computeColocalizationFromTiff(filename, channels, cropExtent, thresholds, memoryBudget=DEFAULT_MEMORY_BUDGET):
+    """
+    Compute the colocalization statistics of some channels of a TIFF file within the crop extent,
+    reading the file in Z-slabs so that at most about memoryBudget bytes are used at once.
+    Gives the same result as ColocEngine.computeColocalization on the fully loaded channels.
+
+    :param filename: path of the multi-channel Z-stack TIFF file.
+    :param channels: indices of the channels to analyse.
+    :param cropExtent: voxel based crop extent [iMin, iMax, jMin, jMax, kMin, kMax], or None for the whole stack.
+    :param thresholds: list of (lower, upper) threshold pairs, one per selected channel.
+    :param memoryBudget: approximate number of bytes that may be used for the slabs.
+    :return: ColocEngine.ColocResult
+    """
+    if len(channels) != len(thresholds):
+        raise ValueError("One threshold pair is required for each channel.")
+
+    with TiffChannelReader(filename) as reader:
+        for channel in channels:
+            if channel < 0 or channel >= reader.channelCount:
+                raise ValueError("Channel " + str(channel + 1) + " does not exist in " + filename)
+        extent = reader.clampedExtent(cropExtent)
+        slabSlices = reader.slabSlicesForBudget(len(channels), memoryBudget)
+
+        moments = ColocEngine.ColocMoments(thresholds)
+        for zStart in range(extent[4], extent[5], slabSlices):
+            zStop = min(zStart + slabSlices, extent[5])
+            moments.accumulate([reader.readSlab(channel, zStart, zStop, extent) for channel in channels])
+        return moments.toResult()
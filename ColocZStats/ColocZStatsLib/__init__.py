@@ -0,0 +1,6 @@
+"""
+Slicer-independent helpers used by the ColocZStats module.
+
+Everything in this package only depends on NumPy (and optional packages that are
+imported lazily), so the same computations can run in batch jobs without a 3D Slicer GUI.
+"""